@@ -0,0 +1,43 @@
+"""
+ComfyUI客户端模块 - 所有服务共享的ComfyUI访问层
+"""
+
+from comfyui_gradio.client.metrics import ClientMetrics
+from comfyui_gradio.client.comfyui_client import (
+    ComfyUIClient, ExecutionError, get_client
+)
+from comfyui_gradio.client.backend_pool import BackendPool, get_pool
+from comfyui_gradio.client.dispatcher import QueueFullError
+from comfyui_gradio.client.circuit_breaker import CircuitBreaker, CircuitOpenError
+from comfyui_gradio.client.status import RequestStatus
+from comfyui_gradio.client.fair_share import FairShare
+from comfyui_gradio.client.schema import WorkflowValidationError
+from comfyui_gradio.client.workflow_template import (
+    WorkflowTemplate, new_request_id
+)
+from comfyui_gradio.client.priority import (
+    PRIORITY_INTERACTIVE, PRIORITY_NORMAL, PRIORITY_BULK,
+    get_caller, get_priority
+)
+
+__all__ = [
+    'PRIORITY_BULK',
+    'PRIORITY_INTERACTIVE',
+    'PRIORITY_NORMAL',
+    'BackendPool',
+    'CircuitBreaker',
+    'CircuitOpenError',
+    'ClientMetrics',
+    'ComfyUIClient',
+    'ExecutionError',
+    'FairShare',
+    'QueueFullError',
+    'RequestStatus',
+    'WorkflowTemplate',
+    'WorkflowValidationError',
+    'get_caller',
+    'get_client',
+    'get_pool',
+    'get_priority',
+    'new_request_id'
+]
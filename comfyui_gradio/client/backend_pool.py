@@ -0,0 +1,413 @@
+"""
+后端池 - 在多个ComfyUI后端之间按队列深度分配请求
+"""
+
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+
+from comfyui_gradio.config import Config
+from comfyui_gradio.utils.logger import setup_logger
+from comfyui_gradio.client.dispatcher import QueueFullError
+from comfyui_gradio.client.priority import PRIORITY_NORMAL
+from comfyui_gradio.client.status import RequestStatus
+from comfyui_gradio.client.fair_share import get_fair_share
+from comfyui_gradio.client.workflow_template import WorkflowTemplate
+from comfyui_gradio.client.schema import (
+    WorkflowValidationError, get_schema_cache, validate_workflow
+)
+from comfyui_gradio.utils.error_reporter import ErrorReporter
+from comfyui_gradio.client.comfyui_client import (
+    ComfyUIClient, get_client, get_backend_urls, get_model_group
+)
+
+# 设置日志
+logger = setup_logger("comfyui-client-logs")
+
+
+class BackendPool:
+    """
+    多个ComfyUI后端组成的池
+
+    每次请求开始时通过select()选出队列最短的健康后端，之后该请求的上传、
+    提交和结果获取都使用同一个后端。队列深度读取自/queue并短暂缓存，
+    缓存期内每分配一个请求就把对应后端的深度加一，避免突发请求全部
+    落到同一个后端。
+
+    各工作流加载的模型差异很大，池会记住每个后端最近运行过的模型组，
+    优先分配到已加载对应模型的后端，只有其队列超过阈值时才分配到
+    其他后端，减少模型切换。
+
+    服务启动时通过validate()按各后端的节点定义校验工作流，节点类型或
+    必填输入不存在的工作流不再分配到该后端，请求在排队前就会失败。
+    """
+
+    def __init__(self, urls: List[str]):
+        """
+        初始化后端池
+
+        Args:
+            urls: ComfyUI后端地址列表
+        """
+        self.backends: List[ComfyUIClient] = [get_client(url) for url in urls]
+        # 多个后端时，提交重试仍失败的请求可以转移到其他后端
+        if len(self.backends) > 1 and Config.get(
+                "comfyui_server.retry.failover", True):
+            for backend in self.backends:
+                backend.pool = self
+        # 队列深度缓存时间（秒）
+        self.queue_cache_ttl = Config.get("comfyui_server.queue_cache_ttl", 1.0)
+        # 键为后端地址，值为(读取时间, 队列深度)
+        self._queue_depths: Dict[str, Tuple[float, int]] = {}
+        # 队列深度相同时轮流分配
+        self._next_index = 0
+        self._lock = threading.Lock()
+
+        # 模型亲和：每个后端记住的最近模型组数量，以及已预热后端的队列
+        # 深度超过多少时改为分配到其他后端
+        self.affinity_slots = Config.get("comfyui_server.affinity_slots", 1)
+        self.affinity_spill_threshold = Config.get(
+            "comfyui_server.affinity_spill_threshold", 2)
+        # 键为后端地址，值为按运行时间排序的最近模型组
+        self._warm_groups: Dict[str, OrderedDict] = {
+            backend.base_url: OrderedDict() for backend in self.backends}
+        self.affinity_hits = 0
+        self.affinity_misses = 0
+        # 按调用方限速，所有后端共享
+        self.fair_share = get_fair_share()
+        # 工作流校验发现的问题，键为工作流名称，值为{后端地址: 问题列表}
+        self._invalid: Dict[str, Dict[str, List[str]]] = {}
+        # 尚未完成校验的后端，键为工作流名称，值为后端地址集合
+        self._unvalidated: Dict[str, set] = {}
+
+    def validate(self, template: WorkflowTemplate,
+                 error_reporter: Optional[ErrorReporter] = None) -> None:
+        """
+        在后台线程中按各后端的/object_info校验工作流，不阻塞服务启动
+
+        暂时无法访问的后端（如ComfyUI晚于服务启动）按指数退避重试，
+        校验完成前在统计信息中显示为未校验，请求仍可分配到该后端。
+
+        Args:
+            template: 工作流模板
+            error_reporter: 发现问题时用于记录和告警，None时只记录日志
+        """
+        if not Config.get("comfyui_server.validate_workflows", True):
+            return
+        with self._lock:
+            self._unvalidated[template.name] = {
+                backend.base_url for backend in self.backends}
+        threading.Thread(
+            target=self._validate, args=(template, error_reporter),
+            name=f"validate-{template.name}", daemon=True
+        ).start()
+
+    def _validate(self, template: WorkflowTemplate,
+                  error_reporter: Optional[ErrorReporter],
+                  retry_delay: float = 5.0) -> None:
+        """
+        逐个后端校验工作流，记录不能执行该工作流的后端，无法访问的后端
+        等待后重试，间隔从retry_delay开始翻倍，最长validate_retry_max_delay
+        """
+        max_delay = Config.get("comfyui_server.validate_retry_max_delay", 60)
+        pending = list(self.backends)
+        attempt = 0
+        while True:
+            attempt += 1
+            pending = [
+                backend for backend in pending
+                if not self._validate_backend(
+                    template, backend, error_reporter, attempt)]
+            if not pending:
+                return
+            time.sleep(min(retry_delay * 2 ** (attempt - 1), max_delay))
+
+    def _validate_backend(self, template: WorkflowTemplate,
+                          backend: ComfyUIClient,
+                          error_reporter: Optional[ErrorReporter],
+                          attempt: int) -> bool:
+        """按一个后端的节点定义校验工作流，后端无法访问时返回False"""
+        cache = get_schema_cache()
+        nodes = template.nodes
+        if backend.result_mode == "websocket":
+            # 提交时SaveImage替换为SaveImageWebsocket，按替换后的工作流校验
+            nodes = backend.use_websocket_output(nodes)
+        try:
+            errors, warnings = validate_workflow(
+                nodes, cache.get(backend.base_url))
+            if errors:
+                # 磁盘缓存可能早于自定义节点的安装，重新读取后再确认
+                errors, warnings = validate_workflow(
+                    nodes, cache.get(backend.base_url, refresh=True))
+        except Exception as e:
+            # 只在第一次失败时警告，之后的重试记为调试日志
+            log = logger.warning if attempt == 1 else logger.debug
+            log(f"无法校验工作流{template.name} [{backend.base_url}]，"
+                f"稍后重试: {e}")
+            return False
+
+        for warning in warnings:
+            logger.warning(
+                f"工作流{template.name} [{backend.base_url}]: {warning}")
+        with self._lock:
+            self._unvalidated.get(template.name, set()).discard(
+                backend.base_url)
+            backends = self._invalid.setdefault(template.name, {})
+            if errors:
+                backends[backend.base_url] = errors
+            else:
+                backends.pop(backend.base_url, None)
+        if not errors:
+            logger.info(f"工作流{template.name}校验通过 [{backend.base_url}]")
+            return True
+
+        message = f"工作流{template.name}与ComfyUI后端不匹配"
+        context = {"后端": backend.base_url, "问题": "; ".join(errors)}
+        if error_reporter is not None:
+            error_reporter.report(message, None, context)
+        else:
+            logger.error(f"{message}: {context}")
+        return True
+
+    async def select(self, workflow_name: Optional[str] = None,
+                     priority: int = PRIORITY_NORMAL,
+                     exclude: Optional[ComfyUIClient] = None,
+                     status: Optional[RequestStatus] = None) -> ComfyUIClient:
+        """
+        选择后端：优先已加载该工作流模型的后端，其次队列最短的健康后端
+
+        Args:
+            workflow_name: 工作流名称（工作流文件名，不含扩展名）
+            priority: 请求优先级
+            exclude: 不参与分配的后端，如刚刚提交失败的后端
+            status: 请求状态，传入时使用其中的优先级，并先按调用方限速
+
+        Returns:
+            选中的后端客户端
+
+        Raises:
+            QueueFullError: 所有后端的排队请求都已达上限，或调用方请求过于频繁
+            WorkflowValidationError: 工作流在所有后端上都校验失败
+        """
+        with self._lock:
+            invalid = dict(self._invalid.get(workflow_name, {}))
+        backends = [
+            backend for backend in self.backends
+            if backend.base_url not in invalid]
+        if not backends:
+            errors = next(iter(invalid.values()))
+            raise WorkflowValidationError(
+                f"工作流{workflow_name}与ComfyUI后端不匹配，请联系管理员: "
+                f"{errors[0]}")
+
+        if status is not None:
+            priority = status.priority
+            await self.fair_share.throttle(status)
+
+        group = get_model_group(workflow_name)
+        # 排队已满的后端不再分配，全部排满时立即拒绝，不必再上传输入图片
+        available = [
+            backend for backend in backends
+            if backend is not exclude
+            and not backend.dispatcher.is_full(priority)]
+        if not available:
+            if exclude is None:
+                for backend in self.backends:
+                    backend.dispatcher.rejected += 1
+            raise QueueFullError("所有ComfyUI后端的排队请求已满，请稍后再试")
+
+        if len(self.backends) == 1:
+            backend = available[0]
+            with self._lock:
+                self._mark_warm(backend, group)
+            return backend
+
+        candidates = [
+            backend for backend in available if backend.breaker.available]
+        if not candidates:
+            # 全部后端都处于熔断状态时仍然分配，由请求本身快速失败并报告
+            logger.warning("所有ComfyUI后端均处于熔断状态")
+            candidates = available
+
+        depths = await asyncio.gather(
+            *(self._get_queue_depth(backend) for backend in candidates))
+
+        with self._lock:
+            start = self._next_index
+            self._next_index += 1
+            ranked = [
+                (depth, (index - start) % len(candidates), backend)
+                for index, (backend, depth) in enumerate(
+                    zip(candidates, depths))
+                if depth is not None
+            ]
+            if not ranked:
+                backend = candidates[start % len(candidates)]
+                self._mark_warm(backend, group)
+                return backend
+
+            depth, _, backend = min(ranked, key=lambda item: item[:2])
+            warm = [
+                item for item in ranked
+                if group in self._warm_groups[item[2].base_url]]
+            if warm:
+                warm_depth, _, warm_backend = min(
+                    warm, key=lambda item: item[:2])
+                # 预热后端不太忙时优先使用，否则溢出到队列更短的后端
+                if (warm_depth <= self.affinity_spill_threshold
+                        or warm_depth <= depth):
+                    depth, backend = warm_depth, warm_backend
+
+            fetched_at, _ = self._queue_depths[backend.base_url]
+            self._queue_depths[backend.base_url] = (fetched_at, depth + 1)
+            self._mark_warm(backend, group)
+
+        logger.debug(
+            f"分配ComfyUI后端: {backend.base_url}, 队列深度: {depth}, "
+            f"模型组: {group}")
+        return backend
+
+    def _mark_warm(self, backend: ComfyUIClient, group: Optional[str]) -> None:
+        """记录后端即将运行的模型组并统计命中情况，调用方需持有锁"""
+        if group is None:
+            return
+        warm_groups = self._warm_groups[backend.base_url]
+        if group in warm_groups:
+            self.affinity_hits += 1
+            warm_groups.move_to_end(group)
+        else:
+            self.affinity_misses += 1
+            warm_groups[group] = True
+            while len(warm_groups) > self.affinity_slots:
+                warm_groups.popitem(last=False)
+
+    async def _get_queue_depth(self, backend: ComfyUIClient) -> Optional[int]:
+        """读取后端队列深度，缓存未过期时直接使用缓存，读取失败返回None"""
+        with self._lock:
+            cached = self._queue_depths.get(backend.base_url)
+        if cached is not None and time.time() - cached[0] < self.queue_cache_ttl:
+            return cached[1]
+
+        try:
+            depth = await backend.get_queue_depth()
+        except Exception as e:
+            logger.warning(f"读取ComfyUI队列失败 [{backend.base_url}]: {e}")
+            return None
+
+        # 加上在客户端调度器中等待提交的请求
+        depth += backend.dispatcher.waiting
+        with self._lock:
+            self._queue_depths[backend.base_url] = (time.time(), depth)
+        return depth
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取后端池统计信息"""
+        with self._lock:
+            depths = {
+                url: depth for url, (_, depth) in self._queue_depths.items()}
+            warm_groups = {
+                url: list(groups) for url, groups in self._warm_groups.items()}
+            invalid = {
+                url: sorted(name for name, backends in self._invalid.items()
+                            if url in backends)
+                for url in warm_groups}
+            unvalidated = {
+                url: sorted(name for name, urls in self._unvalidated.items()
+                            if url in urls)
+                for url in warm_groups}
+            hits, misses = self.affinity_hits, self.affinity_misses
+        backends = []
+        for backend in self.backends:
+            stats = backend.get_stats()
+            stats["queue_depth"] = depths.get(backend.base_url)
+            stats["warm_groups"] = warm_groups[backend.base_url]
+            stats["invalid_workflows"] = invalid[backend.base_url]
+            stats["unvalidated_workflows"] = unvalidated[backend.base_url]
+            backends.append(stats)
+        total = hits + misses
+        return {
+            "backends": backends,
+            "affinity": {
+                "hits": hits,
+                "misses": misses,
+                "hit_ratio": hits / total if total else 0.0
+            },
+            "fair_share": self.fair_share.get_stats()
+        }
+
+    def format_stats(self) -> str:
+        """
+        把统计信息整理成一行日志：每个后端的熔断状态、排队情况和缓存
+        命中，以及模型亲和命中率
+
+        Returns:
+            供运维查看的统计摘要
+        """
+        stats = self.get_stats()
+        parts = []
+        for backend in stats["backends"]:
+            dispatch = backend["dispatch"]
+            text = (
+                f"{backend['backend']}: 熔断={backend['circuit']['state']}, "
+                f"执行中={dispatch['outstanding']}, 排队={dispatch['waiting']}, "
+                f"队列深度={backend['queue_depth']}, "
+                f"已加载={backend['warm_groups']}")
+            cache = backend["result_cache"]
+            if cache is not None:
+                text += (
+                    f", 缓存命中率={cache['hit_ratio']:.1%}, "
+                    f"节省={cache['bytes_saved'] / 1024 / 1024:.1f}MB")
+            if backend["invalid_workflows"]:
+                text += f", 校验失败={backend['invalid_workflows']}"
+            if backend["unvalidated_workflows"]:
+                text += f", 未校验={backend['unvalidated_workflows']}"
+            parts.append(f"[{text}]")
+        affinity = stats["affinity"]
+        return (
+            f"ComfyUI后端状态: {' '.join(parts)} "
+            f"模型亲和命中率={affinity['hit_ratio']:.1%}"
+            f"({affinity['hits']}/{affinity['hits'] + affinity['misses']}), "
+            f"限速等待={stats['fair_share']['throttled']}")
+
+    def start_stats_log(self, interval: float) -> None:
+        """
+        启动后台线程，定期把统计摘要写入日志
+
+        Args:
+            interval: 写日志的间隔（秒）
+        """
+        def run() -> None:
+            while True:
+                time.sleep(interval)
+                try:
+                    logger.info(self.format_stats())
+                except Exception as e:
+                    logger.warning(f"记录后端统计信息失败: {e}")
+
+        threading.Thread(
+            target=run, name="backend-pool-stats", daemon=True).start()
+
+
+# 每个进程内共享的后端池
+_pool: Optional[BackendPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> BackendPool:
+    """
+    获取配置中所有后端组成的共享后端池
+
+    Returns:
+        BackendPool对象
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = BackendPool(get_backend_urls())
+            # 每个服务进程定期记录熔断、亲和和缓存统计，0表示不记录
+            interval = Config.get("comfyui_server.stats_log_interval", 300)
+            if interval > 0:
+                _pool.start_stats_log(interval)
+        return _pool
@@ -0,0 +1,146 @@
+"""
+熔断器 - 后端连续失败后快速失败，冷却后放行探测请求恢复
+"""
+
+import time
+import threading
+from typing import Dict, Any
+
+from comfyui_gradio.utils.logger import setup_logger
+
+# 设置日志
+logger = setup_logger("comfyui-client-logs")
+
+# 熔断器状态
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """后端处于熔断状态，请求没有发送"""
+
+
+class CircuitBreaker:
+    """
+    单个后端的熔断器
+
+    连续失败failure_threshold次后打开，打开期间请求不再发送、立即失败，
+    负载均衡也不再分配到该后端。经过reset_seconds后进入半开状态，只放行
+    一个探测请求：成功则关闭，失败则重新打开。
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 3,
+                 reset_seconds: float = 30):
+        """
+        初始化熔断器
+
+        Args:
+            name: 后端名称，用于日志
+            failure_threshold: 连续失败多少次后打开
+            reset_seconds: 打开后多久放行探测请求（秒）
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        # 半开状态下是否已有探测请求在进行
+        self._probing = False
+        self._lock = threading.Lock()
+        # 统计：打开次数和因熔断快速失败的请求数
+        self.opened = 0
+        self.rejected = 0
+
+    def _current_state(self) -> str:
+        """当前状态，调用方需持有锁"""
+        if (self._state == OPEN
+                and time.time() - self._opened_at >= self.reset_seconds):
+            return HALF_OPEN
+        return self._state
+
+    @property
+    def state(self) -> str:
+        """熔断器状态：closed、open或half_open"""
+        with self._lock:
+            return self._current_state()
+
+    @property
+    def available(self) -> bool:
+        """是否可以分配新请求：已关闭，或半开且没有探测请求在进行"""
+        with self._lock:
+            state = self._current_state()
+            return state == CLOSED or (
+                state == HALF_OPEN and not self._probing)
+
+    @property
+    def retry_after(self) -> float:
+        """距离放行探测请求还有多少秒"""
+        with self._lock:
+            if self._state != OPEN:
+                return 0.0
+            return max(
+                self._opened_at + self.reset_seconds - time.time(), 0.0)
+
+    def allow(self) -> bool:
+        """
+        请求是否可以发送，半开状态下只放行一个探测请求
+
+        Returns:
+            是否可以发送
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probing:
+                self._state = HALF_OPEN
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self) -> None:
+        """记录一次成功，半开状态下关闭熔断器"""
+        with self._lock:
+            if self._state != CLOSED:
+                logger.info(f"ComfyUI后端已恢复，关闭熔断: {self.name}")
+            self._state = CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self) -> None:
+        """记录一次失败，连续失败达到阈值或探测失败时打开熔断器"""
+        with self._lock:
+            self._failures += 1
+            if self._state == OPEN:
+                return
+            if (self._state == HALF_OPEN
+                    or self._failures >= self.failure_threshold):
+                logger.warning(
+                    f"ComfyUI后端连续失败{self._failures}次，熔断"
+                    f"{self.reset_seconds}秒: {self.name}")
+                self._state = OPEN
+                self._opened_at = time.time()
+                self._probing = False
+                self.opened += 1
+
+    def record_aborted(self) -> None:
+        """请求被取消、没有结果时调用，允许放行新的探测请求"""
+        with self._lock:
+            self._probing = False
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取熔断器统计信息"""
+        with self._lock:
+            state = self._current_state()
+            return {
+                "state": state,
+                "consecutive_failures": self._failures,
+                "retry_after": (
+                    max(self._opened_at + self.reset_seconds - time.time(), 0.0)
+                    if state == OPEN else 0.0),
+                "opened": self.opened,
+                "rejected": self.rejected
+            }
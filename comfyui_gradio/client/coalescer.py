@@ -0,0 +1,239 @@
+"""
+请求合并 - 相同请求仍在执行时不再重复提交，所有等待方共享同一个结果
+"""
+
+import json
+import asyncio
+import hashlib
+import threading
+from typing import Dict, Any, Optional, Callable, Awaitable, TypeVar
+
+from comfyui_gradio.client.status import RequestStatus
+from comfyui_gradio.utils.logger import setup_logger
+
+# 设置日志
+logger = setup_logger("comfyui-client-logs")
+
+T = TypeVar("T")
+
+
+class _Job:
+    """一个已提交或正在提交的prompt，相同请求共享同一个_Job"""
+
+    def __init__(self, key: Optional[str], request_id: str,
+                 loop: asyncio.AbstractEventLoop,
+                 status: Optional[RequestStatus] = None):
+        self.key = key
+        # 实际提交该prompt的请求ID，即SaveImage节点的filename_prefix
+        self.request_id = request_id
+        self.submitted = loop.create_future()
+        self.prompt_id: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        # 提交该prompt的请求的状态，合并请求的状态随之更新
+        self.status = status
+        # 尚未取走结果的请求数
+        self.waiters = 1
+        # 已得到prompt_id但尚未开始等待结果的请求，值为其所在的任务
+        self.pending: Dict[str, asyncio.Task] = {}
+        # 合并请求的状态，键为请求ID
+        self.followers: Dict[str, RequestStatus] = {}
+
+
+class Coalescer:
+    """
+    在执行中的相同请求之间合并提交和结果
+
+    第一个请求负责提交，相同key的后续请求直接得到同一个prompt_id；
+    等待结果时第一个调用方创建等待任务，其余调用方共享该任务的结果，
+    最后一个取走结果的请求清理记录。所有等待方都放弃等待时取消等待任务。
+    得到prompt_id后没有等待结果就结束（出错或被取消）的请求，在其任务
+    结束时离开。
+    """
+
+    def __init__(self):
+        # 键为请求指纹，只包含仍在执行中的prompt
+        self._inflight: Dict[str, _Job] = {}
+        # 键为prompt_id
+        self._jobs: Dict[str, _Job] = {}
+        self._lock = threading.Lock()
+        self.merged = 0
+
+    async def submit(self, key: Optional[str], request_id: str,
+                     submit_fn: Callable[[], Awaitable[str]],
+                     status: Optional[RequestStatus] = None) -> str:
+        """
+        提交请求，相同key的请求仍在执行时直接返回其prompt_id
+
+        Args:
+            key: 请求指纹，为None时不参与合并
+            request_id: 请求ID
+            submit_fn: 实际提交的协程函数，返回prompt_id
+            status: 请求状态，合并时接收提交方的排队位置和执行进度
+
+        Returns:
+            prompt_id
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            job = self._inflight.get(key) if key is not None else None
+            if job is not None:
+                job.waiters += 1
+                self.merged += 1
+                if status is not None and job.status is not None:
+                    job.followers[request_id] = status
+            else:
+                leader = _Job(key, request_id, loop, status)
+                if key is not None:
+                    self._inflight[key] = leader
+
+        if job is not None:
+            logger.info(
+                f"合并相同请求 [请求ID: {request_id}, "
+                f"合并到: {job.request_id}]")
+            if request_id in job.followers:
+                job.status.attach(status)
+            self._hold(job, request_id)
+            try:
+                return await asyncio.shield(job.submitted)
+            except BaseException:
+                self._leave(job, request_id)
+                raise
+
+        self._hold(leader, request_id)
+        try:
+            prompt_id = await submit_fn()
+        except BaseException as e:
+            with self._lock:
+                leader.pending.pop(request_id, None)
+                if key is not None:
+                    self._inflight.pop(key, None)
+            if isinstance(e, asyncio.CancelledError):
+                e = RuntimeError(f"合并的请求已取消 [请求ID: {request_id}]")
+            leader.submitted.set_exception(e)
+            # 没有合并请求时避免未取回异常的警告
+            leader.submitted.exception()
+            raise
+
+        leader.prompt_id = prompt_id
+        with self._lock:
+            self._jobs[prompt_id] = leader
+        leader.submitted.set_result(prompt_id)
+        return prompt_id
+
+    async def wait(self, prompt_id: str, request_id: str,
+                   wait_fn: Callable[[str], Awaitable[T]]) -> T:
+        """
+        等待prompt的结果，同一prompt的所有等待方共享一次等待
+
+        Args:
+            prompt_id: prompt_id
+            request_id: 调用方的请求ID，prompt不是经由submit()提交时使用
+            wait_fn: 实际等待结果的协程函数，参数为提交该prompt的请求ID
+
+        Returns:
+            wait_fn的结果
+        """
+        with self._lock:
+            job = self._jobs.get(prompt_id)
+            if job is not None:
+                job.pending.pop(request_id, None)
+                if job.task is None:
+                    job.task = asyncio.ensure_future(
+                        wait_fn(job.request_id))
+        if job is None:
+            return await wait_fn(request_id)
+
+        try:
+            return await asyncio.shield(job.task)
+        finally:
+            self._leave(job, request_id)
+
+    def _hold(self, job: _Job, request_id: str) -> None:
+        """记录请求所在的任务，任务结束前没有等待结果时离开"""
+        task = asyncio.current_task()
+        if task is None:
+            return
+        with self._lock:
+            job.pending[request_id] = task
+        task.add_done_callback(
+            lambda finished: self._release(job, request_id, finished))
+
+    def _release(self, job: _Job, request_id: str,
+                 task: asyncio.Task) -> None:
+        """请求所在的任务已结束，仍未开始等待结果时离开"""
+        with self._lock:
+            if job.pending.get(request_id) is not task:
+                return
+        logger.debug(f"请求未等待结果即结束，离开合并记录 [请求ID: {request_id}]")
+        self._leave(job, request_id)
+
+    def _leave(self, job: _Job, request_id: str) -> None:
+        """一个请求取走结果或放弃等待，最后一个离开时清理记录"""
+        with self._lock:
+            job.pending.pop(request_id, None)
+            follower = job.followers.pop(request_id, None)
+            job.waiters -= 1
+            last = job.waiters <= 0
+            if last:
+                if (job.key is not None
+                        and self._inflight.get(job.key) is job):
+                    del self._inflight[job.key]
+                if job.prompt_id is not None:
+                    self._jobs.pop(job.prompt_id, None)
+        if follower is not None:
+            job.status.detach(follower)
+        # 没有请求再等待结果时停止等待，由等待任务取消后端上的prompt
+        if last and job.task is not None and not job.task.done():
+            job.task.cancel()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取合并统计信息"""
+        with self._lock:
+            return {"inflight": len(self._inflight), "merged": self.merged}
+
+
+class _UnknownInput(Exception):
+    """工作流引用了内容未知的输入文件"""
+
+
+def fingerprint(workflow_name: Optional[str], workflow: Dict[str, Any],
+                request_id: str,
+                input_digests: Dict[str, str]) -> Optional[str]:
+    """
+    计算请求指纹
+
+    输入图片路径替换为图片内容摘要，等于请求ID的值（SaveImage的文件名前缀）
+    忽略，因此只有工作流、参数和输入图片内容都相同的请求指纹才相同。
+    其他包含请求ID的字符串可能是内容未知的输入文件，此时不参与合并。
+
+    Args:
+        workflow_name: 工作流名称
+        workflow: 已填入参数的工作流
+        request_id: 请求ID
+        input_digests: 输入图片路径到内容摘要的映射
+
+    Returns:
+        十六进制的SHA-256指纹，无法确定输入内容时返回None
+    """
+    def normalize(value: Any) -> Any:
+        if isinstance(value, str):
+            if value in input_digests:
+                return f"sha256:{input_digests[value]}"
+            if value == request_id:
+                return ""
+            if request_id in value:
+                raise _UnknownInput(value)
+            return value
+        if isinstance(value, dict):
+            return {k: normalize(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [normalize(v) for v in value]
+        return value
+
+    try:
+        normalized = normalize(workflow)
+    except _UnknownInput:
+        return None
+    payload = json.dumps(
+        [workflow_name, normalized], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
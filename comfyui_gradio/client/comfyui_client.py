@@ -0,0 +1,1398 @@
+"""
+ComfyUI客户端 - 基于连接池的异步ComfyUI HTTP访问
+"""
+
+import io
+import time
+import random
+import hashlib
+import uuid
+import asyncio
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+
+import httpx
+from PIL import Image
+
+from comfyui_gradio.config import Config
+from comfyui_gradio.utils.logger import setup_logger
+from comfyui_gradio.client.metrics import ClientMetrics
+from comfyui_gradio.client.circuit_breaker import (
+    CircuitBreaker, CircuitOpenError
+)
+from comfyui_gradio.client.dispatcher import Dispatcher, QueueFullError
+from comfyui_gradio.client.status import RequestStatus
+from comfyui_gradio.client.priority import (
+    PRIORITY_INTERACTIVE, PRIORITY_NORMAL
+)
+from comfyui_gradio.client.coalescer import Coalescer, fingerprint
+from comfyui_gradio.client.eta import get_latency_model, format_seconds
+from comfyui_gradio.client.result_cache import (
+    get_result_cache, is_deterministic
+)
+from comfyui_gradio.client.ws_listener import (
+    ExecutionListener, PromptState, WS_OUTPUT_NODE_PREFIX
+)
+
+# 设置日志
+logger = setup_logger("comfyui-client-logs")
+
+# 记录内容摘要的输入图片数量上限
+INPUT_DIGEST_LIMIT = 1024
+
+# api上传模式下保留的待提交输入图片数量上限，转移到其他后端时重新上传
+UPLOAD_RETAIN_LIMIT = 32
+
+# 命中结果缓存时返回的占位prompt_id前缀
+CACHED_PROMPT_PREFIX = "cache-"
+
+# 等待结果期间确认prompt仍在后端的间隔（秒）
+PROMPT_CHECK_INTERVAL = 10
+
+# prompt连续多少次既不在队列中也没有执行记录时判定为已丢失
+PROMPT_MISSING_CHECKS = 2
+
+
+class ExecutionError(RuntimeError):
+    """ComfyUI执行工作流出错、被中断或prompt已丢失"""
+
+
+class _Submission:
+    """一个已提交到后端的工作流，被抢占后使用新的prompt_id重新提交"""
+
+    def __init__(self, workflow: Dict[str, Any], request_id: str,
+                 workflow_name: Optional[str], priority: int,
+                 status: Optional[RequestStatus],
+                 cache_key: Optional[str]):
+        self.workflow = workflow
+        self.request_id = request_id
+        self.workflow_name = workflow_name
+        self.group = get_model_group(workflow_name)
+        self.priority = priority
+        self.status = status
+        # 执行成功后写入结果缓存使用的键
+        self.cache_key = cache_key
+        # 预计占用的显存（MB）
+        self.vram_cost = 0.0
+        # 输入图片中最大一张的百万像素数和预计执行耗时（秒），0表示未知
+        self.megapixels = 0.0
+        self.estimate = 0.0
+        # 实际执行耗时（秒），收到开始和完成事件后记录
+        self.run_time: Optional[float] = None
+        # 是否使用websocket输出节点提交
+        self.websocket_output = False
+        # 是否持有调度许可
+        self.dispatched = False
+        # 是否已被高优先级请求抢占、从后端队列中撤回
+        self.preempted = False
+        # 首次排队的时间，被抢占后按该时间重新排队
+        self.enqueued_at: Optional[float] = None
+
+
+class _Preempted(Exception):
+    """prompt已被撤回，需要重新提交"""
+
+
+class ComfyUIClient:
+    """单个ComfyUI后端的客户端，复用长连接"""
+
+    def __init__(self, url: Optional[str] = None):
+        """
+        初始化客户端
+
+        Args:
+            url: ComfyUI地址，默认为配置中的第一个后端
+        """
+        self.base_url = self._normalize_base_url(url or get_backend_urls()[0])
+
+        # 连接池大小与超时配置
+        self.pool_size = Config.get("comfyui_server.pool_size", 10)
+        self.connect_timeout = Config.get("comfyui_server.connect_timeout", 5)
+        # 单次HTTP请求的读取超时，与工作流的执行期限(deadline)分开配置
+        self.read_timeout = Config.get("comfyui_server.read_timeout", 30)
+
+        # 异步HTTP连接池，按事件循环懒创建
+        self._http: Optional[httpx.AsyncClient] = None
+        self._http_loop: Optional[asyncio.AbstractEventLoop] = None
+
+        # 结果获取方式：filesystem读取共享输出目录，api通过/history和/view获取，
+        # websocket把SaveImage替换为SaveImageWebsocket，结果不落盘直接推送
+        self.result_mode = Config.get("comfyui_server.result_mode", "filesystem")
+        # 输入上传方式：filesystem写入共享输入目录，api通过/upload/image上传
+        self.upload_mode = Config.get("comfyui_server.upload_mode", "filesystem")
+
+        self.metrics = ClientMetrics()
+
+        # 提交遇到暂时性故障（连接重置、5xx）时按指数退避加随机抖动重试，
+        # 所有重试的等待时间不超过budget_seconds
+        self.retry_attempts = Config.get(
+            "comfyui_server.retry.max_attempts", 3)
+        self.retry_base_delay = Config.get(
+            "comfyui_server.retry.base_delay", 0.5)
+        self.retry_max_delay = Config.get("comfyui_server.retry.max_delay", 5)
+        self.retry_budget = Config.get(
+            "comfyui_server.retry.budget_seconds", 15)
+        self.retries = 0
+        # 所属的后端池，重试仍失败时转移到池中的其他后端
+        self.pool = None
+        self.failovers = 0
+        # api上传模式下尚未提交的输入图片，键为上传后的路径
+        self._uploads: "OrderedDict[str, tuple]" = OrderedDict()
+        # 转移到其他后端提交的prompt，等待结果时交给该后端
+        self._redirects: Dict[str, "ComfyUIClient"] = {}
+
+        # 熔断器：连续失败达到阈值后请求立即失败，也不参与负载均衡
+        self.breaker = CircuitBreaker(
+            self.base_url,
+            failure_threshold=Config.get(
+                "comfyui_server.circuit_breaker.failure_threshold",
+                Config.get("comfyui_server.eject_after_failures", 3)),
+            reset_seconds=Config.get(
+                "comfyui_server.circuit_breaker.reset_seconds",
+                Config.get("comfyui_server.eject_seconds", 30)))
+
+        # 本进程提交的工作流都使用同一个client_id，执行事件由共享监听线程接收
+        self.client_id = uuid.uuid4().hex
+        self.listener = ExecutionListener(self.base_url, self.client_id)
+        # 经调度提交、尚未取走结果的prompt
+        self._submissions: Dict[str, _Submission] = {}
+        self._prompts_lock = threading.Lock()
+
+        # 合并执行中的相同请求，需要记录输入图片的内容摘要
+        self.coalesce = Config.get("comfyui_server.coalesce", True)
+        self.coalescer = Coalescer()
+        self._input_digests: "OrderedDict[str, str]" = OrderedDict()
+        # 输入图片路径对应的百万像素数，用于预测执行耗时
+        self._input_sizes: "OrderedDict[str, float]" = OrderedDict()
+
+        # 执行耗时模型：显示预计等待时间，预计无法在执行期限内完成的请求
+        # 直接拒绝
+        self.latency = get_latency_model()
+        self.eta_shed = Config.get("eta.shed", True)
+
+        # 磁盘结果缓存：命中时不提交，结果直接从缓存读取
+        self.result_cache = get_result_cache()
+        # 命中缓存的请求使用的占位prompt_id到结果的映射
+        self._cached_results: Dict[str, Image.Image] = {}
+
+        # 提交调度：限制同时留在后端队列中的prompt数量，按模型组重新排序
+        self.dispatcher = Dispatcher(
+            max_outstanding=Config.get(
+                "comfyui_server.dispatch.max_outstanding", 2),
+            reorder_window=Config.get(
+                "comfyui_server.dispatch.reorder_window", 8),
+            max_hold_seconds=Config.get(
+                "comfyui_server.dispatch.max_hold_seconds", 30),
+            max_queued=Config.get("comfyui_server.dispatch.max_queued", 20),
+            vram_reserve_mb=Config.get("comfyui_server.vram.reserve_mb", 1024),
+            vram_max_hold_seconds=Config.get(
+                "comfyui_server.vram.max_hold_seconds", 120),
+            fair_share=Config.get("fair_share.enabled", True))
+        # 按显存调度：各工作流预计占用的显存（MB），通过/system_stats读取空闲显存
+        self.vram_costs: Dict[str, float] = (
+            Config.get("comfyui_server.vram.costs_mb") or {}
+            if Config.get("comfyui_server.vram.enabled", True) else {})
+        self.vram_poll_interval = Config.get(
+            "comfyui_server.vram.poll_interval", 2.0)
+        self._vram_fetched_at = 0.0
+        self._vram_poller: Optional[asyncio.Future] = None
+        # 高优先级请求排队时，把尚未开始执行的低优先级prompt撤回客户端
+        self.preempt = Config.get("comfyui_server.dispatch.preempt", True)
+        self.preempted = 0
+        # 按优先级排到其他进程提交的低优先级prompt之前的次数
+        self.queue_jumps = 0
+        # 被取消的请求数（浏览器断开或用户取消）
+        self.cancelled = 0
+        # 后台执行的抢占和取消任务，保留引用避免被回收
+        self._background_tasks = set()
+
+    @staticmethod
+    def _normalize_base_url(url: str) -> str:
+        """去掉末尾的/prompt，兼容旧配置中的完整接口地址"""
+        url = url.rstrip("/")
+        if url.endswith("/prompt"):
+            url = url[:-len("/prompt")]
+        return url
+
+    def _get_http(self) -> httpx.AsyncClient:
+        """获取当前事件循环上的连接池，复用TCP连接"""
+        loop = asyncio.get_running_loop()
+        if self._http is None or self._http_loop is not loop:
+            self._http = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(
+                    self.read_timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size))
+            self._http_loop = loop
+        return self._http
+
+    async def _request(self, method: str, path: str, name: str,
+                       count_failure: bool = True,
+                       **kwargs) -> httpx.Response:
+        """
+        发送请求并记录指标
+
+        Args:
+            method: HTTP方法
+            path: 接口路径，如"/prompt"
+            name: 指标中使用的接口名称
+            count_failure: 失败是否计入熔断器，为False时由调用方自行计入
+            **kwargs: 传给httpx的其他参数
+
+        Returns:
+            响应对象
+
+        Raises:
+            httpx.HTTPError: 请求失败
+            CircuitOpenError: 后端处于熔断状态，请求没有发送
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError(
+                f"ComfyUI后端暂时不可用，"
+                f"{self.breaker.retry_after:.0f}秒后重试: {self.base_url}")
+
+        start_time = time.time()
+        try:
+            response = await self._get_http().request(method, path, **kwargs)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            self.metrics.record(name, time.time() - start_time, success=False)
+            # 4xx表示请求本身有误（如工作流校验失败），后端本身是正常的
+            if _is_client_error(e):
+                self.breaker.record_success()
+            elif count_failure:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_aborted()
+            raise
+        except BaseException:
+            self.breaker.record_aborted()
+            raise
+        self.metrics.record(name, time.time() - start_time)
+        self.breaker.record_success()
+        return response
+
+    async def get_queue_depth(self) -> int:
+        """
+        获取后端队列中正在执行和等待执行的prompt数量
+
+        Returns:
+            队列深度
+        """
+        response = await self._request("GET", "/queue", "queue")
+        queue = response.json()
+        return (len(queue.get("queue_running", []))
+                + len(queue.get("queue_pending", [])))
+
+    async def submit(self, workflow: Dict[str, Any], request_id: str,
+                     workflow_name: Optional[str] = None,
+                     status: Optional[RequestStatus] = None,
+                     failover: bool = True) -> str:
+        """
+        提交工作流到ComfyUI
+
+        提交前需要取得调度许可，许可在wait_for_image()结束时归还，
+        因此提交成功后必须调用wait_for_image()。与仍在执行中的请求完全
+        相同（工作流、参数和输入图片内容一致）时不再重复提交，直接返回
+        该请求的prompt_id；结果缓存命中时也不提交，返回占位的prompt_id。
+        尚未开始执行的prompt可能被高优先级请求抢占，此时由wait_for_image()
+        重新提交，返回的prompt_id仍可用于等待结果。暂时性故障重试后仍失败
+        且属于后端池时，转移到池中的其他后端提交。
+
+        Args:
+            workflow: API格式的工作流
+            request_id: 请求ID，用于日志
+            workflow_name: 工作流名称，调度时把同一模型组的请求排在一起
+            status: 请求状态，排队期间更新排队位置，并提供请求优先级
+            failover: 是否允许转移到其他后端
+
+        Returns:
+            ComfyUI返回的prompt_id
+
+        Raises:
+            QueueFullError: 排队请求已达上限
+        """
+        # 在提交前启动监听，避免错过执行事件
+        self.listener.start()
+
+        key = None
+        if self.coalesce or self.result_cache is not None:
+            with self._prompts_lock:
+                input_digests = dict(self._input_digests)
+            key = fingerprint(
+                workflow_name, workflow, request_id, input_digests)
+
+        cache_key = None
+        if (self.result_cache is not None and key is not None
+                and is_deterministic(workflow)):
+            cache_key = key
+            content = await asyncio.to_thread(self.result_cache.get, key)
+            if content is not None:
+                output_image = await asyncio.to_thread(
+                    self._decode_image, content)
+                prompt_id = f"{CACHED_PROMPT_PREFIX}{request_id}"
+                with self._prompts_lock:
+                    self._cached_results[prompt_id] = output_image
+                # 调用方出错或被取消、没有取走结果时，在其任务结束后丢弃
+                task = asyncio.current_task()
+                if task is not None:
+                    task.add_done_callback(
+                        lambda _: self._discard_cached(prompt_id))
+                logger.info(f"命中结果缓存 [请求ID: {request_id}]")
+                return prompt_id
+
+        submission = _Submission(
+            workflow, request_id, workflow_name,
+            status.priority if status is not None else PRIORITY_NORMAL,
+            status, cache_key)
+        submission.vram_cost = self.vram_costs.get(workflow_name, 0)
+        if self.latency is not None:
+            submission.megapixels = self._input_megapixels(workflow)
+            submission.estimate = self.latency.estimate(
+                workflow_name, submission.megapixels) or 0.0
+        try:
+            prompt_id = await self.coalescer.submit(
+                key if self.coalesce else None, request_id,
+                lambda: self._dispatch(submission), status)
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            if not (failover and self.pool is not None and (
+                    isinstance(e, CircuitOpenError) or _is_transient(e))):
+                raise
+            prompt_id = await self._failover(
+                workflow, request_id, workflow_name, status, e)
+        self._forget_uploads(workflow)
+        if status is not None:
+            status.update(_submitted_message(submission.estimate))
+        return prompt_id
+
+    def _discard_cached(self, prompt_id: str) -> None:
+        """丢弃没有被取走的缓存结果"""
+        with self._prompts_lock:
+            self._cached_results.pop(prompt_id, None)
+
+    async def _failover(self, workflow: Dict[str, Any], request_id: str,
+                        workflow_name: Optional[str],
+                        status: Optional[RequestStatus],
+                        error: httpx.HTTPError) -> str:
+        """本后端提交失败时转移到池中的其他后端，没有可用后端时抛出原异常"""
+        priority = status.priority if status is not None else PRIORITY_NORMAL
+        try:
+            other = await self.pool.select(
+                workflow_name, priority, exclude=self)
+        except QueueFullError:
+            raise error
+        logger.warning(
+            f"ComfyUI后端提交失败，转移到{other.base_url} "
+            f"[请求ID: {request_id}]: {error}")
+
+        # 各后端不共享磁盘时，把输入图片重新上传到新的后端
+        with self._prompts_lock:
+            uploads = dict(self._uploads)
+        mapping = {}
+        for node in workflow.values():
+            for value in node.get("inputs", {}).values():
+                if isinstance(value, str) and value in uploads \
+                        and value not in mapping:
+                    mapping[value] = await other.upload_image(*uploads[value])
+        if mapping:
+            workflow = {
+                node_id: dict(node, inputs={
+                    name: mapping.get(value, value)
+                    if isinstance(value, str) else value
+                    for name, value in node.get("inputs", {}).items()})
+                for node_id, node in workflow.items()}
+
+        prompt_id = await other.submit(
+            workflow, request_id, workflow_name, status, failover=False)
+        with self._prompts_lock:
+            self._redirects[prompt_id] = other
+        self.failovers += 1
+        return prompt_id
+
+    async def _dispatch(self, submission: _Submission) -> str:
+        """取得调度许可后提交，返回prompt_id"""
+        requeued_at = submission.enqueued_at
+        if requeued_at is None:
+            submission.enqueued_at = time.time()
+        if submission.vram_cost > 0:
+            await self._refresh_vram()
+        max_wait = None
+        if self.eta_shed and submission.estimate > 0:
+            # 排队加执行超过执行期限的请求注定超时，不必排队
+            max_wait = (get_deadline(submission.workflow_name)
+                        - submission.estimate)
+        await self.dispatcher.acquire(
+            submission.group, submission.status, submission.priority,
+            on_wait=self._on_wait, enqueued_at=requeued_at,
+            cost=submission.vram_cost,
+            caller=(submission.status.caller
+                    if submission.status is not None else None),
+            estimate=submission.estimate, max_wait=max_wait)
+        prompt_id = str(uuid.uuid4())
+        try:
+            prompt_id, websocket_output = await self._submit(
+                submission.workflow, submission.request_id,
+                submission.priority, prompt_id)
+        except asyncio.CancelledError:
+            # 提交请求可能已被ComfyUI接收，按生成的prompt_id删除或中断，
+            # 停止后再归还许可
+            self._spawn(self._abandon(prompt_id, submission.estimate))
+            raise
+        except BaseException:
+            self.dispatcher.release(submission.estimate)
+            raise
+        submission.websocket_output = websocket_output
+        submission.dispatched = True
+        submission.preempted = False
+        with self._prompts_lock:
+            self._submissions[prompt_id] = submission
+        return prompt_id
+
+    async def _abandon(self, prompt_id: str, estimate: float) -> None:
+        """停止提交过程中被取消的prompt并归还调度许可"""
+        try:
+            await self.cancel(prompt_id)
+        finally:
+            self.dispatcher.release(estimate)
+
+    async def _submit(self, workflow: Dict[str, Any], request_id: str,
+                      priority: int = PRIORITY_NORMAL,
+                      prompt_id: Optional[str] = None) -> Tuple[str, bool]:
+        """
+        发送工作流到/prompt接口，返回prompt_id和是否使用websocket输出
+
+        prompt_id由调用方或在此生成，重试使用同一个prompt_id。连接在请求
+        发出后断开时，先确认上一次提交是否已被接收，避免同一请求被执行两次。
+
+        优先级写入extra_data，独立进程运行的各服务共用后端队列时，
+        交互请求按该值排到其他进程提交的低优先级prompt之前；为此每次
+        提交多读取一次/queue，因此只对交互请求这样做。
+        """
+
+        # 事件通道未连接时无法接收推送的结果，退回到SaveImage落盘
+        websocket_output = (
+            self.result_mode == "websocket" and self.listener.connected)
+        if websocket_output:
+            workflow = self.use_websocket_output(workflow)
+
+        prompt_id = prompt_id or str(uuid.uuid4())
+        payload = {
+            "prompt": workflow,
+            "client_id": self.client_id,
+            "prompt_id": prompt_id,
+            "extra_data": {"priority": priority}
+        }
+        if self.preempt and priority <= PRIORITY_INTERACTIVE:
+            number = await self._queue_number(priority)
+            if number is not None:
+                payload["number"] = number
+        start_time = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = await self._request(
+                    "POST", "/prompt", "prompt", count_failure=False,
+                    json=payload)
+                prompt_id = response.json().get("prompt_id", prompt_id)
+                break
+            except httpx.HTTPError as e:
+                delay = self._backoff(attempt)
+                if (not _is_transient(e) or attempt >= self.retry_attempts
+                        or time.time() - start_time + delay
+                        > self.retry_budget):
+                    if not _is_client_error(e):
+                        # 每次提交无论重试几次只计一次失败，
+                        # 单个请求的重试不会触发熔断
+                        self.breaker.record_failure()
+                    if attempt > 1:
+                        self.metrics.record(
+                            "prompt_retry", time.time() - start_time,
+                            success=False)
+                    raise
+                self.retries += 1
+                logger.warning(
+                    f"提交失败，{delay:.1f}秒后第{attempt}次重试 "
+                    f"[请求ID: {request_id}]: {e}")
+                await asyncio.sleep(delay)
+                if not isinstance(e, (httpx.ConnectError,
+                                      httpx.ConnectTimeout)) \
+                        and await self._prompt_exists(prompt_id):
+                    logger.info(
+                        f"上一次提交已被接收，不再重复提交 [请求ID: {request_id}]")
+                    break
+
+        if attempt > 1:
+            # 重试带来的额外延迟单独统计，不混入正常提交的耗时
+            self.metrics.record("prompt_retry", time.time() - start_time)
+        if "number" in payload:
+            # ComfyUI接收后才算插队成功
+            self.queue_jumps += 1
+        logger.debug(f"工作流已提交 [请求ID: {request_id}, prompt_id: {prompt_id}]")
+        return prompt_id, websocket_output
+
+    async def _queue_number(self, priority: int) -> Optional[float]:
+        """
+        计算插队位置：排在后端队列中第一个低优先级prompt之前
+
+        ComfyUI按number从小到大执行等待中的prompt。取第一个低优先级
+        prompt与其前一个prompt的number的中间值，同级及更高优先级的
+        prompt仍在前面，低优先级prompt不被删除，提交它们的进程照常
+        等待结果。没有低优先级prompt或无法读取队列时返回None，按
+        提交顺序排队。没有标注优先级的prompt视为不可插队。
+        """
+        try:
+            response = await self._request("GET", "/queue", "queue")
+            pending = sorted(
+                (item[0], _queued_priority(item))
+                for item in response.json().get("queue_pending", []))
+        except (httpx.HTTPError, CircuitOpenError, ValueError, TypeError,
+                IndexError) as e:
+            logger.debug(f"读取ComfyUI队列失败，按提交顺序排队: {e}")
+            return None
+
+        previous = None
+        for number, queued_priority in pending:
+            if queued_priority is not None and queued_priority > priority:
+                if previous is None:
+                    previous = number - 1
+                return (previous + number) / 2
+            previous = number
+        return None
+
+    def _backoff(self, attempt: int) -> float:
+        """第attempt次失败后的等待时间：指数退避上限内的随机值"""
+        ceiling = min(
+            self.retry_max_delay, self.retry_base_delay * 2 ** (attempt - 1))
+        return random.uniform(0, ceiling)
+
+    async def _prompt_exists(self, prompt_id: str) -> bool:
+        """prompt是否已在队列中或已有执行记录，失败不计入熔断器"""
+        try:
+            response = await self._request(
+                "GET", "/queue", "queue", count_failure=False)
+            if prompt_id in _queued_prompt_ids(response.json()):
+                return True
+            response = await self._request(
+                "GET", f"/history/{prompt_id}", "history",
+                count_failure=False)
+            return bool(response.json().get(prompt_id))
+        except (httpx.HTTPError, CircuitOpenError):
+            return False
+
+    def _on_wait(self, priority: int) -> None:
+        """有请求开始排队时调用：抢占低优先级prompt，并持续读取空闲显存"""
+        if self.preempt:
+            self._schedule_preempt(priority)
+        if self.vram_costs and (
+                self._vram_poller is None or self._vram_poller.done()):
+            self._vram_poller = asyncio.ensure_future(self._poll_vram())
+
+    async def get_free_vram(self) -> Optional[float]:
+        """
+        通过/system_stats读取后端的空闲显存
+
+        Returns:
+            第一个GPU的空闲显存（MB），没有GPU信息时返回None
+        """
+        response = await self._request("GET", "/system_stats", "system_stats")
+        devices = response.json().get("devices") or []
+        if not devices or "vram_free" not in devices[0]:
+            return None
+        return devices[0]["vram_free"] / (1024 * 1024)
+
+    async def _refresh_vram(self, force: bool = False) -> None:
+        """读取空闲显存并交给调度器，间隔小于poll_interval时使用上次的结果"""
+        if not force and (
+                time.time() - self._vram_fetched_at < self.vram_poll_interval):
+            return
+        self._vram_fetched_at = time.time()
+        try:
+            free_mb = await self.get_free_vram()
+        except (httpx.HTTPError, CircuitOpenError, ValueError) as e:
+            logger.debug(f"读取空闲显存失败，暂不按显存调度: {e}")
+            free_mb = None
+        self.dispatcher.update_vram(free_mb)
+
+    async def _poll_vram(self) -> None:
+        """有需要显存的请求在等待时定期读取空闲显存，放行显存已足够的请求"""
+        while self.dispatcher.vram_waiting:
+            await asyncio.sleep(self.vram_poll_interval)
+            await self._refresh_vram(force=True)
+
+    def _schedule_preempt(self, priority: int) -> None:
+        """有请求开始排队时，在后台撤回优先级更低的prompt"""
+        with self._prompts_lock:
+            if not any(submission.priority > priority
+                       and not submission.preempted
+                       for submission in self._submissions.values()):
+                return
+        self._spawn(self._preempt(priority))
+
+    def _spawn(self, coro) -> None:
+        """在后台执行协程，不受调用方取消的影响"""
+        task = asyncio.ensure_future(coro)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _preempt(self, priority: int) -> None:
+        """
+        把尚未开始执行的低优先级prompt从后端队列撤回客户端
+
+        撤回的数量不超过排队中的同级及更高优先级请求数，被撤回的请求
+        归还调度许可，由各自的等待方重新排队提交。
+
+        Args:
+            priority: 排队请求的优先级
+        """
+        try:
+            response = await self._request("GET", "/queue", "queue")
+            pending = {
+                item[1] for item in response.json().get("queue_pending", [])}
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            logger.warning(f"获取ComfyUI队列失败，跳过抢占: {e}")
+            return
+
+        with self._prompts_lock:
+            victims = [
+                (prompt_id, submission)
+                for prompt_id, submission in self._submissions.items()
+                if submission.priority > priority and submission.dispatched
+                and prompt_id in pending]
+        # 优先撤回优先级最低、最晚提交的prompt
+        victims.reverse()
+        victims.sort(key=lambda victim: victim[1].priority, reverse=True)
+        victims = victims[:self.dispatcher.waiting_ahead(priority)]
+        if not victims:
+            return
+
+        try:
+            await self._request(
+                "POST", "/queue", "queue_delete",
+                json={"delete": [prompt_id for prompt_id, _ in victims]})
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            logger.warning(f"撤回低优先级prompt失败: {e}")
+            return
+
+        # 读取队列和删除之间prompt可能已开始执行，删除对其无效；只有确认
+        # 已不在队列中、也没有执行记录的prompt才算撤回，否则会重复执行
+        try:
+            response = await self._request("GET", "/queue", "queue")
+            queued = _queued_prompt_ids(response.json())
+            withdrawn = []
+            for prompt_id, submission in victims:
+                if (prompt_id not in queued
+                        and not await self.get_history(prompt_id)):
+                    withdrawn.append((prompt_id, submission))
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            logger.warning(f"无法确认低优先级prompt已撤回，不再重新排队: {e}")
+            return
+
+        for prompt_id, submission in withdrawn:
+            # 等待方可能已经取走结果并归还了许可
+            if not submission.dispatched:
+                continue
+            submission.dispatched = False
+            submission.preempted = True
+            self.preempted += 1
+            logger.info(
+                f"低优先级请求被抢占，重新排队 "
+                f"[请求ID: {submission.request_id}, prompt_id: {prompt_id}]")
+            self.dispatcher.release(submission.estimate)
+            self.listener.wake(prompt_id)
+
+    @staticmethod
+    def use_websocket_output(workflow: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        把SaveImage节点替换为SaveImageWebsocket节点
+
+        SaveImage是末端节点，不会被其他节点引用，因此可以改用带前缀的
+        节点ID，监听线程据此识别输出帧。原工作流不会被修改。
+        """
+        rewritten = {}
+        for node_id, node in workflow.items():
+            if node.get("class_type") == "SaveImage":
+                rewritten[f"{WS_OUTPUT_NODE_PREFIX}{node_id}"] = {
+                    "class_type": "SaveImageWebsocket",
+                    "inputs": {"images": node["inputs"]["images"]}
+                }
+            else:
+                rewritten[node_id] = node
+        return rewritten
+
+    async def cancel(self, prompt_id: str) -> None:
+        """
+        取消prompt：仍在排队时从队列删除，正在执行时中断
+
+        先删除再检查是否正在执行，避免prompt在两次请求之间开始执行而漏掉。
+
+        Args:
+            prompt_id: ComfyUI返回的prompt_id
+        """
+        try:
+            await self._request(
+                "POST", "/queue", "queue_delete",
+                json={"delete": [prompt_id]})
+            response = await self._request("GET", "/queue", "queue")
+            running = {
+                item[1] for item in response.json().get("queue_running", [])}
+            if prompt_id in running:
+                # 新版ComfyUI只在该prompt正在执行时中断，不影响其他请求
+                await self._request(
+                    "POST", "/interrupt", "interrupt",
+                    json={"prompt_id": prompt_id})
+                logger.info(f"已中断正在执行的prompt: {prompt_id}")
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            logger.warning(f"取消prompt失败 [prompt_id: {prompt_id}]: {e}")
+            return
+        self.cancelled += 1
+
+    async def upload_image(self, image: Image.Image, filename: str,
+                           local_dir: Path, subfolder: str = "",
+                           overwrite: bool = True) -> str:
+        """
+        上传输入图片，返回LoadImage节点使用的图片路径
+
+        filesystem模式下保存到local_dir，api模式下把PNG字节直接上传到
+        ComfyUI的/upload/image接口，不需要共享磁盘。
+
+        Args:
+            image: 输入图片
+            filename: 文件名
+            local_dir: filesystem模式下的保存目录
+            subfolder: ComfyUI输入目录下的子目录，如"clipspace"
+            overwrite: 同名文件是否覆盖，不覆盖时ComfyUI会自动重命名
+
+        Returns:
+            相对ComfyUI输入目录的图片路径
+        """
+        digest = None
+        if self.coalesce or self.result_cache is not None:
+            digest = await asyncio.to_thread(self._digest_image, image)
+
+        if self.upload_mode != "api":
+            await asyncio.to_thread(
+                self._save_local, image, Path(local_dir), filename)
+            path = f"{subfolder}/{filename}" if subfolder else filename
+            self._remember_digest(path, digest)
+            self._remember_size(path, image)
+            return path
+
+        # PNG编码较耗CPU，放到线程中执行，避免阻塞事件循环
+        content = await asyncio.to_thread(self._encode_png, image)
+        response = await self._request(
+            "POST", "/upload/image", "upload",
+            files={"image": (filename, content, "image/png")},
+            data={
+                "subfolder": subfolder,
+                "type": "input",
+                "overwrite": "true" if overwrite else "false"
+            })
+        result = response.json()
+        name = result.get("name", filename)
+        uploaded_subfolder = result.get("subfolder", subfolder)
+        path = f"{uploaded_subfolder}/{name}" if uploaded_subfolder else name
+        self._remember_digest(path, digest)
+        self._remember_size(path, image)
+        if self.pool is not None:
+            with self._prompts_lock:
+                self._uploads[path] = (
+                    image, filename, local_dir, subfolder, overwrite)
+                while len(self._uploads) > UPLOAD_RETAIN_LIMIT:
+                    self._uploads.popitem(last=False)
+        return path
+
+    def _forget_uploads(self, workflow: Dict[str, Any]) -> None:
+        """工作流提交成功后不再保留其输入图片"""
+        with self._prompts_lock:
+            if not self._uploads:
+                return
+            for node in workflow.values():
+                for value in node.get("inputs", {}).values():
+                    if isinstance(value, str):
+                        self._uploads.pop(value, None)
+
+    def _remember_digest(self, path: str, digest: Optional[str]) -> None:
+        """记录输入图片路径对应的内容摘要，用于计算请求指纹"""
+        if digest is None:
+            return
+        with self._prompts_lock:
+            self._input_digests[path] = digest
+            self._input_digests.move_to_end(path)
+            while len(self._input_digests) > INPUT_DIGEST_LIMIT:
+                self._input_digests.popitem(last=False)
+
+    def _remember_size(self, path: str, image: Image.Image) -> None:
+        """记录输入图片路径对应的百万像素数，用于预测执行耗时"""
+        with self._prompts_lock:
+            self._input_sizes[path] = image.width * image.height / 1e6
+            self._input_sizes.move_to_end(path)
+            while len(self._input_sizes) > INPUT_DIGEST_LIMIT:
+                self._input_sizes.popitem(last=False)
+
+    def _input_megapixels(self, workflow: Dict[str, Any]) -> float:
+        """工作流引用的输入图片中最大一张的百万像素数，未知时返回0"""
+        megapixels = 0.0
+        with self._prompts_lock:
+            for node in workflow.values():
+                for value in node.get("inputs", {}).values():
+                    if isinstance(value, str) and value in self._input_sizes:
+                        megapixels = max(megapixels, self._input_sizes[value])
+        return megapixels
+
+    @staticmethod
+    def _digest_image(image: Image.Image) -> str:
+        """计算图片像素内容的摘要"""
+        sha = hashlib.sha256()
+        sha.update(f"{image.mode}:{image.size}".encode("utf-8"))
+        sha.update(image.tobytes())
+        return sha.hexdigest()
+
+    @staticmethod
+    def _save_local(image: Image.Image, local_dir: Path, filename: str) -> None:
+        """保存图片到本地目录"""
+        local_dir.mkdir(parents=True, exist_ok=True)
+        image.save(local_dir / filename)
+
+    @staticmethod
+    def _encode_png(image: Image.Image) -> bytes:
+        """把图片编码为PNG字节"""
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    @staticmethod
+    def _decode_image(content: bytes) -> Image.Image:
+        """把编码后的图片字节解码为PIL图片"""
+        with Image.open(io.BytesIO(content)) as img:
+            return img.copy()
+
+    async def get_history(self, prompt_id: str) -> Dict[str, Any]:
+        """
+        获取prompt的执行记录
+
+        Args:
+            prompt_id: ComfyUI返回的prompt_id
+
+        Returns:
+            执行记录，prompt尚未完成时为空字典
+        """
+        response = await self._request(
+            "GET", f"/history/{prompt_id}", "history")
+        return response.json().get(prompt_id, {})
+
+    async def view_image(self, filename: str, subfolder: str = "",
+                         image_type: str = "output") -> Image.Image:
+        """
+        通过/view接口把图片直接读入内存
+
+        Args:
+            filename: 文件名
+            subfolder: 子目录
+            image_type: 目录类型，output、input或temp
+
+        Returns:
+            PIL.Image对象
+        """
+        response = await self._request(
+            "GET", "/view", "view",
+            params={
+                "filename": filename,
+                "subfolder": subfolder,
+                "type": image_type
+            })
+        return await asyncio.to_thread(self._decode_image, response.content)
+
+    async def wait_for_image(self, prompt_id: str, request_id: str,
+                             output_dir: Path,
+                             max_wait: Optional[float] = None
+                             ) -> Tuple[Image.Image, str]:
+        """
+        等待工作流执行完成并读取输出图片
+
+        优先通过WebSocket执行事件得知完成时间，事件通道不可用时退回到轮询。
+        结果按result_mode从共享输出目录或ComfyUI的/history、/view接口获取。
+        ComfyUI报告执行出错，或prompt既不在队列中也没有执行记录时立即失败，
+        不必等到期限。
+
+        Args:
+            prompt_id: ComfyUI返回的prompt_id
+            request_id: 请求ID，即SaveImage节点的filename_prefix
+            output_dir: ComfyUI输出目录，仅filesystem模式使用
+            max_wait: 最长等待时间（秒），默认为该工作流配置的执行期限
+
+        Returns:
+            (输出图片, 输出文件位置)
+
+        Raises:
+            TimeoutError: 超过最长等待时间仍未得到结果
+            ExecutionError: ComfyUI执行出错、被中断或prompt已丢失
+            RuntimeError: websocket输出模式下未收到输出图片
+        """
+        with self._prompts_lock:
+            cached = self._cached_results.pop(prompt_id, None)
+            other = self._redirects.pop(prompt_id, None)
+        if cached is not None:
+            return cached, "cache"
+        if other is not None:
+            return await other.wait_for_image(
+                prompt_id, request_id, output_dir, max_wait)
+
+        # 合并的请求共享同一次等待，结果文件以实际提交的请求ID为前缀
+        return await self.coalescer.wait(
+            prompt_id, request_id,
+            lambda submitted_id: self._wait_dispatched(
+                prompt_id, submitted_id, output_dir, max_wait))
+
+    async def _wait_dispatched(self, prompt_id: str, request_id: str,
+                               output_dir: Path,
+                               max_wait: Optional[float]
+                               ) -> Tuple[Image.Image, str]:
+        """等待结果、归还调度许可并写入结果缓存，被抢占时重新提交"""
+        with self._prompts_lock:
+            submission = self._submissions.get(prompt_id)
+        if max_wait is None:
+            max_wait = get_deadline(
+                submission.workflow_name if submission is not None else None)
+        if submission is None:
+            return await self._wait_for_image(
+                prompt_id, request_id, output_dir, max_wait, None)
+
+        deadline = time.time() + max_wait
+        try:
+            while True:
+                try:
+                    result = await self._wait_for_image(
+                        prompt_id, request_id, output_dir,
+                        deadline - time.time(), submission)
+                    break
+                except _Preempted:
+                    with self._prompts_lock:
+                        self._submissions.pop(prompt_id, None)
+                    if submission.status is not None:
+                        submission.status.update("已让出位置给优先请求，重新排队中")
+                    prompt_id = await self._dispatch(submission)
+                    if submission.status is not None:
+                        submission.status.update(
+                            _submitted_message(submission.estimate))
+        except asyncio.CancelledError:
+            # 浏览器断开或用户取消，不再让放弃的请求占用GPU
+            if submission.dispatched:
+                logger.info(
+                    f"请求已取消，停止ComfyUI任务 [请求ID: {request_id}, "
+                    f"prompt_id: {prompt_id}]")
+                self._spawn(self.cancel(prompt_id))
+            raise
+        except TimeoutError:
+            # 超过执行期限后没有人再取结果，停止prompt后再归还许可，
+            # 否则后端实际执行的prompt会超过max_outstanding
+            if submission.dispatched:
+                logger.warning(
+                    f"请求超过执行期限，停止ComfyUI任务 [请求ID: {request_id}, "
+                    f"prompt_id: {prompt_id}]")
+                await self.cancel(prompt_id)
+            raise
+        finally:
+            with self._prompts_lock:
+                self._submissions.pop(prompt_id, None)
+            if submission.dispatched:
+                submission.dispatched = False
+                self.dispatcher.release(submission.estimate)
+
+        if self.latency is not None and submission.run_time is not None:
+            asyncio.get_running_loop().run_in_executor(
+                None, self.latency.observe, submission.workflow_name,
+                submission.megapixels, submission.run_time)
+        if submission.cache_key is not None:
+            # PNG编码和写盘在后台线程完成，不推迟返回结果
+            asyncio.get_running_loop().run_in_executor(
+                None, self._store_result, submission.cache_key, result[0])
+        return result
+
+    def _store_result(self, cache_key: str, image: Image.Image) -> None:
+        """把结果写入缓存"""
+        self.result_cache.put(cache_key, self._encode_png(image))
+
+    async def _wait_for_image(self, prompt_id: str, request_id: str,
+                              output_dir: Path, max_wait: float,
+                              submission: Optional[_Submission]
+                              ) -> Tuple[Image.Image, str]:
+        """
+        等待执行完成事件并获取结果，事件通道不可用时改为轮询
+
+        Raises:
+            _Preempted: prompt已被撤回，需要重新提交
+        """
+        deadline = time.time() + max_wait
+        websocket_output = (
+            submission is not None and submission.websocket_output)
+        missing = 0
+        if submission is not None and submission.status is not None:
+            # 把执行中的节点和步数推送到状态栏
+            self.listener.watch(
+                prompt_id,
+                lambda state: self._report_progress(submission, state))
+
+        try:
+            while True:
+                state = await self.listener.wait(
+                    prompt_id,
+                    min(max(deadline - time.time(), 0), PROMPT_CHECK_INTERVAL))
+                if submission is not None and submission.preempted:
+                    raise _Preempted(prompt_id)
+                if state.error is not None:
+                    raise ExecutionError(_describe_error(state.error, request_id))
+                if (submission is not None and state.started_at is not None
+                        and (state.finished or state.images)):
+                    submission.run_time = (
+                        (state.finished_at or time.time()) - state.started_at)
+                if state.images:
+                    output_image = await asyncio.to_thread(
+                        self._decode_image, state.images[-1])
+                    return output_image, "websocket"
+                if (state.finished or state.notified
+                        or not self.listener.connected
+                        or time.time() >= deadline):
+                    break
+                # 事件通道正常但尚未完成，确认prompt没有丢失
+                missing = await self._check_prompt(
+                    prompt_id, request_id, submission, missing)
+
+            if websocket_output:
+                if not state.finished and time.time() >= deadline:
+                    raise TimeoutError(f"等待处理结果超时 [请求ID: {request_id}]")
+                # 输出节点不落盘，事件通道断开后结果无法再获取
+                raise RuntimeError(
+                    f"未收到websocket输出图片 [请求ID: {request_id}]")
+            if state.finished:
+                result = await self._fetch_result(
+                    prompt_id, request_id, output_dir)
+                if result is not None:
+                    return result
+                logger.warning(
+                    f"已收到完成事件但未找到输出图片，改为轮询 [请求ID: {request_id}]")
+        finally:
+            self.listener.discard(prompt_id)
+
+        return await self._poll_result(
+            prompt_id, request_id, output_dir, deadline - time.time(),
+            submission)
+
+    def _report_progress(self, submission: _Submission,
+                         state: PromptState) -> None:
+        """把执行进度和预览图更新到请求状态"""
+        if submission.preempted:
+            return
+        preview = state.take_preview()
+        if preview is not None and submission.status.previews:
+            # 解码在线程中进行，不阻塞事件循环
+            self._spawn(self._report_preview(submission, preview))
+        if state.node is None:
+            return
+        node = submission.workflow.get(state.node) or {}
+        title = (node.get("_meta", {}).get("title")
+                 or node.get("class_type") or state.node)
+        message = f"正在执行节点: {title}"
+        if state.step is not None and state.step[1] > 0:
+            message += f"，第{state.step[0]}/{state.step[1]}步"
+        submission.status.update(message, state.step)
+
+    async def _report_preview(self, submission: _Submission,
+                              content: bytes) -> None:
+        """解码预览图并更新到请求状态"""
+        try:
+            image = await asyncio.to_thread(self._decode_image, content)
+        except OSError as e:
+            logger.debug(f"预览图解码失败: {e}")
+            return
+        if not submission.preempted:
+            submission.status.update_preview(image)
+
+    async def _check_prompt(self, prompt_id: str, request_id: str,
+                            submission: Optional[_Submission],
+                            missing: int) -> int:
+        """
+        确认prompt仍在排队、执行或已有执行记录
+
+        Args:
+            missing: 此前连续未找到prompt的次数
+
+        Returns:
+            连续未找到prompt的次数
+
+        Raises:
+            ExecutionError: 执行记录显示出错，或连续多次未找到prompt
+        """
+        try:
+            history = await self.get_history(prompt_id)
+            if history:
+                _check_history(history, request_id)
+                return 0
+            response = await self._request("GET", "/queue", "queue")
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            logger.debug(f"确认prompt状态失败 [请求ID: {request_id}]: {e}")
+            return missing
+
+        if prompt_id in _queued_prompt_ids(response.json()) or (
+                submission is not None and submission.preempted):
+            return 0
+        # 执行完成时prompt先离开队列再写入执行记录，连续多次未找到才判定丢失
+        missing += 1
+        if missing >= PROMPT_MISSING_CHECKS:
+            raise ExecutionError(
+                f"prompt已不在ComfyUI队列中，也没有执行记录 [请求ID: {request_id}]")
+        return missing
+
+    async def _fetch_result(self, prompt_id: str, request_id: str,
+                            output_dir: Path,
+                            settle: bool = False
+                            ) -> Optional[Tuple[Image.Image, str]]:
+        """
+        获取输出图片，结果尚未生成时返回None
+
+        Args:
+            settle: filesystem模式下找到文件后是否等待写入完成
+        """
+        # websocket模式未能替换输出节点时，结果已落盘，通过接口获取
+        if self.result_mode in ("api", "websocket"):
+            return await self._fetch_from_history(prompt_id, request_id)
+
+        output_path = await asyncio.to_thread(
+            self._find_output, output_dir, request_id)
+        if output_path is None:
+            return None
+        if settle:
+            # 确保文件写入完成
+            await asyncio.sleep(0.5)
+        output_image = await asyncio.to_thread(self._load_image, output_path)
+        return output_image, str(output_path)
+
+    async def _fetch_from_history(
+            self, prompt_id: str,
+            request_id: str) -> Optional[Tuple[Image.Image, str]]:
+        """从/history中找到输出文件名，再通过/view读入内存"""
+        history = await self.get_history(prompt_id)
+        outputs = history.get("outputs", {})
+        images = [
+            image
+            for node_output in outputs.values()
+            for image in node_output.get("images", [])
+            if image.get("type") == "output"
+        ]
+        if not images:
+            return None
+
+        # 优先选择以请求ID为前缀的文件，即SaveImage节点的输出
+        images.sort(key=lambda image: not image.get(
+            "filename", "").startswith(request_id))
+        image = images[0]
+        subfolder = image.get("subfolder", "")
+        output_image = await self.view_image(image["filename"], subfolder)
+        location = image["filename"]
+        if subfolder:
+            location = f"{subfolder}/{location}"
+        return output_image, location
+
+    async def _poll_result(self, prompt_id: str, request_id: str,
+                           output_dir: Path, max_wait: float,
+                           submission: Optional[_Submission] = None
+                           ) -> Tuple[Image.Image, str]:
+        """轮询输出结果，作为事件通道不可用时的后备方案"""
+        deadline = time.time() + max_wait
+        retry_count = 0
+        missing = 0
+
+        while time.time() < deadline:
+            if submission is not None and submission.preempted:
+                raise _Preempted(prompt_id)
+            try:
+                result = await self._fetch_result(
+                    prompt_id, request_id, output_dir, settle=True)
+                if result is not None:
+                    return result
+            except Exception as e:
+                logger.error(f"图片加载失败 [请求ID: {request_id}]: {e}")
+
+            await asyncio.sleep(1)
+            retry_count += 1
+            if retry_count % PROMPT_CHECK_INTERVAL == 0:
+                logger.info(
+                    f"等待处理结果 [请求ID: {request_id}]: {retry_count}秒")
+                missing = await self._check_prompt(
+                    prompt_id, request_id, submission, missing)
+
+        raise TimeoutError(f"等待处理结果超时 [请求ID: {request_id}]")
+
+    @staticmethod
+    def _find_output(output_dir: Path, request_id: str) -> Optional[Path]:
+        """查找以请求ID为前缀的输出文件"""
+        output_files = list(Path(output_dir).glob(f"{request_id}*.png"))
+        return output_files[0] if output_files else None
+
+    @staticmethod
+    def _load_image(output_path: Path) -> Image.Image:
+        """读取图片并脱离文件句柄"""
+        with Image.open(output_path) as img:
+            return img.copy()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取客户端统计信息"""
+        return {
+            "backend": self.base_url,
+            "result_mode": self.result_mode,
+            "upload_mode": self.upload_mode,
+            "event_channel_connected": self.listener.connected,
+            "circuit": self.breaker.get_stats(),
+            "dispatch": self.dispatcher.get_stats(),
+            "preempted": self.preempted,
+            "queue_jumps": self.queue_jumps,
+            "retries": self.retries,
+            "failovers": self.failovers,
+            "cancelled": self.cancelled,
+            "coalesce": self.coalescer.get_stats(),
+            "result_cache": (self.result_cache.get_stats()
+                             if self.result_cache is not None else None),
+            "eta": (self.latency.get_stats()
+                    if self.latency is not None else None),
+            "calls": self.metrics.snapshot()
+        }
+
+
+def _submitted_message(estimate: float) -> str:
+    """提交成功后显示的状态消息，有预计耗时时一并显示"""
+    message = "已提交到ComfyUI，等待处理结果"
+    if estimate > 0:
+        message += f"，预计需要{format_seconds(estimate)}"
+    return message
+
+
+def _is_transient(error: httpx.HTTPError) -> bool:
+    """是否为可以重试的暂时性故障：连接失败、连接重置、超时或5xx"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+
+def _is_client_error(error: httpx.HTTPError) -> bool:
+    """是否为4xx：请求本身有误，后端是正常的"""
+    return (isinstance(error, httpx.HTTPStatusError)
+            and error.response.status_code < 500)
+
+
+def _queued_prompt_ids(queue: Dict[str, Any]) -> set:
+    """/queue响应中正在执行和等待执行的prompt_id"""
+    return {
+        item[1]
+        for name in ("queue_running", "queue_pending")
+        for item in queue.get(name, [])}
+
+
+def _queued_priority(item: List[Any]) -> Optional[int]:
+    """/queue中一项的优先级，即提交时写入extra_data的值，没有时返回None"""
+    extra_data = item[3] if len(item) > 3 else None
+    if not isinstance(extra_data, dict):
+        return None
+    priority = extra_data.get("priority")
+    return priority if isinstance(priority, int) else None
+
+
+def _describe_error(data: Dict[str, Any], request_id: str) -> str:
+    """把execution_error或execution_interrupted事件数据转换为错误信息"""
+    if data.get("type") == "execution_interrupted":
+        return f"ComfyUI执行已被中断 [请求ID: {request_id}]"
+    node_type = data.get("node_type") or data.get("node_id") or "未知"
+    message = data.get("exception_message") or data.get("exception_type") or ""
+    return f"ComfyUI执行失败，{node_type}节点出错: {message.strip()} [请求ID: {request_id}]"
+
+
+def _check_history(history: Dict[str, Any], request_id: str) -> None:
+    """
+    检查执行记录中的执行状态
+
+    Raises:
+        ExecutionError: 执行出错或被中断
+    """
+    status = history.get("status") or {}
+    if status.get("status_str") != "error":
+        return
+    for message in status.get("messages", []):
+        if (isinstance(message, (list, tuple)) and len(message) == 2
+                and message[0] in ("execution_error",
+                                   "execution_interrupted")):
+            raise ExecutionError(_describe_error(
+                dict(message[1], type=message[0]), request_id))
+    raise ExecutionError(f"ComfyUI执行失败 [请求ID: {request_id}]")
+
+
+def get_deadline(workflow_name: Optional[str] = None) -> float:
+    """
+    获取工作流的执行期限（秒），从开始等待结果时计时，包含排队时间
+
+    comfyui_server.deadlines按工作流名称配置，未配置的工作流使用
+    comfyui_server.deadline
+    """
+    deadlines = Config.get("comfyui_server.deadlines") or {}
+    if workflow_name in deadlines:
+        return deadlines[workflow_name]
+    return Config.get("comfyui_server.deadline", 6000)
+
+
+def get_backend_urls() -> List[str]:
+    """
+    获取配置的ComfyUI后端地址列表
+
+    comfyui_server.url既可以是单个地址，也可以是地址列表
+    """
+    urls = Config.get("comfyui_server.url")
+    if isinstance(urls, str):
+        urls = [urls]
+    return [ComfyUIClient._normalize_base_url(url) for url in urls]
+
+
+def get_model_group(workflow_name: Optional[str]) -> Optional[str]:
+    """
+    获取工作流所属的模型组
+
+    comfyui_server.model_groups中列在同一组的工作流共用同一组模型，
+    未列出的工作流各自为一组
+
+    Args:
+        workflow_name: 工作流名称（工作流文件名，不含扩展名）
+
+    Returns:
+        模型组名称
+    """
+    model_groups = Config.get("comfyui_server.model_groups") or {}
+    for group, workflow_names in model_groups.items():
+        if workflow_name in workflow_names:
+            return group
+    return workflow_name
+
+
+# 每个进程内按后端地址共享的客户端
+_clients: Dict[str, ComfyUIClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(url: Optional[str] = None) -> ComfyUIClient:
+    """
+    获取指定后端的共享客户端，同一进程内每个后端只创建一个连接池
+
+    Args:
+        url: ComfyUI地址，默认为配置中的第一个后端
+
+    Returns:
+        ComfyUIClient对象
+    """
+    key = ComfyUIClient._normalize_base_url(url or get_backend_urls()[0])
+    with _clients_lock:
+        if key not in _clients:
+            client = ComfyUIClient(key)
+            # 服务启动时即建立事件通道，首个请求也能走事件通知
+            client.listener.start()
+            _clients[key] = client
+        return _clients[key]
@@ -0,0 +1,403 @@
+"""
+提交调度 - 在客户端暂存提交，按优先级和模型组重新排序，减少单个GPU上的模型切换
+"""
+
+import time
+import asyncio
+import threading
+from typing import Dict, Any, List, Optional, Callable, Tuple
+
+from comfyui_gradio.utils.logger import setup_logger
+from comfyui_gradio.client.status import RequestStatus
+from comfyui_gradio.client.priority import PRIORITY_NORMAL, PRIORITY_BULK
+from comfyui_gradio.client.eta import format_seconds
+
+# 设置日志
+logger = setup_logger("comfyui-client-logs")
+
+# 排队期间刷新排队位置的间隔（秒）
+POSITION_INTERVAL = 1.0
+
+
+class QueueFullError(RuntimeError):
+    """排队请求已达上限，请求被拒绝"""
+
+
+class _Ticket:
+    """一个等待提交的请求"""
+
+    def __init__(self, group: Optional[str], priority: int, cost: float,
+                 loop: asyncio.AbstractEventLoop,
+                 caller: Optional[str] = None, estimate: float = 0):
+        self.group = group
+        self.priority = priority
+        self.caller = caller
+        # 预计执行耗时（秒），0表示未知
+        self.estimate = estimate
+        # 预计占用的显存（MB）
+        self.cost = cost
+        # 是否曾因显存不足被暂缓
+        self.held = False
+        self.loop = loop
+        self.future = loop.create_future()
+        self.enqueued_at = time.time()
+        self.granted = False
+
+
+class Dispatcher:
+    """
+    单个后端的提交调度器
+
+    ComfyUI的队列是先进先出的，提交之后就无法再调整顺序。调度器只让
+    max_outstanding个prompt同时留在后端（一个执行、其余排队），其余请求
+    在客户端等待。有空位时先放行优先级最高的请求；同一优先级内优先放行
+    与上一个提交同一模型组的请求，但只在最早的reorder_window个等待请求中
+    挑选，且任何请求等待超过max_hold_seconds后必须按到达顺序放行，保证
+    单个请求的延迟有上限。负载较低时不会有请求排队，因此不增加延迟。
+
+    开启fair_share时，同一优先级内按调用方轮流放行，最久没有被放行的
+    调用方先提交，上述模型组重排和强制放行只在该调用方的请求中进行，
+    一个调用方积压大量请求时只会拖慢自己。
+
+    请求带有预计执行耗时时，排队期间显示预计等待时间；预计等待时间
+    超过max_wait的新请求立即被拒绝，不必排到最后再超时。
+
+    同优先级及更高优先级的等待请求数达到max_queued后，新请求立即被拒绝，
+    不再无限排队；低优先级的积压不会挡住高优先级请求。
+
+    设置了后端空闲显存（update_vram()）时，预计显存占用超过空闲显存的
+    请求暂缓提交，最多暂缓vram_max_hold_seconds，避免ComfyUI显存不足。
+    自上次读取空闲显存以来放行的请求的显存会先从空闲显存中扣除。
+    ComfyUI执行完成后仍会缓存模型，空闲显存在后端空闲时也可能偏低，
+    因此只有本后端还有已提交的prompt（其结束后显存才可能释放）时才暂缓。
+    """
+
+    def __init__(self, max_outstanding: int = 2, reorder_window: int = 8,
+                 max_hold_seconds: float = 30, max_queued: int = 0,
+                 vram_reserve_mb: float = 0,
+                 vram_max_hold_seconds: float = 120,
+                 fair_share: bool = True):
+        """
+        初始化调度器
+
+        Args:
+            max_outstanding: 同时提交到后端的prompt数量上限，0表示不限制
+            reorder_window: 重新排序时考虑的等待请求数量
+            max_hold_seconds: 请求最长被插队等待的时间（秒）
+            max_queued: 在客户端等待的请求数量上限，0表示不限制
+            vram_reserve_mb: 保留不分配的显存（MB）
+            vram_max_hold_seconds: 请求因显存不足最长暂缓的时间（秒）
+            fair_share: 同一优先级内是否按调用方轮流放行
+        """
+        self.max_outstanding = max_outstanding
+        self.max_queued = max_queued
+        self.reorder_window = max(reorder_window, 1)
+        self.max_hold_seconds = max_hold_seconds
+        self.vram_reserve_mb = vram_reserve_mb
+        self.vram_max_hold_seconds = vram_max_hold_seconds
+        self.fair_share = fair_share
+        self._waiting: List[_Ticket] = []
+        self._outstanding = 0
+        self._last_group: Optional[str] = None
+        # 最近读取的空闲显存（MB），None表示未知，不按显存暂缓
+        self.free_vram: Optional[float] = None
+        # 上次读取空闲显存之后放行的请求预计占用的显存
+        self._committed_vram = 0.0
+        # 已提交的prompt预计执行耗时之和
+        self._outstanding_estimate = 0.0
+        # 键为调用方，值为最近一次放行的序号，轮流放行时序号最小的调用方优先
+        self._served: Dict[Optional[str], int] = {}
+        self._served_count = 0
+        self._lock = threading.Lock()
+        # 统计：被提前放行的同组请求数、因等待超时强制放行的请求数、
+        # 因排队已满被拒绝的请求数、因显存不足暂缓的请求数，以及因预计
+        # 等待时间过长被拒绝的请求数
+        self.reordered = 0
+        self.forced = 0
+        self.rejected = 0
+        self.vram_held = 0
+        self.shed = 0
+
+    @property
+    def waiting(self) -> int:
+        """在客户端等待提交的请求数量"""
+        return len(self._waiting)
+
+    @property
+    def full(self) -> bool:
+        """排队请求是否已达上限（按最低优先级计算）"""
+        return self.is_full(PRIORITY_BULK)
+
+    def is_full(self, priority: int = PRIORITY_NORMAL) -> bool:
+        """
+        该优先级的请求是否已无法排队
+
+        Args:
+            priority: 请求优先级
+
+        Returns:
+            同优先级及更高优先级的等待请求数是否已达上限
+        """
+        return 0 < self.max_queued <= self.waiting_ahead(priority)
+
+    @property
+    def vram_waiting(self) -> bool:
+        """是否有需要显存的请求在等待"""
+        with self._lock:
+            return any(ticket.cost > 0 for ticket in self._waiting)
+
+    def update_vram(self, free_mb: Optional[float]) -> None:
+        """
+        更新后端的空闲显存并放行显存已足够的请求
+
+        Args:
+            free_mb: 空闲显存（MB），None表示未知
+        """
+        with self._lock:
+            self.free_vram = free_mb
+            self._committed_vram = 0.0
+            self._drain()
+
+    def waiting_ahead(self, priority: int) -> int:
+        """同优先级及更高优先级的等待请求数量"""
+        return sum(
+            1 for ticket in self._waiting if ticket.priority <= priority)
+
+    def predicted_wait(self, priority: int = PRIORITY_NORMAL) -> float:
+        """
+        新请求预计的排队时间
+
+        Args:
+            priority: 请求优先级
+
+        Returns:
+            已提交的prompt和同优先级及更高优先级的等待请求的预计耗时之和（秒）
+        """
+        with self._lock:
+            return self._wait_before(len(self._waiting), priority)
+
+    def _wait_before(self, index: int, priority: int) -> float:
+        """排在等待队列index位置的请求预计的排队时间，调用方需持有锁"""
+        return self._outstanding_estimate + sum(
+            ticket.estimate for ticket in self._waiting[:index]
+            if ticket.priority <= priority)
+
+    async def acquire(self, group: Optional[str] = None,
+                      status: Optional[RequestStatus] = None,
+                      priority: int = PRIORITY_NORMAL,
+                      on_wait: Optional[Callable[[int], None]] = None,
+                      enqueued_at: Optional[float] = None,
+                      cost: float = 0, caller: Optional[str] = None,
+                      estimate: float = 0,
+                      max_wait: Optional[float] = None) -> None:
+        """
+        等待提交许可，提交完成的prompt执行结束后必须调用release()，
+        并传入相同的estimate
+
+        Args:
+            group: 请求所属的模型组
+            status: 请求状态，排队期间更新排队位置
+            priority: 请求优先级，数值越小越优先
+            on_wait: 请求需要排队时调用，参数为请求优先级，用于抢占低优先级请求
+            enqueued_at: 被抢占后重新排队的请求首次排队的时间，按该时间
+                插回等待队列，且不受排队上限限制
+            cost: 预计占用的显存（MB），0表示不按显存暂缓
+            caller: 调用方标识，同一优先级内按调用方轮流放行
+            estimate: 预计执行耗时（秒），0表示未知
+            max_wait: 预计排队时间超过该值（秒）时拒绝新请求，None表示不限制
+
+        Raises:
+            QueueFullError: 排队请求已达上限，或预计等待时间过长
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.max_outstanding <= 0 or (
+                    not self._waiting
+                    and self._outstanding < self.max_outstanding
+                    and self._fits(cost, enqueued_at or time.time())):
+                self._outstanding += 1
+                self._last_group = group
+                self._committed_vram += cost
+                self._outstanding_estimate += estimate
+                self._mark_served(caller)
+                return
+            if enqueued_at is None and self.is_full(priority):
+                self.rejected += 1
+                raise QueueFullError(
+                    f"排队请求已满（{len(self._waiting)}个），请稍后再试")
+            if enqueued_at is None and max_wait is not None:
+                wait = self._wait_before(len(self._waiting), priority)
+                if wait > max_wait:
+                    self.rejected += 1
+                    self.shed += 1
+                    raise QueueFullError(
+                        f"当前排队较多，预计需要等待{format_seconds(wait)}，"
+                        f"请稍后再试")
+            ticket = _Ticket(group, priority, cost, loop, caller, estimate)
+            if enqueued_at is None:
+                self._waiting.append(ticket)
+            else:
+                ticket.enqueued_at = enqueued_at
+                index = next(
+                    (i for i, other in enumerate(self._waiting)
+                     if other.enqueued_at > enqueued_at),
+                    len(self._waiting))
+                self._waiting.insert(index, ticket)
+            # 有空位但前面的请求在等待显存时，显存足够的请求可以先放行
+            self._drain()
+
+        if on_wait is not None and not ticket.granted:
+            on_wait(priority)
+
+        try:
+            while True:
+                if status is not None:
+                    position = self._position(ticket)
+                    if position is not None:
+                        position, wait = position
+                        message = f"排队中，前面还有{position}个请求"
+                        if ticket.held:
+                            message += "，等待GPU显存释放"
+                        elif wait > 0:
+                            message += f"，预计等待{format_seconds(wait)}"
+                        status.update(message)
+                try:
+                    await asyncio.wait_for(
+                        asyncio.shield(ticket.future), POSITION_INTERVAL)
+                    return
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = ticket.granted
+                if not granted:
+                    self._waiting.remove(ticket)
+            if granted:
+                self.release(ticket.estimate)
+            raise
+
+    def release(self, estimate: float = 0) -> None:
+        """
+        归还提交许可并放行下一个等待的请求
+
+        Args:
+            estimate: 取得许可时传入的预计执行耗时（秒）
+        """
+        with self._lock:
+            self._outstanding_estimate = max(
+                self._outstanding_estimate - estimate, 0.0)
+            if self.max_outstanding <= 0:
+                return
+            self._outstanding = max(self._outstanding - 1, 0)
+            self._drain()
+
+    def _drain(self) -> None:
+        """有空位时放行等待的请求，调用方需持有锁"""
+        while self._waiting and self._outstanding < self.max_outstanding:
+            ticket = self._pick()
+            if ticket is None:
+                return
+            self._waiting.remove(ticket)
+            ticket.granted = True
+            self._outstanding += 1
+            self._last_group = ticket.group
+            self._committed_vram += ticket.cost
+            self._outstanding_estimate += ticket.estimate
+            self._mark_served(ticket.caller)
+            ticket.loop.call_soon_threadsafe(_grant, ticket.future)
+
+    def _mark_served(self, caller: Optional[str]) -> None:
+        """记录调用方被放行，调用方需持有锁"""
+        if not self.fair_share:
+            return
+        self._served_count += 1
+        self._served[caller] = self._served_count
+        # 只需记住仍有请求在等待的调用方
+        if len(self._served) > 2 * len(self._waiting) + 64:
+            waiting = {ticket.caller for ticket in self._waiting}
+            self._served = {
+                name: count for name, count in self._served.items()
+                if name in waiting}
+
+    def _fits(self, cost: float, enqueued_at: float) -> bool:
+        """空闲显存是否足够，调用方需持有锁"""
+        if cost <= 0 or self.free_vram is None:
+            return True
+        # 没有已提交的prompt时等待不会释放显存，ComfyUI会自行卸载缓存的模型
+        if self._outstanding == 0:
+            return True
+        # 显存长时间不足（如被缓存的模型占用）时不再暂缓，交给ComfyUI处理
+        if time.time() - enqueued_at >= self.vram_max_hold_seconds:
+            return True
+        return (cost + self._committed_vram + self.vram_reserve_mb
+                <= self.free_vram)
+
+    def _position(self, ticket: _Ticket) -> Optional[Tuple[int, float]]:
+        """请求前面还有多少个请求以及预计排队时间，已放行时返回None"""
+        with self._lock:
+            if ticket.granted:
+                return None
+            index = self._waiting.index(ticket)
+            position = self._outstanding + sum(
+                1 for other in self._waiting[:index]
+                if other.priority <= ticket.priority)
+            return position, self._wait_before(index, ticket.priority)
+
+    def _pick(self) -> Optional[_Ticket]:
+        """选择下一个放行的请求，显存都不足时返回None，调用方需持有锁"""
+        # 只在优先级最高的等待请求中挑选
+        priority = min(ticket.priority for ticket in self._waiting)
+        waiting = [
+            ticket for ticket in self._waiting if ticket.priority == priority]
+        fitting = []
+        for ticket in waiting:
+            if self._fits(ticket.cost, ticket.enqueued_at):
+                fitting.append(ticket)
+            elif not ticket.held:
+                ticket.held = True
+                self.vram_held += 1
+        if not fitting:
+            return None
+
+        if self.fair_share:
+            # 轮到最久没有被放行的调用方，新调用方视为从未被放行
+            caller = min(
+                fitting, key=lambda ticket: self._served.get(
+                    ticket.caller, 0)).caller
+            waiting = [
+                ticket for ticket in waiting if ticket.caller == caller]
+            fitting = [
+                ticket for ticket in fitting if ticket.caller == caller]
+
+        oldest = waiting[0]
+        if (fitting[0] is oldest
+                and time.time() - oldest.enqueued_at >= self.max_hold_seconds):
+            self.forced += 1
+            return oldest
+        for ticket in waiting[:self.reorder_window]:
+            if ticket.group == self._last_group and ticket in fitting:
+                if ticket is not oldest:
+                    self.reordered += 1
+                return ticket
+        return fitting[0]
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取调度统计信息"""
+        with self._lock:
+            return {
+                "outstanding": self._outstanding,
+                "waiting": len(self._waiting),
+                "reordered": self.reordered,
+                "forced": self.forced,
+                "rejected": self.rejected,
+                "free_vram_mb": self.free_vram,
+                "vram_held": self.vram_held,
+                "shed": self.shed,
+                "outstanding_estimate": self._outstanding_estimate
+            }
+
+
+def _grant(future: asyncio.Future) -> None:
+    """在等待方的事件循环中放行"""
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,191 @@
+"""
+耗时预测 - 按工作流和输入尺寸学习执行耗时，用于显示预计等待时间和拒绝注定超时的请求
+"""
+
+import os
+import json
+import time
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+from comfyui_gradio.config import Config
+from comfyui_gradio.utils.logger import setup_logger
+
+# 设置日志
+logger = setup_logger("comfyui-client-logs")
+
+# 默认的输入尺寸分档（百万像素），超过最后一档的归入最后一档之上
+MEGAPIXEL_BUCKETS = [0.5, 1, 2, 4, 8]
+# 指数移动平均的权重，样本较少时使用算术平均
+EWMA_ALPHA = 0.2
+# 两次写盘的最短间隔（秒）
+SAVE_INTERVAL = 10.0
+
+
+class LatencyModel:
+    """
+    执行耗时模型
+
+    以"工作流名称@尺寸档"为键记录执行耗时的移动平均，尺寸档按输入图片
+    中最大一张的百万像素数划分。某个尺寸档还没有样本时使用该工作流
+    所有尺寸档的加权平均。模型保存为JSON文件，重启后继续使用，写入时
+    先写临时文件再原子替换。
+    """
+
+    def __init__(self, path: Optional[Path] = None,
+                 buckets: Optional[List[float]] = None):
+        """
+        初始化耗时模型
+
+        Args:
+            path: 模型文件路径，None表示不持久化
+            buckets: 输入尺寸分档的上限（百万像素），从小到大
+        """
+        self.path = Path(path) if path is not None else None
+        self.buckets = sorted(buckets or MEGAPIXEL_BUCKETS)
+        # 键为"工作流名称@尺寸档"，值包含平均耗时avg和样本数count
+        self._entries: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+        self._saved_at = 0.0
+        self._dirty = False
+        self.observations = 0
+        self._load()
+
+    def _bucket(self, megapixels: float) -> str:
+        """输入尺寸所属的分档"""
+        for limit in self.buckets:
+            if megapixels <= limit:
+                return f"{limit:g}"
+        return f">{self.buckets[-1]:g}"
+
+    def estimate(self, workflow_name: Optional[str],
+                 megapixels: float = 0) -> Optional[float]:
+        """
+        预测执行耗时
+
+        Args:
+            workflow_name: 工作流名称
+            megapixels: 输入图片的百万像素数
+
+        Returns:
+            预计耗时（秒），没有样本时返回None
+        """
+        if workflow_name is None:
+            return None
+        key = f"{workflow_name}@{self._bucket(megapixels)}"
+        prefix = f"{workflow_name}@"
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry["avg"]
+            entries = [
+                entry for name, entry in self._entries.items()
+                if name.startswith(prefix)]
+        count = sum(entry["count"] for entry in entries)
+        if not count:
+            return None
+        return sum(entry["avg"] * entry["count"] for entry in entries) / count
+
+    def observe(self, workflow_name: Optional[str], megapixels: float,
+                seconds: float) -> None:
+        """
+        记录一次执行耗时，距上次写盘超过SAVE_INTERVAL时保存模型
+
+        Args:
+            workflow_name: 工作流名称
+            megapixels: 输入图片的百万像素数
+            seconds: 执行耗时（秒）
+        """
+        if workflow_name is None or seconds <= 0:
+            return
+        key = f"{workflow_name}@{self._bucket(megapixels)}"
+        with self._lock:
+            entry = self._entries.setdefault(key, {"avg": seconds, "count": 0})
+            entry["count"] += 1
+            weight = max(1 / entry["count"], EWMA_ALPHA)
+            entry["avg"] += (seconds - entry["avg"]) * weight
+            self.observations += 1
+            self._dirty = True
+            need_save = time.time() - self._saved_at >= SAVE_INTERVAL
+        if need_save:
+            self.save()
+
+    def _load(self) -> None:
+        """从模型文件读取，文件不存在或损坏时从空模型开始"""
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            entries = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError) as e:
+            logger.warning(f"读取耗时模型失败: {e}")
+            return
+        self._entries = {
+            key: {"avg": float(entry["avg"]), "count": int(entry["count"])}
+            for key, entry in entries.items()
+            if isinstance(entry, dict) and "avg" in entry and "count" in entry}
+
+    def save(self) -> None:
+        """保存模型文件"""
+        if self.path is None:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            content = json.dumps(self._entries, ensure_ascii=False, indent=2)
+            self._dirty = False
+            self._saved_at = time.time()
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=self.path.parent, prefix=".tmp_", suffix=".json")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    f.write(content)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            logger.warning(f"保存耗时模型失败: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取耗时模型统计信息"""
+        with self._lock:
+            return {
+                "observations": self.observations,
+                "estimates": {
+                    key: round(entry["avg"], 1)
+                    for key, entry in self._entries.items()}
+            }
+
+
+# 每个进程内共享的耗时模型
+_model: Optional[LatencyModel] = None
+_model_lock = threading.Lock()
+
+
+def get_latency_model() -> Optional[LatencyModel]:
+    """
+    获取共享的耗时模型
+
+    Returns:
+        LatencyModel对象，未启用耗时预测时返回None
+    """
+    global _model
+    if not Config.get("eta.enabled", True):
+        return None
+    with _model_lock:
+        if _model is None:
+            root_dir = Path(__file__).parent.parent.parent
+            path = Path(Config.get("eta.path", root_dir / "cache" / "eta.json"))
+            _model = LatencyModel(path, Config.get("eta.megapixel_buckets"))
+        return _model
+
+
+def format_seconds(seconds: float) -> str:
+    """把秒数格式化为界面显示的时长"""
+    if seconds < 60:
+        return f"{max(seconds, 1):.0f}秒"
+    return f"{seconds // 60:.0f}分{seconds % 60:.0f}秒"
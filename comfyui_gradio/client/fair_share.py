@@ -0,0 +1,191 @@
+"""
+公平分配 - 按调用方限速，避免单个用户的大量请求挤占其他用户
+"""
+
+import time
+import asyncio
+import threading
+from typing import Dict, Any, Optional, Tuple
+
+from comfyui_gradio.config import Config
+from comfyui_gradio.utils.logger import setup_logger
+from comfyui_gradio.client.dispatcher import QueueFullError
+from comfyui_gradio.client.status import RequestStatus
+
+# 设置日志
+logger = setup_logger("comfyui-client-logs")
+
+# 令牌桶数量超过该值时清理已经回满的令牌桶
+BUCKET_PRUNE_SIZE = 1024
+
+
+class TokenBucket:
+    """
+    令牌桶
+
+    最多积攒burst个令牌，每秒补充rate个。令牌不足时仍可预约，余额变为
+    负数，预约方按欠下的令牌数等待，保证同一调用方的请求按顺序放行。
+    """
+
+    def __init__(self, rate: float, burst: float):
+        """
+        初始化令牌桶
+
+        Args:
+            rate: 每秒补充的令牌数
+            burst: 令牌数上限
+        """
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        """按经过的时间补充令牌"""
+        now = time.monotonic()
+        self.tokens = min(
+            self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+
+    @property
+    def full(self) -> bool:
+        """令牌是否已回满"""
+        self._refill()
+        return self.tokens >= self.burst
+
+    def delay(self) -> float:
+        """现在预约一个令牌需要等待的时间（秒）"""
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def reserve(self) -> float:
+        """
+        预约一个令牌
+
+        Returns:
+            需要等待的时间（秒）
+        """
+        wait = self.delay()
+        self.tokens -= 1
+        return wait
+
+    def refund(self) -> None:
+        """归还一个已预约但没有使用的令牌"""
+        self.tokens = min(self.tokens + 1, self.burst)
+
+
+class FairShare:
+    """
+    按调用方和服务限速
+
+    每个调用方在每个服务上有独立的令牌桶，突发提交burst个请求后按
+    per_minute的速率放行，超出的请求在提交前等待，不进入后端的调度
+    队列，因此不会占用其他用户的排队名额。调度器在同一优先级内再按
+    调用方轮流放行，重度用户只会拖慢自己。
+    """
+
+    def __init__(self, rate_limits: Dict[str, Dict[str, float]],
+                 max_delay: float = 600):
+        """
+        初始化限速器
+
+        Args:
+            rate_limits: 按服务名称配置的限速，值包含burst和per_minute
+            max_delay: 限速等待的上限（秒），超过时立即拒绝
+        """
+        self.rate_limits = rate_limits
+        self.max_delay = max_delay
+        # 键为(服务名称, 调用方)
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._lock = threading.Lock()
+        # 统计：需要等待的请求数和因等待过久被拒绝的请求数
+        self.throttled = 0
+        self.rejected = 0
+
+    def _bucket(self, service: str, caller: str) -> Optional[TokenBucket]:
+        """获取调用方在该服务上的令牌桶，服务不限速时返回None，调用方需持有锁"""
+        limit = self.rate_limits.get(service)
+        if not limit or not limit.get("per_minute"):
+            return None
+        key = (service, caller)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= BUCKET_PRUNE_SIZE:
+                self._buckets = {
+                    key: bucket for key, bucket in self._buckets.items()
+                    if not bucket.full}
+            bucket = TokenBucket(
+                limit["per_minute"] / 60, limit.get("burst", 1))
+            self._buckets[key] = bucket
+        return bucket
+
+    async def throttle(self, status: Optional[RequestStatus]) -> None:
+        """
+        等待调用方的令牌，无法识别调用方或服务不限速时立即返回
+
+        Args:
+            status: 请求状态，提供服务名称和调用方，等待期间更新状态消息
+
+        Raises:
+            QueueFullError: 需要等待的时间超过max_delay
+        """
+        if status is None or status.caller is None or status.service is None:
+            return
+        with self._lock:
+            bucket = self._bucket(status.service, status.caller)
+            if bucket is None:
+                return
+            wait = bucket.delay()
+            if wait > self.max_delay:
+                self.rejected += 1
+                raise QueueFullError(
+                    f"请求过于频繁，请{wait:.0f}秒后再试")
+            bucket.reserve()
+            if wait > 0:
+                self.throttled += 1
+        if wait <= 0:
+            return
+
+        logger.debug(
+            f"调用方限速等待{wait:.1f}秒 [{status.service}: {status.caller}]")
+        status.update(f"提交过于频繁，{wait:.0f}秒后开始排队")
+        try:
+            await asyncio.sleep(wait)
+        except asyncio.CancelledError:
+            with self._lock:
+                bucket.refund()
+            raise
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取限速统计信息"""
+        with self._lock:
+            return {
+                "callers": len(self._buckets),
+                "throttled": self.throttled,
+                "rejected": self.rejected
+            }
+
+
+# 每个进程内共享的限速器
+_fair_share: Optional[FairShare] = None
+_fair_share_lock = threading.Lock()
+
+
+def get_fair_share() -> FairShare:
+    """
+    获取共享的限速器
+
+    Returns:
+        FairShare对象
+    """
+    global _fair_share
+    with _fair_share_lock:
+        if _fair_share is None:
+            rate_limits = (
+                Config.get("fair_share.rate_limits") or {}
+                if Config.get("fair_share.enabled", True) else {})
+            _fair_share = FairShare(
+                rate_limits, Config.get("fair_share.max_delay", 600))
+        return _fair_share
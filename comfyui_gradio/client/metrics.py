@@ -0,0 +1,56 @@
+"""
+客户端指标 - 记录每个ComfyUI接口的调用次数、失败次数和耗时
+"""
+
+import threading
+from typing import Dict, Any
+
+
+class ClientMetrics:
+    """线程安全的接口调用指标统计"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # 键为接口名称，值为该接口的累计统计
+        self._calls: Dict[str, Dict[str, float]] = {}
+
+    def record(self, name: str, elapsed: float, success: bool = True) -> None:
+        """
+        记录一次接口调用
+
+        Args:
+            name: 接口名称，如"prompt"
+            elapsed: 调用耗时（秒）
+            success: 调用是否成功
+        """
+        with self._lock:
+            stats = self._calls.setdefault(name, {
+                "count": 0,
+                "errors": 0,
+                "total_time": 0.0,
+                "max_time": 0.0
+            })
+            stats["count"] += 1
+            if not success:
+                stats["errors"] += 1
+            stats["total_time"] += elapsed
+            stats["max_time"] = max(stats["max_time"], elapsed)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """
+        获取当前统计快照
+
+        Returns:
+            每个接口的调用次数、失败次数、平均耗时和最大耗时
+        """
+        with self._lock:
+            result = {}
+            for name, stats in self._calls.items():
+                count = stats["count"]
+                result[name] = {
+                    "count": count,
+                    "errors": stats["errors"],
+                    "avg_time": stats["total_time"] / count if count else 0.0,
+                    "max_time": stats["max_time"]
+                }
+            return result
@@ -0,0 +1,65 @@
+"""
+请求优先级 - 按服务和调用方确定请求的优先级
+"""
+
+from typing import Any, Optional
+
+from comfyui_gradio.config import Config
+
+# 优先级，数值越小越优先
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+PRIORITY_CLASSES = {
+    "interactive": PRIORITY_INTERACTIVE,
+    "normal": PRIORITY_NORMAL,
+    "bulk": PRIORITY_BULK
+}
+
+
+def get_caller(request: Any = None) -> Optional[str]:
+    """
+    获取调用方标识
+
+    依次使用登录用户名、客户端IP和Gradio会话ID
+
+    Args:
+        request: gr.Request对象
+
+    Returns:
+        调用方标识，无法识别时返回None
+    """
+    if request is None:
+        return None
+    username = getattr(request, "username", None)
+    if username:
+        return username
+    client = getattr(request, "client", None)
+    host = getattr(client, "host", None)
+    if host:
+        return host
+    return getattr(request, "session_hash", None)
+
+
+def get_priority(service: str, request: Any = None) -> int:
+    """
+    获取请求的优先级
+
+    priority.callers中配置的调用方优先级优先于priority.services中
+    配置的服务优先级，均未配置时为normal
+
+    Args:
+        service: 服务名称，如"fill_repaint"
+        request: gr.Request对象
+
+    Returns:
+        优先级数值
+    """
+    name = None
+    caller = get_caller(request)
+    if caller is not None:
+        name = (Config.get("priority.callers") or {}).get(caller)
+    if name is None:
+        name = (Config.get("priority.services") or {}).get(service, "normal")
+    return PRIORITY_CLASSES.get(name, PRIORITY_NORMAL)
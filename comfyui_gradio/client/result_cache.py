@@ -0,0 +1,207 @@
+"""
+结果缓存 - 以请求指纹为键、按字节上限做LRU淘汰的磁盘结果缓存
+"""
+
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, Any, List, Optional
+
+from comfyui_gradio.config import Config
+from comfyui_gradio.utils.logger import setup_logger
+
+# 设置日志
+logger = setup_logger("comfyui-client-logs")
+
+# 缓存文件扩展名
+CACHE_SUFFIX = ".png"
+
+
+class ResultCache:
+    """
+    磁盘结果缓存
+
+    缓存文件按指纹前两位分目录存放，写入时先写临时文件再原子替换，
+    多个服务进程可以共享同一个缓存目录。文件的修改时间即最近使用时间，
+    命中时更新修改时间，超过字节上限时删除最久未使用的文件。
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        """
+        初始化结果缓存
+
+        Args:
+            cache_dir: 缓存目录
+            max_bytes: 缓存占用的字节上限
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # 本进程估计的缓存总大小，超过上限时扫描目录得到准确值
+        self._size: Optional[int] = None
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+
+    def _path(self, key: str) -> Path:
+        """缓存键对应的文件路径"""
+        return self.cache_dir / key[:2] / f"{key}{CACHE_SUFFIX}"
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        读取缓存结果
+
+        Args:
+            key: 请求指纹
+
+        Returns:
+            编码后的结果图片，未命中时返回None
+        """
+        path = self._path(key)
+        try:
+            content = path.read_bytes()
+            # 更新最近使用时间
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += len(content)
+        return content
+
+    def put(self, key: str, content: bytes) -> None:
+        """
+        写入缓存结果，超过字节上限时淘汰最久未使用的结果
+
+        Args:
+            key: 请求指纹
+            content: 编码后的结果图片
+        """
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=path.parent, prefix=".tmp_", suffix=CACHE_SUFFIX)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(content)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            logger.warning(f"写入结果缓存失败: {e}")
+            return
+
+        with self._lock:
+            self.stores += 1
+            if self._size is not None:
+                self._size += len(content)
+            need_scan = self._size is None or self._size > self.max_bytes
+        if need_scan:
+            self._evict()
+
+    def _evict(self) -> None:
+        """扫描缓存目录，删除最久未使用的文件直到低于上限的90%"""
+        entries: List[tuple] = []
+        total = 0
+        for path in self.cache_dir.glob(f"*/*{CACHE_SUFFIX}"):
+            if path.name.startswith(".tmp_"):
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        evicted = 0
+        if total > self.max_bytes:
+            target = self.max_bytes * 0.9
+            entries.sort(key=lambda entry: entry[0])
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    path.unlink()
+                except OSError:
+                    continue
+                total -= size
+                evicted += 1
+            logger.info(f"结果缓存淘汰{evicted}个文件，当前占用{total}字节")
+
+        with self._lock:
+            self._size = total
+            self.evictions += evicted
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取缓存统计信息"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "bytes_saved": self.bytes_saved,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "size": self._size,
+                "max_bytes": self.max_bytes
+            }
+
+
+def is_deterministic(workflow: Dict[str, Any]) -> bool:
+    """
+    判断工作流的结果是否可复现
+
+    种子为负数（如-1表示每次随机）或包含配置中列出的非确定性节点时，
+    同样的输入不保证得到同样的结果，不能使用缓存。
+
+    Args:
+        workflow: 已填入参数的工作流
+
+    Returns:
+        是否可以缓存
+    """
+    nondeterministic_nodes = Config.get(
+        "result_cache.nondeterministic_nodes") or []
+    for node in workflow.values():
+        if node.get("class_type") in nondeterministic_nodes:
+            return False
+        for name, value in node.get("inputs", {}).items():
+            if "seed" in name.lower() and isinstance(value, (int, float)) \
+                    and value < 0:
+                return False
+    return True
+
+
+# 每个进程内共享的结果缓存
+_cache: Optional[ResultCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache() -> Optional[ResultCache]:
+    """
+    获取共享的结果缓存
+
+    Returns:
+        ResultCache对象，未启用缓存时返回None
+    """
+    global _cache
+    if not Config.get("result_cache.enabled", True):
+        return None
+    with _cache_lock:
+        if _cache is None:
+            root_dir = Path(__file__).parent.parent.parent
+            cache_dir = Path(Config.get(
+                "result_cache.dir", root_dir / "cache" / "results"))
+            max_bytes = int(
+                Config.get("result_cache.max_size_mb", 2048) * 1024 * 1024)
+            _cache = ResultCache(cache_dir, max_bytes)
+        return _cache
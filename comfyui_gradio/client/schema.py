@@ -0,0 +1,187 @@
+"""
+工作流校验 - 启动时按ComfyUI的/object_info检查工作流的节点类型和输入名称
+"""
+
+import os
+import re
+import json
+import time
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple
+
+import httpx
+
+from comfyui_gradio.config import Config
+from comfyui_gradio.utils.logger import setup_logger
+
+# 设置日志
+logger = setup_logger("comfyui-client-logs")
+
+# 节点定义缓存目录
+SCHEMA_CACHE_DIR = Path(__file__).parent.parent.parent / "cache" / "object_info"
+
+
+class WorkflowValidationError(RuntimeError):
+    """工作流与ComfyUI后端的节点定义不匹配，请求没有发送"""
+
+
+class SchemaCache:
+    """
+    ComfyUI节点定义（/object_info）的缓存
+
+    /object_info包含所有节点的输入定义，安装较多自定义节点时有数MB，
+    因此按后端地址和ComfyUI版本缓存到磁盘，重启后在cache_ttl内直接使用。
+    自定义节点变化不会改变版本号，校验发现不匹配时会绕过缓存重新读取
+    一次再下结论。同一进程内每个后端最多从网络读取一次，各服务共享。
+    """
+
+    def __init__(self, cache_dir: Path = SCHEMA_CACHE_DIR,
+                 cache_ttl: float = 86400, timeout: float = 30):
+        """
+        初始化缓存
+
+        Args:
+            cache_dir: 缓存目录
+            cache_ttl: 磁盘缓存的有效期（秒）
+            timeout: 读取/object_info的超时时间（秒）
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_ttl = cache_ttl
+        self.timeout = timeout
+        # 键为后端地址，值为(节点定义, 是否本进程从网络读取)
+        self._schemas: Dict[str, Tuple[Dict[str, Any], bool]] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def get(self, base_url: str, refresh: bool = False) -> Dict[str, Any]:
+        """
+        获取后端的节点定义
+
+        Args:
+            base_url: ComfyUI的HTTP地址
+            refresh: 是否忽略磁盘缓存重新读取，本进程已从网络读取过时不再读取
+
+        Returns:
+            /object_info返回的节点定义，键为节点类型
+
+        Raises:
+            httpx.HTTPError: 后端无法访问
+        """
+        with self._lock:
+            lock = self._locks.setdefault(base_url, threading.Lock())
+        with lock:
+            cached = self._schemas.get(base_url)
+            if cached is not None and (cached[1] or not refresh):
+                return cached[0]
+
+            with httpx.Client(base_url=base_url, timeout=self.timeout) as http:
+                version = _get_version(http)
+                path = self._path(base_url, version)
+                schema = None if refresh else self._load(path)
+                fresh = schema is None
+                if fresh:
+                    response = http.get("/object_info")
+                    response.raise_for_status()
+                    schema = response.json()
+                    self._save(path, schema)
+                    logger.info(
+                        f"已读取ComfyUI节点定义 [{base_url}, 版本: {version}], "
+                        f"共{len(schema)}个节点类型")
+            self._schemas[base_url] = (schema, fresh)
+            return schema
+
+    def _path(self, base_url: str, version: str) -> Path:
+        """缓存文件路径，按后端地址和版本区分"""
+        name = re.sub(r"[^0-9A-Za-z.]+", "_", f"{base_url}_{version}")
+        return self.cache_dir / f"{name}.json"
+
+    def _load(self, path: Path) -> Optional[Dict[str, Any]]:
+        """读取未过期的缓存文件"""
+        try:
+            if time.time() - path.stat().st_mtime >= self.cache_ttl:
+                return None
+            return json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+
+    def _save(self, path: Path, schema: Dict[str, Any]) -> None:
+        """原子写入缓存文件"""
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=path.parent, prefix=".tmp_", suffix=".json")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(schema, f)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            logger.warning(f"写入节点定义缓存失败: {e}")
+
+
+def _get_version(http: httpx.Client) -> str:
+    """读取ComfyUI版本，旧版本没有版本信息时返回unknown"""
+    response = http.get("/system_stats")
+    response.raise_for_status()
+    system = response.json().get("system") or {}
+    return str(system.get("comfyui_version") or "unknown")
+
+
+def validate_workflow(workflow: Dict[str, Any],
+                      schema: Dict[str, Any]) -> Tuple[List[str], List[str]]:
+    """
+    按节点定义检查工作流
+
+    Args:
+        workflow: API格式的工作流
+        schema: /object_info返回的节点定义
+
+    Returns:
+        (错误, 警告)：缺少节点类型或必填输入为错误，工作流无法执行；
+        节点定义中没有的输入为警告，ComfyUI会忽略该输入
+    """
+    errors: List[str] = []
+    warnings: List[str] = []
+    for node_id, node in workflow.items():
+        class_type = node.get("class_type")
+        info = schema.get(class_type)
+        if info is None:
+            errors.append(f"节点{node_id}的类型不存在: {class_type}")
+            continue
+        spec = info.get("input") or {}
+        required = spec.get("required") or {}
+        known = set(required) | set(spec.get("optional") or {}) | set(
+            spec.get("hidden") or {})
+        inputs = node.get("inputs", {})
+        for name in required:
+            if name not in inputs:
+                errors.append(f"节点{node_id}({class_type})缺少输入: {name}")
+        for name in inputs:
+            if name not in known:
+                warnings.append(f"节点{node_id}({class_type})没有输入: {name}")
+    return errors, warnings
+
+
+# 每个进程内共享的节点定义缓存
+_cache: Optional[SchemaCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_schema_cache() -> SchemaCache:
+    """
+    获取共享的节点定义缓存
+
+    Returns:
+        SchemaCache对象
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = SchemaCache(
+                cache_ttl=Config.get("comfyui_server.schema_cache_ttl", 86400),
+                timeout=Config.get("comfyui_server.read_timeout", 30))
+        return _cache
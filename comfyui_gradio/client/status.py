@@ -0,0 +1,126 @@
+"""
+请求状态 - 把排队位置等实时状态从客户端传递到Gradio界面
+"""
+
+import asyncio
+from typing import Any, AsyncIterator, List, Optional, Tuple
+
+from PIL import Image
+
+from comfyui_gradio.client.priority import PRIORITY_NORMAL
+
+
+class RequestStatus:
+    """
+    单个请求的实时状态
+
+    客户端在排队、提交等阶段调用update()更新状态消息，服务的处理函数
+    通过stream()在等待结果期间把消息推送到状态文本框，并通过
+    take_preview()取得采样预览图。只能在处理请求的事件循环中使用。
+    同时携带调度所需的请求属性。合并到本请求的相同请求通过attach()
+    接收同样的状态更新。
+    """
+
+    def __init__(self, priority: int = PRIORITY_NORMAL,
+                 caller: Optional[str] = None,
+                 service: Optional[str] = None, previews: bool = False):
+        """
+        初始化请求状态
+
+        Args:
+            priority: 请求优先级，数值越小越优先
+            caller: 调用方标识
+            service: 服务名称，如"fill_repaint"，用于按服务限速
+            previews: 是否接收采样过程中的预览图
+        """
+        self.priority = priority
+        self.caller = caller
+        self.service = service
+        self.message: Optional[str] = None
+        # 当前节点的执行进度(当前步数, 总步数)，None表示没有进度
+        self.progress: Optional[Tuple[int, int]] = None
+        self.previews = previews
+        self._preview: Optional[Image.Image] = None
+        self._changed = asyncio.Event()
+        # 合并到本请求的相同请求的状态
+        self._followers: List["RequestStatus"] = []
+
+    def update(self, message: str,
+               progress: Optional[Tuple[int, int]] = None) -> None:
+        """
+        更新状态消息
+
+        Args:
+            message: 显示给用户的状态消息
+            progress: 执行进度(当前步数, 总步数)
+        """
+        self.progress = progress
+        if message != self.message:
+            self.message = message
+            self._changed.set()
+        for follower in self._followers:
+            follower.update(message, progress)
+
+    def update_preview(self, image: Image.Image) -> None:
+        """
+        更新采样预览图
+
+        Args:
+            image: 预览图
+        """
+        self._preview = image
+        self._changed.set()
+        for follower in self._followers:
+            if follower.previews:
+                follower.update_preview(image)
+
+    def attach(self, follower: "RequestStatus") -> None:
+        """
+        把之后的状态更新同时推送给合并到本请求的相同请求
+
+        Args:
+            follower: 合并请求的状态
+        """
+        self._followers.append(follower)
+        if self.message is not None:
+            follower.update(self.message, self.progress)
+
+    def detach(self, follower: "RequestStatus") -> None:
+        """停止向合并请求推送状态更新"""
+        if follower in self._followers:
+            self._followers.remove(follower)
+
+    def take_preview(self) -> Optional[Image.Image]:
+        """取走最新的预览图，没有新预览图时返回None"""
+        image, self._preview = self._preview, None
+        return image
+
+    async def stream(self, task: asyncio.Future,
+                     progress: Any = None) -> AsyncIterator[str]:
+        """
+        在任务完成前产出每次更新的状态消息
+
+        生成器被提前关闭（如浏览器断开）时取消任务。
+
+        Args:
+            task: 处理请求的任务
+            progress: gr.Progress对象，有执行进度时同步更新进度条
+
+        Yields:
+            状态消息
+        """
+        try:
+            while not task.done():
+                changed = asyncio.ensure_future(self._changed.wait())
+                await asyncio.wait(
+                    [task, changed], return_when=asyncio.FIRST_COMPLETED)
+                changed.cancel()
+                if self._changed.is_set() and not task.done():
+                    self._changed.clear()
+                    if progress is not None and self.progress is not None:
+                        progress(self.progress, desc=self.message,
+                                 unit="步")
+                    yield self.message
+        finally:
+            if not task.done():
+                task.cancel()
@@ -0,0 +1,211 @@
+"""
+工作流模板 - 只读的工作流模板和声明式参数绑定，每个请求生成独立的prompt
+"""
+
+import json
+import time
+import uuid
+from pathlib import Path
+from types import MappingProxyType
+from typing import Dict, Any, Iterable, List, Mapping, Tuple, Union
+
+from comfyui_gradio.config import Config
+from comfyui_gradio.utils.logger import setup_logger
+
+# 设置日志
+logger = setup_logger("comfyui-client-logs")
+
+# 工作流文件目录
+WORKFLOW_DIR = Path(__file__).parent.parent.parent / "workflows"
+# 裁剪工作流时保留的输出节点类型，其余输出节点（预览、对比、显示文本等）
+# 及只为它们服务的上游节点在加载时移除
+KEEP_CLASS_TYPES = ["SaveImage", "SaveImageWebsocket", "easy cleanGpuUsed"]
+
+# 参数绑定的目标：(节点ID, 输入名称)，一个参数可以绑定多个目标
+Binding = Union[Tuple[str, str], List[Tuple[str, str]]]
+
+
+class WorkflowTemplate:
+    """
+    只读的工作流模板
+
+    每个服务启动时加载一次工作流，并声明参数名称到(节点ID, 输入名称)的
+    绑定。模板在加载时整体冻结为只读结构（字典为MappingProxyType，列表
+    为tuple），任何一层都无法修改；每个请求通过render()得到一份完全独立
+    的prompt，同一进程中的并发请求不会互相覆盖文件名和提示词。
+    """
+
+    def __init__(self, name: str, workflow: Dict[str, Any],
+                 bindings: Mapping[str, Binding]):
+        """
+        初始化模板
+
+        Args:
+            name: 工作流名称（工作流文件名，不含扩展名）
+            workflow: API格式的工作流
+            bindings: 参数名称到绑定目标的映射
+
+        Raises:
+            ValueError: 绑定的节点或输入在工作流中不存在
+        """
+        self.name = name
+        self._nodes = _freeze(workflow)
+        self._bindings: Dict[str, Tuple[Tuple[str, str], ...]] = {}
+        for param, targets in bindings.items():
+            if isinstance(targets, tuple):
+                targets = [targets]
+            for node_id, input_name in targets:
+                inputs = workflow.get(node_id, {}).get("inputs")
+                if inputs is None or input_name not in inputs:
+                    raise ValueError(
+                        f"工作流{name}中不存在参数{param}绑定的输入: "
+                        f"{node_id}.{input_name}")
+            self._bindings[param] = tuple(
+                (str(node_id), input_name) for node_id, input_name in targets)
+
+    @classmethod
+    def load(cls, name: str,
+             bindings: Mapping[str, Binding]) -> "WorkflowTemplate":
+        """
+        从workflows目录加载工作流模板
+
+        启用workflow_pruning时，只保留workflow_pruning.keep中的输出节点、
+        参数绑定的节点以及它们依赖的上游节点，预览等仅用于界面的节点
+        不再随每个请求在GPU主机上执行和编码图片。
+
+        Args:
+            name: 工作流名称（工作流文件名，不含扩展名）
+            bindings: 参数名称到绑定目标的映射
+
+        Returns:
+            WorkflowTemplate对象
+        """
+        workflow_path = WORKFLOW_DIR / f"{name}.json"
+        with workflow_path.open('r', encoding='utf-8') as f:
+            workflow = json.load(f)
+        if Config.get("workflow_pruning.enabled", True):
+            bound = [
+                node_id
+                for targets in bindings.values()
+                for node_id, _ in (
+                    [targets] if isinstance(targets, tuple) else targets)]
+            pruned = prune_workflow(
+                workflow,
+                Config.get("workflow_pruning.keep", KEEP_CLASS_TYPES),
+                bound)
+            removed = sorted(set(workflow) - set(pruned))
+            if removed:
+                logger.info(
+                    f"工作流{name}已移除{len(removed)}个不影响输出的节点: "
+                    + ", ".join(
+                        f"{node_id}({workflow[node_id].get('class_type')})"
+                        for node_id in removed))
+            workflow = pruned
+        return cls(name, workflow, bindings)
+
+    @property
+    def nodes(self) -> Mapping[str, Any]:
+        """模板中的节点，各层都是只读的"""
+        return self._nodes
+
+    @property
+    def params(self) -> List[str]:
+        """已声明的参数名称"""
+        return list(self._bindings)
+
+    def render(self, **params: Any) -> Dict[str, Any]:
+        """
+        生成填入参数的prompt
+
+        未传入的参数保留工作流文件中的默认值。
+
+        Args:
+            **params: 参数名称和值
+
+        Returns:
+            新的API格式工作流，可以直接提交
+
+        Raises:
+            ValueError: 参数没有声明绑定
+        """
+        unknown = set(params) - set(self._bindings)
+        if unknown:
+            raise ValueError(
+                f"工作流{self.name}没有声明参数: {', '.join(sorted(unknown))}")
+        prompt = _thaw(self._nodes)
+        for param, value in params.items():
+            for node_id, input_name in self._bindings[param]:
+                prompt[node_id]["inputs"][input_name] = value
+        return prompt
+
+    def __contains__(self, node_id: str) -> bool:
+        return node_id in self._nodes
+
+
+def _freeze(value: Any) -> Any:
+    """把工作流转换为只读结构：字典转为MappingProxyType，列表转为tuple"""
+    if isinstance(value, dict):
+        return MappingProxyType(
+            {key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _thaw(value: Any) -> Any:
+    """把只读结构还原为可以修改和提交的字典和列表"""
+    if isinstance(value, MappingProxyType):
+        return {key: _thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(item) for item in value]
+    return value
+
+
+def prune_workflow(workflow: Dict[str, Any], keep_class_types: Iterable[str],
+                   keep_nodes: Iterable[str] = ()) -> Dict[str, Any]:
+    """
+    移除不影响保留节点的节点
+
+    从类型在keep_class_types中的节点和keep_nodes出发，沿输入连接向上
+    收集依赖的节点，其余节点（如PreviewImage及只为它提供输入的节点）
+    全部移除。
+
+    Args:
+        workflow: API格式的工作流
+        keep_class_types: 保留的节点类型，通常是保存结果的输出节点
+        keep_nodes: 额外保留的节点ID，如参数绑定的节点
+
+    Returns:
+        裁剪后的工作流，节点对象与原工作流共享
+    """
+    keep_class_types = set(keep_class_types)
+    pending = [
+        node_id for node_id, node in workflow.items()
+        if node.get("class_type") in keep_class_types]
+    pending.extend(str(node_id) for node_id in keep_nodes)
+    kept = set()
+    while pending:
+        node_id = pending.pop()
+        if node_id in kept or node_id not in workflow:
+            continue
+        kept.add(node_id)
+        for value in workflow[node_id].get("inputs", {}).values():
+            # 连接以[上游节点ID, 输出序号]表示
+            if (isinstance(value, list) and len(value) == 2
+                    and isinstance(value[1], int)):
+                pending.append(str(value[0]))
+    return {
+        node_id: node for node_id, node in workflow.items() if node_id in kept}
+
+
+def new_request_id(prefix: str) -> str:
+    """
+    生成请求ID，同一毫秒内的多个请求也不会重复
+
+    Args:
+        prefix: 服务前缀，如"upscale"
+
+    Returns:
+        形如"upscale_1700000000000_3f2a..."的请求ID
+    """
+    return f"{prefix}_{int(time.time()*1000)}_{uuid.uuid4().hex}"
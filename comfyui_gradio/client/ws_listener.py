@@ -0,0 +1,339 @@
+"""
+执行事件监听 - 通过ComfyUI的/ws接口接收任务完成事件
+"""
+
+import json
+import time
+import struct
+import asyncio
+import threading
+from typing import Dict, Any, List, Optional, Tuple, Callable
+
+import websocket
+
+from comfyui_gradio.utils.logger import setup_logger
+
+# 设置日志
+logger = setup_logger("comfyui-client-logs")
+
+# 无人认领的prompt状态保留时间（秒）
+STATE_RETENTION = 600
+
+# websocket输出模式下替换SaveImage的节点ID前缀，用于识别属于输出的二进制帧
+WS_OUTPUT_NODE_PREFIX = "ws_output_"
+
+# ComfyUI二进制帧类型：预览图（SaveImageWebsocket的输出也使用该类型）
+BINARY_EVENT_PREVIEW_IMAGE = 1
+
+
+class PromptState:
+    """
+    单个prompt的执行状态
+
+    监听线程通过notify()唤醒等待方，等待方在各自的事件循环中await，
+    等待期间不占用线程。
+    """
+
+    def __init__(self):
+        self._notified = False
+        self._waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+        self._lock = threading.Lock()
+        # 是否已收到执行完成事件
+        self.finished = False
+        # 执行出错或被中断时的事件数据
+        self.error: Optional[Dict[str, Any]] = None
+        # 输出节点的结果，键为节点ID
+        self.outputs: Dict[str, Any] = {}
+        # websocket输出节点推送的编码图片
+        self.images: List[bytes] = []
+        # 是否有请求正在等待，等待中的状态不会被清理
+        self.waiting = False
+        self.created_at = time.time()
+        # 开始执行和执行完成的时间，用于学习执行耗时
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # 正在执行的节点ID和该节点的进度(当前步数, 总步数)
+        self.node: Optional[str] = None
+        self.step: Optional[Tuple[int, int]] = None
+        # 采样过程中最新的预览图（编码后的图片），取走后清空
+        self._preview: Optional[bytes] = None
+        # 执行进度的订阅方，回调在订阅方的事件循环中执行
+        self._watchers: List[Tuple[asyncio.AbstractEventLoop, Callable]] = []
+
+    def notify(self) -> None:
+        """唤醒所有等待方，可在任意线程调用"""
+        with self._lock:
+            self._notified = True
+            waiters, self._waiters = self._waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+
+    def watch(self, callback: Callable[["PromptState"], None]) -> None:
+        """
+        订阅执行进度，只能在事件循环中调用
+
+        Args:
+            callback: 节点或步数变化时调用，参数为prompt状态
+        """
+        with self._lock:
+            self._watchers.append((asyncio.get_running_loop(), callback))
+
+    def set_progress(self, node: Optional[str],
+                     step: Optional[Tuple[int, int]] = None) -> None:
+        """更新执行进度并通知订阅方，可在任意线程调用"""
+        with self._lock:
+            self.node = node
+            self.step = step
+        self._notify_watchers()
+
+    def set_preview(self, content: bytes) -> None:
+        """更新预览图并通知订阅方，可在任意线程调用"""
+        with self._lock:
+            self._preview = content
+        self._notify_watchers()
+
+    def take_preview(self) -> Optional[bytes]:
+        """取走最新的预览图，没有新预览图时返回None"""
+        with self._lock:
+            content, self._preview = self._preview, None
+            return content
+
+    def _notify_watchers(self) -> None:
+        """在各订阅方的事件循环中调用回调"""
+        with self._lock:
+            watchers = list(self._watchers)
+        for loop, callback in watchers:
+            try:
+                loop.call_soon_threadsafe(callback, self)
+            except RuntimeError:
+                # 订阅方的事件循环已关闭
+                pass
+
+    @property
+    def notified(self) -> bool:
+        """是否已被唤醒（完成、出错、撤回或事件通道断开）"""
+        return self._notified
+
+    async def wait(self, timeout: float) -> None:
+        """等待被唤醒或超时"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._notified:
+                return
+            future = loop.create_future()
+            self._waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def _resolve(future: asyncio.Future) -> None:
+    """在等待方的事件循环中完成future"""
+    if not future.done():
+        future.set_result(None)
+
+
+class ExecutionListener:
+    """
+    每个后端共享一个的执行事件监听线程
+
+    提交工作流时携带相同的client_id，ComfyUI会把该prompt的执行事件
+    推送到这条WebSocket连接上，收到完成事件后立即唤醒等待的请求。
+    """
+
+    def __init__(self, base_url: str, client_id: str,
+                 reconnect_interval: float = 5.0):
+        """
+        初始化监听器
+
+        Args:
+            base_url: ComfyUI的HTTP地址
+            client_id: 提交工作流时使用的client_id
+            reconnect_interval: 连接断开后的重连间隔（秒）
+        """
+        self.ws_url = (
+            base_url.replace("http", "ws", 1) + f"/ws?clientId={client_id}")
+        self.reconnect_interval = reconnect_interval
+        self.connected = False
+        self._states: Dict[str, PromptState] = {}
+        # 当前正在执行的prompt和节点，用于判断二进制帧的归属
+        self._current_prompt: Optional[str] = None
+        self._current_node: Optional[str] = None
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """启动监听线程（重复调用无副作用）"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run,
+                name="comfyui-ws-listener",
+                daemon=True
+            )
+            self._thread.start()
+
+    async def wait(self, prompt_id: str, timeout: float) -> PromptState:
+        """
+        等待prompt执行完成
+
+        Args:
+            prompt_id: ComfyUI返回的prompt_id
+            timeout: 最长等待时间（秒）
+
+        Returns:
+            prompt状态，finished为False且error为None表示超时、连接已断开或被唤醒
+        """
+        state = self._get_state(prompt_id)
+        state.waiting = True
+        # 未连接时直接返回，由调用方改用轮询
+        if self.connected:
+            await state.wait(timeout)
+        return state
+
+    def watch(self, prompt_id: str,
+              callback: Callable[[PromptState], None]) -> None:
+        """
+        订阅prompt的执行进度（执行中的节点和步数）
+
+        Args:
+            prompt_id: ComfyUI返回的prompt_id
+            callback: 进度变化时在当前事件循环中调用，参数为prompt状态
+        """
+        self._get_state(prompt_id).watch(callback)
+
+    def wake(self, prompt_id: str) -> None:
+        """唤醒等待该prompt的请求，如prompt已从队列中撤回"""
+        self._get_state(prompt_id).notify()
+
+    def discard(self, prompt_id: str) -> None:
+        """释放prompt状态"""
+        with self._lock:
+            self._states.pop(prompt_id, None)
+
+    def _get_state(self, prompt_id: str) -> PromptState:
+        """获取或创建prompt状态，事件可能早于等待方到达"""
+        with self._lock:
+            state = self._states.get(prompt_id)
+            if state is None:
+                state = PromptState()
+                self._states[prompt_id] = state
+            return state
+
+    def _run(self) -> None:
+        """监听线程主循环，断线后自动重连"""
+        while True:
+            ws = None
+            try:
+                ws = websocket.create_connection(self.ws_url, timeout=10)
+                ws.settimeout(None)
+                self.connected = True
+                logger.info(f"已连接ComfyUI事件通道: {self.ws_url}")
+
+                while True:
+                    message = ws.recv()
+                    if isinstance(message, str):
+                        self._handle_message(json.loads(message))
+                    else:
+                        self._handle_binary(message)
+            except Exception as e:
+                if self.connected:
+                    logger.warning(f"ComfyUI事件通道断开: {e}")
+                else:
+                    logger.debug(f"连接ComfyUI事件通道失败: {e}")
+            finally:
+                self.connected = False
+                self._current_prompt = None
+                self._current_node = None
+                if ws is not None:
+                    try:
+                        ws.close()
+                    except Exception:
+                        pass
+                # 唤醒所有等待方，让它们改用轮询
+                self._wake_all()
+
+            time.sleep(self.reconnect_interval)
+
+    def _handle_message(self, message: Dict[str, Any]) -> None:
+        """处理一条执行事件"""
+        event_type = message.get("type")
+        data = message.get("data") or {}
+        prompt_id = data.get("prompt_id")
+        if prompt_id is None and event_type == "progress":
+            # 旧版本ComfyUI的进度事件不带prompt_id
+            prompt_id = self._current_prompt
+        if prompt_id is None:
+            return
+
+        if event_type == "execution_start":
+            self._get_state(prompt_id).started_at = time.time()
+        elif event_type == "executing" and data.get("node") is not None:
+            self._current_prompt = prompt_id
+            self._current_node = str(data.get("node"))
+            self._get_state(prompt_id).set_progress(self._current_node)
+        elif event_type == "progress":
+            node = data.get("node")
+            self._get_state(prompt_id).set_progress(
+                str(node) if node is not None else self._current_node,
+                (int(data.get("value", 0)), int(data.get("max", 0))))
+        elif event_type == "executed":
+            state = self._get_state(prompt_id)
+            state.outputs[str(data.get("node"))] = data.get("output") or {}
+        elif event_type == "execution_success" or (
+                event_type == "executing" and data.get("node") is None):
+            state = self._get_state(prompt_id)
+            state.finished = True
+            state.finished_at = time.time()
+            state.notify()
+            if self._current_prompt == prompt_id:
+                self._current_prompt = None
+                self._current_node = None
+            self._prune()
+        elif event_type in ("execution_error", "execution_interrupted"):
+            state = self._get_state(prompt_id)
+            state.error = dict(data, type=event_type)
+            state.notify()
+            if self._current_prompt == prompt_id:
+                self._current_prompt = None
+                self._current_node = None
+
+    def _handle_binary(self, message: bytes) -> None:
+        """
+        处理二进制帧
+
+        帧格式为4字节事件类型 + 4字节图片格式 + 编码后的图片。
+        websocket输出节点执行期间收到的帧是结果，其余为采样预览图
+        （ComfyUI需以--preview-method启动）。
+        """
+        if len(message) < 8 or self._current_prompt is None:
+            return
+        event_type = struct.unpack(">I", message[:4])[0]
+        if event_type != BINARY_EVENT_PREVIEW_IMAGE:
+            return
+        state = self._get_state(self._current_prompt)
+        if self._current_node and self._current_node.startswith(
+                WS_OUTPUT_NODE_PREFIX):
+            state.images.append(message[8:])
+        else:
+            state.set_preview(message[8:])
+
+    def _wake_all(self) -> None:
+        """唤醒所有等待中的请求"""
+        with self._lock:
+            states = list(self._states.values())
+        for state in states:
+            state.notify()
+
+    def _prune(self) -> None:
+        """清理长时间无人认领的prompt状态"""
+        cutoff = time.time() - STATE_RETENTION
+        with self._lock:
+            expired = [
+                prompt_id for prompt_id, state in self._states.items()
+                if not state.waiting and state.created_at < cutoff
+            ]
+            for prompt_id in expired:
+                del self._states[prompt_id]
@@ -13,12 +13,16 @@ from pathlib import Path
 import gradio as gr
 from PIL import Image
 import time
-import json
-import requests
+import asyncio
+import httpx
 import numpy as np
-from typing import Tuple, Dict, Any
+from typing import Tuple, Dict, Any, AsyncIterator, Optional
 
 from comfyui_gradio.config import Config
+from comfyui_gradio.client import (
+    get_pool, QueueFullError, CircuitOpenError, RequestStatus, get_caller,
+    get_priority, WorkflowTemplate, WorkflowValidationError, new_request_id
+)
 from comfyui_gradio.utils.logger import setup_logger
 from comfyui_gradio.utils.error_reporter import ErrorReporter
 import comfyui_gradio.utils as utils
@@ -30,27 +34,49 @@ error_reporter = ErrorReporter("object-replace", logger)
 
 class FillReplaceApp:
     def __init__(self):
-        self.url = Config.get("comfyui_server.url")
+        self.pool = get_pool()
         self.input_dir = Path(Config.get("paths.input_dir"))
         self.output_dir = Path(Config.get("paths.output_dir"))
         self.clipspace_dir = Path(Config.get("paths.clipspace_dir"))
 
-        # 确保目录存在
-        self.input_dir.mkdir(parents=True, exist_ok=True)
-        self.output_dir.mkdir(parents=True, exist_ok=True)
-        self.clipspace_dir.mkdir(parents=True, exist_ok=True)
-
-        # 加载工作流
-        root_dir = Path(__file__).parent.parent.parent
-        workflow_path = root_dir / "workflows" / "Fill_Replace.json"
-        with workflow_path.open('r', encoding='utf-8') as f:
-            self.workflow = json.load(f)
-
-    def process_image(
+        # 加载工作流模板，每个请求生成独立的prompt
+        self.template = WorkflowTemplate.load("Fill_Replace", {
+            "image": ("145", "image"),
+            "replace_image": ("257", "image"),
+            "filename_prefix": ("259", "filename_prefix"),
+            "prompt": ("216", "prompt"),
+        })
+        self.workflow_name = self.template.name
+        # 按后端的节点定义校验工作流，不匹配时立即告警
+        self.pool.validate(self.template, error_reporter)
+
+    async def process_image(
+            self,
+            input_data: dict,
+            replace_image: Image.Image,
+            prompt: str = "clothes",
+            request: gr.Request = None,
+            progress: gr.Progress = gr.Progress()
+    ) -> AsyncIterator[Tuple[Any, str]]:
+        """处理请求，排队和处理期间把状态推送到状态文本框"""
+        status = RequestStatus(
+            priority=get_priority("fill_replace", request),
+            caller=get_caller(request), service="fill_replace",
+            previews=True)
+        task = asyncio.ensure_future(self._process_image(
+            input_data, replace_image, prompt, status=status))
+        async for message in status.stream(task, progress):
+            # 采样过程中把预览图推送到结果图片
+            preview = status.take_preview()
+            yield (preview if preview is not None else gr.update()), message
+        yield task.result()
+
+    async def _process_image(
             self,
             input_data: dict,
             replace_image: Image.Image,
-            prompt: str = "clothes"
+            prompt: str = "clothes",
+            status: Optional[RequestStatus] = None
     ) -> Tuple[Image.Image, str]:
         try:
             if input_data is None or 'background' not in input_data:
@@ -63,12 +89,12 @@ class FillReplaceApp:
                 return utils.create_error_image(), "未上传替换物体图片"
 
             # 生成唯一请求ID
-            request_id = (
-                f"object_replace_{int(time.time()*1000)}_{os.getpid()}"
-            )
+            request_id = new_request_id("object_replace")
 
             start_time = time.time()
             logger.info(f"开始物体替换 [请求ID: {request_id}]")
+            # 选择ComfyUI后端，本次请求的上传、提交和取结果都使用该后端
+            client = await self.pool.select(self.workflow_name, status=status)
 
             # 获取原图和蒙版图像
             background = Image.fromarray(input_data['background'])
@@ -99,45 +125,38 @@ class FillReplaceApp:
                 Image.new('L', background.size, 0), alpha, mask_image)
             combined_image.putalpha(alpha)  # 将修改后的alpha通道应用回合成图像
 
-            # 保存合成后的图片和替换图
+            # 上传合成后的图片和替换图
             combined_filename = f"{request_id}_combined.png"
             replace_filename = f"{request_id}_replace.png"
 
-            combined_path = self.clipspace_dir / combined_filename
-            replace_path = self.clipspace_dir / replace_filename
-
-            combined_image.save(combined_path)
+            combined_rel_path = await client.upload_image(
+                combined_image, combined_filename, self.clipspace_dir,
+                subfolder="clipspace")
 
             # 确保 replace_image 是 PIL Image 对象
             if isinstance(replace_image, np.ndarray):
                 replace_image = Image.fromarray(replace_image)
-            replace_image.save(replace_path)
-
-            logger.info(f"保存合并后的图片 [请求ID: {request_id}]: {combined_path}")
-            logger.info(f"保存替换图 [请求ID: {request_id}]: {replace_path}")
-
-            # 更新工作流中的路径和参数
-            clipspace_relative = "clipspace"
-            combined_rel_path = f"{clipspace_relative}/{combined_filename}"
-            replace_rel_path = f"{clipspace_relative}/{replace_filename}"
-
-            # 更新工作流配置
-            # 更新LoadImage节点的图像路径
-            self.workflow["145"]["inputs"]["image"] = combined_rel_path
-
-            # 更新替换图的LoadImage节点路径
-            self.workflow["257"]["inputs"]["image"] = replace_rel_path
-
-            # 设置SaveImage节点的filename_prefix参数
-            self.workflow["259"]["inputs"]["filename_prefix"] = request_id
-
-            # 更新SegmentAnythingUltra节点的prompt参数
-            self.workflow["216"]["inputs"]["prompt"] = prompt
+            replace_rel_path = await client.upload_image(
+                replace_image, replace_filename, self.clipspace_dir,
+                subfolder="clipspace")
+
+            logger.info(f"保存合并后的图片 [请求ID: {request_id}]: {combined_rel_path}")
+            logger.info(f"保存替换图 [请求ID: {request_id}]: {replace_rel_path}")
+
+            # 生成本次请求的工作流
+            workflow = self.template.render(
+                # LoadImage节点的图像路径
+                image=combined_rel_path,
+                # 替换图的LoadImage节点路径
+                replace_image=replace_rel_path,
+                # SaveImage节点的filename_prefix参数
+                filename_prefix=request_id,
+                # SegmentAnythingUltra节点的prompt参数
+                prompt=prompt)
 
             # 创建带蒙版的clipspace图像格式
             # 使用ComfyUI约定的clipspace格式保存原图和蒙版
             combined_filename = f"clipspace-mask-{request_id}.png"
-            combined_path = self.clipspace_dir / combined_filename
 
             # 将原图和蒙版组合成ComfyUI能识别的格式
             combined = Image.new('RGBA', background.size)
@@ -149,20 +168,21 @@ class FillReplaceApp:
             # 设置alpha通道 - 确保标记区域是要替换的区域
             r, g, b = combined.split()[:3]
             combined = Image.merge('RGBA', (r, g, b, mask_resized))
-            combined.save(combined_path)
+            combined_path = await client.upload_image(
+                combined, combined_filename, self.clipspace_dir,
+                subfolder="clipspace")
 
             logger.info(f"保存合并图片 [请求ID: {request_id}]: {combined_path}")
 
             # 发送请求到ComfyUI
             try:
-                response = requests.post(
-                    self.url,
-                    json={"prompt": self.workflow},
-                    timeout=Config.get("comfyui_server.timeout", 3000)
-                )
-                response.raise_for_status()
-                logger.info(f"已发送请求到ComfyUI [请求ID: {request_id}]")
-            except requests.exceptions.RequestException as e:
+                prompt_id = await client.submit(
+                    workflow, request_id, self.workflow_name,
+                    status=status)
+                logger.info(
+                    f"已发送请求到ComfyUI [请求ID: {request_id}, "
+                    f"prompt_id: {prompt_id}]")
+            except httpx.HTTPError as e:
                 error_context = {
                     "请求ID": request_id,
                     "替换提示词": prompt
@@ -171,54 +191,33 @@ class FillReplaceApp:
                 return utils.create_error_image(), f"ComfyUI请求失败: {str(e)}"
 
             # 等待处理结果
-            max_retries = 6000
-            retry_count = 0
-
-            while retry_count < max_retries:
-                try:
-                    # 查找以请求ID为前缀的输出文件
-                    output_files = list(
-                        self.output_dir.glob(f"{request_id}*.png"))
-                    if output_files:
-                        output_path = output_files[0]
-                        # 确保文件写入完成
-                        time.sleep(0.5)
-
-                        with Image.open(output_path) as img:
-                            output_image = img.copy()
-
-                        process_time = time.time() - start_time
-                        logger.info(
-                            f"处理完成 [请求ID: {request_id}], "
-                            f"耗时: {process_time:.2f}秒")
-                        logger.info(f"输出图片: {output_path}")
-                        logger.info(f"图片模式: {output_image.mode}")
-                        logger.info(f"图片大小: {output_image.size}")
-
-                        return output_image, "处理成功"
-
-                except Exception as e:
-                    logger.error(f"图片加载失败 [请求ID: {request_id}]: {e}")
-                    time.sleep(1)
-                    retry_count += 1
-                    continue
-
-                time.sleep(1)
-                retry_count += 1
-                if retry_count % 10 == 0:
-                    logger.info(
-                        f"等待处理结果 [请求ID: {request_id}]: "
-                        f"{retry_count}/{max_retries}")
-
-            error_context = {
-                "请求ID": request_id,
-                "已等待": f"{retry_count}秒",
-                "输出路径": str(self.output_dir),
-                "替换提示词": prompt
-            }
-            error_reporter.report("处理超时", None, error_context)
-            return utils.create_error_image(), "处理超时"
-
+            try:
+                output_image, output_path = await client.wait_for_image(
+                    prompt_id, request_id, self.output_dir)
+            except TimeoutError:
+                error_context = {
+                    "请求ID": request_id,
+                    "已等待": f"{time.time() - start_time:.0f}秒",
+                    "输出路径": str(self.output_dir),
+                    "替换提示词": prompt
+                }
+                error_reporter.report("处理超时", None, error_context)
+                return utils.create_error_image(), "处理超时"
+
+            process_time = time.time() - start_time
+            logger.info(
+                f"处理完成 [请求ID: {request_id}], "
+                f"耗时: {process_time:.2f}秒")
+            logger.info(f"输出图片: {output_path}")
+            logger.info(f"图片模式: {output_image.mode}")
+            logger.info(f"图片大小: {output_image.size}")
+
+            return output_image, "处理成功"
+
+        except (QueueFullError, CircuitOpenError,
+                WorkflowValidationError) as e:
+            logger.warning(f"请求被拒绝: {e}")
+            return utils.create_error_image(), str(e)
         except Exception as e:
             error_reporter.report("处理失败", e, {"替换提示词": prompt})
             return utils.create_error_image(), f"处理失败: {str(e)}"
@@ -247,7 +246,9 @@ def create_interface() -> Dict[str, Any]:
                 placeholder="例如：衣服、猫、狗、汽车等",
                 info="请输入要替换的物体名称，用于精确识别蒙版区域"
             )
-            process_btn = gr.Button("开始处理", variant="primary")
+            with gr.Row():
+                process_btn = gr.Button("开始处理", variant="primary")
+                abort_btn = gr.Button("中止", variant="stop")
 
         with gr.Column(scale=1):
             output_image = gr.Image(
@@ -259,7 +260,7 @@ def create_interface() -> Dict[str, Any]:
             status_text = gr.Textbox(label="处理状态")
 
     # 设置事件处理
-    process_btn.click(
+    process_event = process_btn.click(
         fn=app.process_image,
         inputs=[
             input_editor,
@@ -269,7 +270,16 @@ def create_interface() -> Dict[str, Any]:
         outputs=[
             output_image,
             status_text,
-        ]
+        ],
+        concurrency_limit=Config.get(
+            "gradio_server.concurrency_limit", 200)
+    )
+    # 中止时取消处理事件，ComfyUI中对应的prompt随之被删除或中断
+    abort_btn.click(
+        fn=lambda: "已中止",
+        outputs=[status_text],
+        cancels=[process_event],
+        queue=False
     )
 
     return {
@@ -277,6 +287,7 @@ def create_interface() -> Dict[str, Any]:
         "replace_image": replace_image,
         "object_name": object_name,
         "process_btn": process_btn,
+        "abort_btn": abort_btn,
         "output_image": output_image,
         "status_text": status_text
     }
@@ -7,9 +7,13 @@ from comfyui_gradio.utils.error_reporter import ErrorReporter
 from comfyui_gradio.utils.logger import setup_logger
 from comfyui_gradio.utils.image_processor import ImageProcessor
 from comfyui_gradio.config import Config
-from typing import Tuple, Dict, Any
-import requests
-import json
+from comfyui_gradio.client import (
+    get_pool, QueueFullError, CircuitOpenError, RequestStatus, get_caller,
+    get_priority, WorkflowTemplate, WorkflowValidationError, new_request_id
+)
+from typing import Tuple, Dict, Any, AsyncIterator, Optional
+import httpx
+import asyncio
 import time
 from PIL import Image
 import gradio as gr
@@ -29,31 +33,48 @@ error_reporter = ErrorReporter("image-upscale", logger)
 
 class ImageUpscaleApp:
     def __init__(self):
-        self.url = Config.get("comfyui_server.url")
+        self.pool = get_pool()
         self.input_dir = Path(Config.get("paths.input_dir"))
         self.output_dir = Path(Config.get("paths.output_dir"))
 
-        # 确保目录存在
-        self.input_dir.mkdir(parents=True, exist_ok=True)
-        self.output_dir.mkdir(parents=True, exist_ok=True)
-
-        # 加载工作流
-        root_dir = Path(__file__).parent.parent.parent
-        workflow_path = root_dir / "workflows" / "2_Image_Upscale_TTP.json"
-        with workflow_path.open('r', encoding='utf-8') as f:
-            self.workflow = json.load(f)
-
-    def process_image(
-            self, input_image: Image.Image, denoise: float = 0.25) -> Tuple[Image.Image, str]:
+        # 加载工作流模板，每个请求生成独立的prompt
+        self.template = WorkflowTemplate.load("2_Image_Upscale_TTP", {
+            "image": ("10", "image"),
+            "filename_prefix": ("34", "filename_prefix"),
+            "denoise": ("9", "denoise"),
+        })
+        self.workflow_name = self.template.name
+        # 按后端的节点定义校验工作流，不匹配时立即告警
+        self.pool.validate(self.template, error_reporter)
+
+    async def process_image(
+            self, input_image: Image.Image, denoise: float = 0.25,
+            request: gr.Request = None,
+            progress: gr.Progress = gr.Progress()) -> AsyncIterator[Tuple[Any, str]]:
+        """处理请求，排队和处理期间把状态推送到状态文本框"""
+        status = RequestStatus(
+            priority=get_priority("image_upscale", request),
+            caller=get_caller(request), service="image_upscale")
+        task = asyncio.ensure_future(self._process_image(
+            input_image, denoise, status=status))
+        async for message in status.stream(task, progress):
+            yield gr.update(), message
+        yield task.result()
+
+    async def _process_image(
+            self, input_image: Image.Image, denoise: float = 0.25,
+            status: Optional[RequestStatus] = None) -> Tuple[Image.Image, str]:
         try:
             if input_image is None:
                 return utils.create_error_image(), "未上传图片"
 
             # 生成唯一请求ID
-            request_id = f"upscale_{int(time.time()*1000)}_{os.getpid()}"
+            request_id = new_request_id("upscale")
 
             start_time = time.time()
             logger.info(f"开始图片放大 [请求ID: {request_id}]")
+            # 选择ComfyUI后端，本次请求的上传、提交和取结果都使用该后端
+            client = await self.pool.select(self.workflow_name, status=status)
 
             # 检查图像尺寸，如果太大则自动缩放
             max_size = Config.get("image_processing.max_size", 1600)
@@ -76,31 +97,29 @@ class ImageUpscaleApp:
 
             # 保存上传的图片
             input_filename = f"{request_id}_input.png"
-            input_path = self.input_dir / input_filename
-            input_image.save(input_path)
+            input_path = await client.upload_image(
+                input_image, input_filename, self.input_dir)
             logger.info(f"保存输入图片 [请求ID: {request_id}]: {input_path}")
 
-            # 更新工作流中的路径和参数
-            # 更新LoadImage节点的图像路径
-            self.workflow["10"]["inputs"]["image"] = input_filename
-
-            # 设置SaveImage节点的filename_prefix参数
-            self.workflow["34"]["inputs"]["filename_prefix"] = request_id
-
-            # 更新BasicScheduler节点的denoise参数
-            self.workflow["9"]["inputs"]["denoise"] = float(denoise)
+            # 生成本次请求的工作流
+            workflow = self.template.render(
+                # LoadImage节点的图像路径
+                image=input_path,
+                # SaveImage节点的filename_prefix参数
+                filename_prefix=request_id,
+                # BasicScheduler节点的denoise参数
+                denoise=float(denoise))
             logger.info(f"重绘幅度: {denoise}")
 
             # 发送请求到ComfyUI
             try:
-                response = requests.post(
-                    self.url,
-                    json={"prompt": self.workflow},
-                    timeout=Config.get("comfyui_server.timeout", 3000)
-                )
-                response.raise_for_status()
-                logger.info(f"已发送请求到ComfyUI [请求ID: {request_id}]")
-            except requests.exceptions.RequestException as e:
+                prompt_id = await client.submit(
+                    workflow, request_id, self.workflow_name,
+                    status=status)
+                logger.info(
+                    f"已发送请求到ComfyUI [请求ID: {request_id}, "
+                    f"prompt_id: {prompt_id}]")
+            except httpx.HTTPError as e:
                 error_context = {
                     "请求ID": request_id,
                     "输入图片": input_filename,
@@ -110,57 +129,36 @@ class ImageUpscaleApp:
                 return utils.create_error_image(), f"ComfyUI请求失败: {str(e)}"
 
             # 等待处理结果
-            max_retries = 6000
-            retry_count = 0
-
-            while retry_count < max_retries:
-                try:
-                    # 查找以请求ID为前缀的输出文件
-                    output_files = list(
-                        self.output_dir.glob(f"{request_id}*.png"))
-                    if output_files:
-                        output_path = output_files[0]
-                        # 确保文件写入完成
-                        time.sleep(0.5)
-
-                        with Image.open(output_path) as img:
-                            output_image = img.copy()
-
-                        process_time = time.time() - start_time
-                        logger.info(
-                            f"处理完成 [请求ID: {request_id}], "
-                            f"耗时: {process_time:.2f}秒")
-                        logger.info(f"输出图片: {output_path}")
-
-                        # 构建状态信息
-                        status_msg = "处理成功"
-                        if resize_msg:
-                            status_msg = f"{resize_msg}\n{status_msg}"
-
-                        return output_image, status_msg
-
-                except Exception as e:
-                    logger.error(f"图片加载失败 [请求ID: {request_id}]: {e}")
-                    time.sleep(1)
-                    retry_count += 1
-                    continue
-
-                time.sleep(1)
-                retry_count += 1
-                if retry_count % 10 == 0:
-                    logger.info(
-                        f"等待处理结果 [请求ID: {request_id}]: "
-                        f"{retry_count}/{max_retries}")
-
-            error_context = {
-                "请求ID": request_id,
-                "已等待": f"{retry_count}秒",
-                "输出路径": str(self.output_dir),
-                "重绘幅度": denoise
-            }
-            error_reporter.report("处理超时", None, error_context)
-            return utils.create_error_image(), "处理超时"
-
+            try:
+                output_image, output_path = await client.wait_for_image(
+                    prompt_id, request_id, self.output_dir)
+            except TimeoutError:
+                error_context = {
+                    "请求ID": request_id,
+                    "已等待": f"{time.time() - start_time:.0f}秒",
+                    "输出路径": str(self.output_dir),
+                    "重绘幅度": denoise
+                }
+                error_reporter.report("处理超时", None, error_context)
+                return utils.create_error_image(), "处理超时"
+
+            process_time = time.time() - start_time
+            logger.info(
+                f"处理完成 [请求ID: {request_id}], "
+                f"耗时: {process_time:.2f}秒")
+            logger.info(f"输出图片: {output_path}")
+
+            # 构建状态信息
+            status_msg = "处理成功"
+            if resize_msg:
+                status_msg = f"{resize_msg}\n{status_msg}"
+
+            return output_image, status_msg
+
+        except (QueueFullError, CircuitOpenError,
+                WorkflowValidationError) as e:
+            logger.warning(f"请求被拒绝: {e}")
+            return utils.create_error_image(), str(e)
         except Exception as e:
             error_reporter.report("处理失败", e, {"重绘幅度": denoise})
             return utils.create_error_image(), f"处理失败: {str(e)}"
@@ -188,7 +186,9 @@ def create_interface() -> Dict[str, Any]:
                 label="重绘幅度",
                 info="调整放大图像后细节改变的幅度，值越大细节改变幅度越大 (0 到 1)"
             )
-            process_btn = gr.Button("开始处理", variant="primary")
+            with gr.Row():
+                process_btn = gr.Button("开始处理", variant="primary")
+                abort_btn = gr.Button("中止", variant="stop")
 
         with gr.Column(scale=1):
             output_image = gr.Image(
@@ -200,16 +200,26 @@ def create_interface() -> Dict[str, Any]:
             status_text = gr.Textbox(label="处理状态")
 
     # 设置事件处理
-    process_btn.click(
+    process_event = process_btn.click(
         fn=app.process_image,
         inputs=[input_image, denoise_slider],
-        outputs=[output_image, status_text]
+        outputs=[output_image, status_text],
+        concurrency_limit=Config.get(
+            "gradio_server.concurrency_limit", 200)
+    )
+    # 中止时取消处理事件，ComfyUI中对应的prompt随之被删除或中断
+    abort_btn.click(
+        fn=lambda: "已中止",
+        outputs=[status_text],
+        cancels=[process_event],
+        queue=False
     )
 
     return {
         "input_image": input_image,
         "denoise_slider": denoise_slider,
         "process_btn": process_btn,
+        "abort_btn": abort_btn,
         "output_image": output_image,
         "status_text": status_text
     }
@@ -13,11 +13,15 @@ from pathlib import Path
 import gradio as gr
 from PIL import Image
 import time
-import json
-import requests
-from typing import Tuple, Dict, Any
+import asyncio
+import httpx
+from typing import Tuple, Dict, Any, AsyncIterator, Optional
 
 from comfyui_gradio.config import Config
+from comfyui_gradio.client import (
+    get_pool, QueueFullError, CircuitOpenError, RequestStatus, get_caller,
+    get_priority, WorkflowTemplate, WorkflowValidationError, new_request_id
+)
 from comfyui_gradio.utils.logger import setup_logger
 from comfyui_gradio.utils.error_reporter import ErrorReporter
 import comfyui_gradio.utils as utils
@@ -29,24 +33,41 @@ error_reporter = ErrorReporter("remove-object", logger)
 
 class RemoveObjectApp:
     def __init__(self):
-        self.url = Config.get("comfyui_server.url")
+        self.pool = get_pool()
         self.input_dir = Path(Config.get("paths.input_dir"))
         self.output_dir = Path(Config.get("paths.output_dir"))
 
-        # 确保目录存在
-        self.input_dir.mkdir(parents=True, exist_ok=True)
-        self.output_dir.mkdir(parents=True, exist_ok=True)
-
-        # 加载工作流
-        root_dir = Path(__file__).parent.parent.parent
-        workflow_path = root_dir / "workflows" / "Remove_Object.json"
-        with workflow_path.open('r', encoding='utf-8') as f:
-            self.workflow = json.load(f)
-
-    def process_image(self,
-                      input_image: Image.Image,
-                      prompt: str,
-                      mask_expand: int = 30) -> Tuple[Image.Image, str]:
+        # 加载工作流模板，每个请求生成独立的prompt
+        self.template = WorkflowTemplate.load("Remove_Object", {
+            "image": ("36", "image"),
+            "mask_expand": ("47", "expand"),
+            "filename_prefix": ("154", "filename_prefix"),
+        })
+        self.workflow_name = self.template.name
+        # 按后端的节点定义校验工作流，不匹配时立即告警
+        self.pool.validate(self.template, error_reporter)
+
+    async def process_image(self,
+                            input_image: Image.Image,
+                            prompt: str,
+                            mask_expand: int = 30,
+                            request: gr.Request = None,
+                            progress: gr.Progress = gr.Progress()) -> AsyncIterator[Tuple[Any, str]]:
+        """处理请求，排队和处理期间把状态推送到状态文本框"""
+        status = RequestStatus(
+            priority=get_priority("remove_object", request),
+            caller=get_caller(request), service="remove_object")
+        task = asyncio.ensure_future(self._process_image(
+            input_image, prompt, mask_expand, status=status))
+        async for message in status.stream(task, progress):
+            yield gr.update(), message
+        yield task.result()
+
+    async def _process_image(self,
+                             input_image: Image.Image,
+                             prompt: str,
+                             mask_expand: int = 30,
+                             status: Optional[RequestStatus] = None) -> Tuple[Image.Image, str]:
         try:
             if input_image is None:
                 return utils.create_error_image(), "未上传图片"
@@ -55,43 +76,40 @@ class RemoveObjectApp:
                 return utils.create_error_image(), "请输入要移除的物体描述"
 
             # 生成唯一请求ID
-            request_id = f"remove_object_{int(time.time()*1000)}_{os.getpid()}"
+            request_id = new_request_id("remove_object")
 
             start_time = time.time()
             logger.info(f"开始物体移除 [请求ID: {request_id}]")
+            # 选择ComfyUI后端，本次请求的上传、提交和取结果都使用该后端
+            client = await self.pool.select(self.workflow_name, status=status)
             logger.info(f"物体描述: {prompt}")
             logger.info(f"蒙版扩展值: {mask_expand}")
 
             # 保存上传的图片
             input_filename = f"{request_id}_input.png"
-            input_path = self.input_dir / input_filename
-            input_image.save(input_path)
+            input_path = await client.upload_image(
+                input_image, input_filename, self.input_dir)
             logger.info(f"保存输入图片 [请求ID: {request_id}]: {input_path}")
 
-            # 更新工作流中的路径和参数
-            # 更新LoadImage节点的图像路径
-            self.workflow["36"]["inputs"]["image"] = input_filename
-
-            # 更新CLIPTextEncode节点的text参数
-            # 注意：工作流文件中没有SegmentAnythingUltra节点，所以这里暂时不做修改
-            # self.workflow["8"]["inputs"]["prompt"] = prompt
-
-            # 更新MaskExpand节点的扩展值
-            self.workflow["47"]["inputs"]["expand"] = mask_expand
-
-            # 设置SaveImage节点的filename_prefix参数
-            self.workflow["154"]["inputs"]["filename_prefix"] = request_id
+            # 生成本次请求的工作流
+            # 注意：工作流文件中没有SegmentAnythingUltra节点，所以不绑定prompt参数
+            workflow = self.template.render(
+                # LoadImage节点的图像路径
+                image=input_path,
+                # MaskExpand节点的扩展值
+                mask_expand=mask_expand,
+                # SaveImage节点的filename_prefix参数
+                filename_prefix=request_id)
 
             # 发送请求到ComfyUI
             try:
-                response = requests.post(
-                    self.url,
-                    json={"prompt": self.workflow},
-                    timeout=Config.get("comfyui_server.timeout", 3000)
-                )
-                response.raise_for_status()
-                logger.info(f"已发送请求到ComfyUI [请求ID: {request_id}]")
-            except requests.exceptions.RequestException as e:
+                prompt_id = await client.submit(
+                    workflow, request_id, self.workflow_name,
+                    status=status)
+                logger.info(
+                    f"已发送请求到ComfyUI [请求ID: {request_id}, "
+                    f"prompt_id: {prompt_id}]")
+            except httpx.HTTPError as e:
                 error_context = {
                     "请求ID": request_id,
                     "物体描述": prompt,
@@ -101,53 +119,32 @@ class RemoveObjectApp:
                 return utils.create_error_image(), f"ComfyUI请求失败: {str(e)}"
 
             # 等待处理结果
-            max_retries = 6000
-            retry_count = 0
-
-            while retry_count < max_retries:
-                try:
-                    # 查找以请求ID为前缀的输出文件
-                    output_files = list(
-                        self.output_dir.glob(f"{request_id}*.png"))
-                    if output_files:
-                        output_path = output_files[0]
-                        # 确保文件写入完成
-                        time.sleep(0.5)
-
-                        with Image.open(output_path) as img:
-                            output_image = img.copy()
-
-                        process_time = time.time() - start_time
-                        logger.info(
-                            f"处理完成 [请求ID: {request_id}], "
-                            f"耗时: {process_time:.2f}秒")
-                        logger.info(f"输出图片: {output_path}")
-
-                        return output_image, "处理成功"
-
-                except Exception as e:
-                    logger.error(f"图片加载失败 [请求ID: {request_id}]: {e}")
-                    time.sleep(1)
-                    retry_count += 1
-                    continue
-
-                time.sleep(1)
-                retry_count += 1
-                if retry_count % 10 == 0:
-                    logger.info(
-                        f"等待处理结果 [请求ID: {request_id}]: "
-                        f"{retry_count}/{max_retries}")
+            try:
+                output_image, output_path = await client.wait_for_image(
+                    prompt_id, request_id, self.output_dir)
+            except TimeoutError:
+                error_context = {
+                    "请求ID": request_id,
+                    "已等待": f"{time.time() - start_time:.0f}秒",
+                    "输出路径": str(self.output_dir),
+                    "物体描述": prompt,
+                    "蒙版扩展值": mask_expand
+                }
+                error_reporter.report("处理超时", None, error_context)
+                return utils.create_error_image(), "处理超时"
 
-            error_context = {
-                "请求ID": request_id,
-                "已等待": f"{retry_count}秒",
-                "输出路径": str(self.output_dir),
-                "物体描述": prompt,
-                "蒙版扩展值": mask_expand
-            }
-            error_reporter.report("处理超时", None, error_context)
-            return utils.create_error_image(), "处理超时"
+            process_time = time.time() - start_time
+            logger.info(
+                f"处理完成 [请求ID: {request_id}], "
+                f"耗时: {process_time:.2f}秒")
+            logger.info(f"输出图片: {output_path}")
+
+            return output_image, "处理成功"
 
+        except (QueueFullError, CircuitOpenError,
+                WorkflowValidationError) as e:
+            logger.warning(f"请求被拒绝: {e}")
+            return utils.create_error_image(), str(e)
         except Exception as e:
             error_context = {
                 "物体描述": prompt,
@@ -182,7 +179,9 @@ def create_interface() -> Dict[str, Any]:
                 label="蒙版扩展值",
                 info="调整蒙版扩展的像素值，值越大扩展越多 (0 到 100)"
             )
-            process_btn = gr.Button("开始处理", variant="primary")
+            with gr.Row():
+                process_btn = gr.Button("开始处理", variant="primary")
+                abort_btn = gr.Button("中止", variant="stop")
 
         with gr.Column(scale=1):
             output_image = gr.Image(
@@ -194,7 +193,7 @@ def create_interface() -> Dict[str, Any]:
             status_text = gr.Textbox(label="处理状态")
 
     # 设置事件处理
-    process_btn.click(
+    process_event = process_btn.click(
         fn=app.process_image,
         inputs=[
             input_image,
@@ -204,7 +203,16 @@ def create_interface() -> Dict[str, Any]:
         outputs=[
             output_image,
             status_text,
-        ]
+        ],
+        concurrency_limit=Config.get(
+            "gradio_server.concurrency_limit", 200)
+    )
+    # 中止时取消处理事件，ComfyUI中对应的prompt随之被删除或中断
+    abort_btn.click(
+        fn=lambda: "已中止",
+        outputs=[status_text],
+        cancels=[process_event],
+        queue=False
     )
 
     return {
@@ -212,6 +220,7 @@ def create_interface() -> Dict[str, Any]:
         "prompt": prompt,
         "mask_expand": mask_expand,
         "process_btn": process_btn,
+        "abort_btn": abort_btn,
         "output_image": output_image,
         "status_text": status_text
     }
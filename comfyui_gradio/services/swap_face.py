@@ -2,23 +2,27 @@
 人脸替换服务 - 将图片中的人脸替换为另一张图片中的人脸
 """
 
-import json
+import asyncio
 import os
 import sys
 import time
 from pathlib import Path
-from typing import Tuple, Dict, Any
+from typing import Tuple, Dict, Any, AsyncIterator, Optional
 
 # 添加项目根目录到Python路径
 root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
 sys.path.insert(0, root_dir)
 
 import gradio as gr
-import requests
+import httpx
 import numpy as np
 from PIL import Image
 
 from comfyui_gradio.config import Config
+from comfyui_gradio.client import (
+    get_pool, QueueFullError, CircuitOpenError, RequestStatus, get_caller,
+    get_priority, WorkflowTemplate, WorkflowValidationError, new_request_id
+)
 from comfyui_gradio.utils.logger import setup_logger
 from comfyui_gradio.utils.error_reporter import ErrorReporter
 import comfyui_gradio.utils as utils
@@ -30,26 +34,44 @@ error_reporter = ErrorReporter("face-swap", logger)
 
 class SwapFaceApp:
     def __init__(self):
-        self.url = Config.get("comfyui_server.url")
+        self.pool = get_pool()
         self.input_dir = Path(Config.get("paths.input_dir"))
         self.output_dir = Path(Config.get("paths.output_dir"))
         self.clipspace_dir = Path(Config.get("paths.clipspace_dir"))
 
-        # 确保目录存在
-        self.input_dir.mkdir(parents=True, exist_ok=True)
-        self.output_dir.mkdir(parents=True, exist_ok=True)
-        self.clipspace_dir.mkdir(parents=True, exist_ok=True)
-
-        # 加载工作流
-        root_dir = Path(__file__).parent.parent.parent
-        workflow_path = root_dir / "workflows" / "Fill_Replace_Swap_Face.json"
-        with workflow_path.open('r', encoding='utf-8') as f:
-            self.workflow = json.load(f)
-
-    def process_image(
+        # 加载工作流模板，每个请求生成独立的prompt
+        self.template = WorkflowTemplate.load("Fill_Replace_Swap_Face", {
+            "image": ("145", "image"),
+            "face_image": ("257", "image"),
+            "prompt": ("216", "prompt"),
+            "filename_prefix": ("259", "filename_prefix"),
+        })
+        self.workflow_name = self.template.name
+        # 按后端的节点定义校验工作流，不匹配时立即告警
+        self.pool.validate(self.template, error_reporter)
+
+    async def process_image(
+            self,
+            input_data: dict,  # 源图像(带绘制的面部区域)
+            face_image: Image.Image,   # 目标人脸图像
+            request: gr.Request = None,
+            progress: gr.Progress = gr.Progress()
+    ) -> AsyncIterator[Tuple[Any, str]]:
+        """处理请求，排队和处理期间把状态推送到状态文本框"""
+        status = RequestStatus(
+            priority=get_priority("swap_face", request),
+            caller=get_caller(request), service="swap_face")
+        task = asyncio.ensure_future(self._process_image(
+            input_data, face_image, status=status))
+        async for message in status.stream(task, progress):
+            yield gr.update(), message
+        yield task.result()
+
+    async def _process_image(
             self,
             input_data: dict,  # 源图像(带绘制的面部区域)
             face_image: Image.Image,   # 目标人脸图像
+            status: Optional[RequestStatus] = None
     ) -> Tuple[Image.Image, str]:
         try:
             if input_data is None or 'background' not in input_data:
@@ -62,12 +84,12 @@ class SwapFaceApp:
                 return utils.create_error_image(), "未上传目标人脸图片"
 
             # 生成唯一请求ID
-            request_id = (
-                f"face_swap_{int(time.time()*1000)}_{os.getpid()}"
-            )
+            request_id = new_request_id("face_swap")
 
             start_time = time.time()
             logger.info(f"开始人脸替换 [请求ID: {request_id}]")
+            # 选择ComfyUI后端，本次请求的上传、提交和取结果都使用该后端
+            client = await self.pool.select(self.workflow_name, status=status)
 
             # 获取原图和蒙版图像
             background = Image.fromarray(input_data['background'])
@@ -95,47 +117,38 @@ class SwapFaceApp:
                 Image.new('L', background.size, 0), alpha, mask_image)
             combined_image.putalpha(alpha)  # 将修改后的alpha通道应用回合成图像
             
-            # 保存合成后的图片和替换图
+            # 上传合成后的图片和替换图
             combined_filename = f"{request_id}_combined.png"
             face_filename = f"{request_id}_face.png"
             
-            combined_path = self.clipspace_dir / combined_filename
-            face_path = self.clipspace_dir / face_filename
-            
-            combined_image.save(combined_path)
+            combined_rel_path = await client.upload_image(
+                combined_image, combined_filename, self.clipspace_dir,
+                subfolder="clipspace")
             
             # 确保 face_image 是 PIL Image 对象
             if isinstance(face_image, np.ndarray):
                 face_image = Image.fromarray(face_image)
-            face_image.save(face_path)
-            
-            logger.info(f"保存合并后的图片 [请求ID: {request_id}]: {combined_path}")
-            logger.info(f"保存目标人脸图片 [请求ID: {request_id}]: {face_path}")
-
-            # 更新工作流中的路径和参数
-            clipspace_relative = "clipspace"
-            combined_rel_path = f"{clipspace_relative}/{combined_filename}"
-            face_rel_path = f"{clipspace_relative}/{face_filename}"
+            face_rel_path = await client.upload_image(
+                face_image, face_filename, self.clipspace_dir,
+                subfolder="clipspace")
             
-            # 更新工作流配置
-            # 更新LoadImage节点的图像路径 - 源图像
-            self.workflow["145"]["inputs"]["image"] = combined_rel_path
-            
-            # 更新LoadImage节点的图像路径 - 目标人脸图像
-            self.workflow["257"]["inputs"]["image"] = face_rel_path
-            
-            # 更新人脸检测相关参数
-            if "216" in self.workflow:
+            logger.info(f"保存合并后的图片 [请求ID: {request_id}]: {combined_rel_path}")
+            logger.info(f"保存目标人脸图片 [请求ID: {request_id}]: {face_rel_path}")
+
+            # 生成本次请求的工作流
+            workflow = self.template.render(
+                # LoadImage节点的图像路径 - 源图像
+                image=combined_rel_path,
+                # LoadImage节点的图像路径 - 目标人脸图像
+                face_image=face_rel_path,
                 # 使用"face"作为提示词，帮助模型识别面部区域
-                self.workflow["216"]["inputs"]["prompt"] = "face"
-            
-            # 设置SaveImage节点的filename_prefix参数
-            self.workflow["259"]["inputs"]["filename_prefix"] = request_id
+                prompt="face",
+                # SaveImage节点的filename_prefix参数
+                filename_prefix=request_id)
             
             # 创建带蒙版的clipspace图像格式
             # 使用ComfyUI约定的clipspace格式保存原图和蒙版
             clipspace_filename = f"clipspace-mask-{request_id}.png"
-            clipspace_path = self.clipspace_dir / clipspace_filename
             
             # 将原图和蒙版组合成ComfyUI能识别的格式
             combined = Image.new('RGBA', background.size)
@@ -147,20 +160,21 @@ class SwapFaceApp:
             # 设置alpha通道 - 确保标记区域是要替换的区域
             r, g, b = combined.split()[:3]
             combined = Image.merge('RGBA', (r, g, b, mask_resized))
-            combined.save(clipspace_path)
+            clipspace_path = await client.upload_image(
+                combined, clipspace_filename, self.clipspace_dir,
+                subfolder="clipspace")
             
             logger.info(f"保存clipspace图片 [请求ID: {request_id}]: {clipspace_path}")
 
             # 发送请求到ComfyUI
             try:
-                response = requests.post(
-                    self.url,
-                    json={"prompt": self.workflow},
-                    timeout=Config.get("comfyui_server.timeout", 3000)
-                )
-                response.raise_for_status()
-                logger.info(f"已发送请求到ComfyUI [请求ID: {request_id}]")
-            except requests.exceptions.RequestException as e:
+                prompt_id = await client.submit(
+                    workflow, request_id, self.workflow_name,
+                    status=status)
+                logger.info(
+                    f"已发送请求到ComfyUI [请求ID: {request_id}, "
+                    f"prompt_id: {prompt_id}]")
+            except httpx.HTTPError as e:
                 error_context = {
                     "请求ID": request_id
                 }
@@ -168,53 +182,32 @@ class SwapFaceApp:
                 return utils.create_error_image(), f"ComfyUI请求失败: {str(e)}"
 
             # 等待处理结果
-            max_retries = 6000
-            retry_count = 0
-
-            while retry_count < max_retries:
-                try:
-                    # 查找以请求ID为前缀的输出文件
-                    output_files = list(
-                        self.output_dir.glob(f"{request_id}*.png"))
-                    if output_files:
-                        output_path = output_files[0]
-                        # 确保文件写入完成
-                        time.sleep(0.5)
-
-                        with Image.open(output_path) as img:
-                            output_image = img.copy()
-
-                        process_time = time.time() - start_time
-                        logger.info(
-                            f"处理完成 [请求ID: {request_id}], "
-                            f"耗时: {process_time:.2f}秒")
-                        logger.info(f"输出图片: {output_path}")
-                        logger.info(f"图片模式: {output_image.mode}")
-                        logger.info(f"图片大小: {output_image.size}")
-
-                        return output_image, "处理成功"
-
-                except Exception as e:
-                    logger.error(f"图片加载失败 [请求ID: {request_id}]: {e}")
-                    time.sleep(1)
-                    retry_count += 1
-                    continue
-
-                time.sleep(1)
-                retry_count += 1
-                if retry_count % 10 == 0:
-                    logger.info(
-                        f"等待处理结果 [请求ID: {request_id}]: "
-                        f"{retry_count}/{max_retries}")
-
-            error_context = {
-                "请求ID": request_id,
-                "已等待": f"{retry_count}秒",
-                "输出路径": str(self.output_dir)
-            }
-            error_reporter.report("处理超时", None, error_context)
-            return utils.create_error_image(), "处理超时"
-
+            try:
+                output_image, output_path = await client.wait_for_image(
+                    prompt_id, request_id, self.output_dir)
+            except TimeoutError:
+                error_context = {
+                    "请求ID": request_id,
+                    "已等待": f"{time.time() - start_time:.0f}秒",
+                    "输出路径": str(self.output_dir)
+                }
+                error_reporter.report("处理超时", None, error_context)
+                return utils.create_error_image(), "处理超时"
+
+            process_time = time.time() - start_time
+            logger.info(
+                f"处理完成 [请求ID: {request_id}], "
+                f"耗时: {process_time:.2f}秒")
+            logger.info(f"输出图片: {output_path}")
+            logger.info(f"图片模式: {output_image.mode}")
+            logger.info(f"图片大小: {output_image.size}")
+
+            return output_image, "处理成功"
+
+        except (QueueFullError, CircuitOpenError,
+                WorkflowValidationError) as e:
+            logger.warning(f"请求被拒绝: {e}")
+            return utils.create_error_image(), str(e)
         except Exception as e:
             error_reporter.report("处理失败", e, {})
             return utils.create_error_image(), f"处理失败: {str(e)}"
@@ -238,7 +231,9 @@ def create_interface() -> Dict[str, Any]:
                 label="目标人脸图片",
                 type="pil",
             )
-            process_btn = gr.Button("开始处理", variant="primary")
+            with gr.Row():
+                process_btn = gr.Button("开始处理", variant="primary")
+                abort_btn = gr.Button("中止", variant="stop")
 
         with gr.Column(scale=1):
             output_image = gr.Image(
@@ -250,7 +245,7 @@ def create_interface() -> Dict[str, Any]:
             status_text = gr.Textbox(label="处理状态")
 
     # 设置事件处理
-    process_btn.click(
+    process_event = process_btn.click(
         fn=app.process_image,
         inputs=[
             input_editor,
@@ -259,13 +254,23 @@ def create_interface() -> Dict[str, Any]:
         outputs=[
             output_image,
             status_text,
-        ]
+        ],
+        concurrency_limit=Config.get(
+            "gradio_server.concurrency_limit", 200)
+    )
+    # 中止时取消处理事件，ComfyUI中对应的prompt随之被删除或中断
+    abort_btn.click(
+        fn=lambda: "已中止",
+        outputs=[status_text],
+        cancels=[process_event],
+        queue=False
     )
 
     return {
         "input_editor": input_editor,
         "face_image": face_image,
         "process_btn": process_btn,
+        "abort_btn": abort_btn,
         "output_image": output_image,
         "status_text": status_text
     }
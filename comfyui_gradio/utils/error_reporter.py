@@ -6,19 +6,32 @@
 """
 
 import os
+import re
 import sys
+import time
+import threading
 import traceback
 import logging
 import inspect
 from datetime import datetime
 from typing import Optional, Dict, Any, List, Tuple
 
+from comfyui_gradio.config import Config
 from comfyui_gradio.utils.dingtalk import DingTalkBot
 
+# 异常信息中每次都不同的部分：请求ID和prompt_id中的时间戳、UUID和十六进制串
+_VOLATILE = re.compile(r"[0-9a-fA-F]{8,}(?:-[0-9a-fA-F]{4,})*|\d{5,}")
+
 
 class ErrorReporter:
     """统一的错误报告工具类"""
 
+    # 所有实例共享的告警去重记录，
+    # 键为(服务名称, 错误消息, 异常类型, 归一化的异常信息)，
+    # 值为[上次发送时间, 之后被抑制的次数]
+    _recent: Dict[Tuple[str, str, str, str], List[float]] = {}
+    _recent_lock = threading.Lock()
+
     def __init__(self, service_name: str,
                  logger: Optional[logging.Logger] = None):
         """
@@ -31,6 +44,8 @@ class ErrorReporter:
         self.service_name = service_name
         self.logger = logger or logging.getLogger(service_name)
         self.ding = DingTalkBot()
+        # 相同告警在该时间窗口（秒）内只发送一次
+        self.dedup_seconds = Config.get("dingtalk.dedup_seconds", 300)
 
     def report(self, error_msg: str, error: Optional[Exception] = None,
                context: Optional[Dict[str, Any]] = None,
@@ -56,7 +71,42 @@ class ErrorReporter:
 
         # 发送通知
         if notify:
-            self.ding.send_message(formatted_msg, error)
+            suppressed = self._acquire_alert(error_msg, error)
+            if suppressed is None:
+                return
+            if suppressed:
+                formatted_msg += (f"\n\n过去{self.dedup_seconds}秒内相同告警"
+                                  f"另有{suppressed}次未发送")
+            # 在后台线程发送，不阻塞请求处理
+            threading.Thread(
+                target=self.ding.send_message,
+                args=(formatted_msg, error),
+                name="dingtalk-alert",
+                daemon=True
+            ).start()
+
+    def _acquire_alert(self, error_msg: str,
+                       error: Optional[Exception]) -> Optional[int]:
+        """
+        判断告警是否需要发送
+
+        异常信息去掉请求ID等每次都不同的部分后参与去重，
+        同一类型的不同故障（如不同节点报错）分别告警。
+
+        Returns:
+            需要发送时返回上次发送后被抑制的次数，不需要发送时返回None
+        """
+        detail = _VOLATILE.sub("#", str(error)) if error is not None else ""
+        key = (self.service_name, error_msg, type(error).__name__, detail)
+        now = time.time()
+        with self._recent_lock:
+            record = self._recent.get(key)
+            if record is not None and now - record[0] < self.dedup_seconds:
+                record[1] += 1
+                return None
+            suppressed = int(record[1]) if record is not None else 0
+            self._recent[key] = [now, 0]
+            return suppressed
 
     def _get_stack_info(self) -> List[Tuple[str, int, str, str]]:
         """
@@ -20,9 +20,11 @@ setup(
     ],
     python_requires=">=3.10",
     install_requires=[
-        "gradio>=3.50.0",
+        "gradio>=4.0.0",
         "pillow>=10.0.0",
         "requests>=2.31.0",
+        "httpx>=0.24.0",
+        "websocket-client>=1.6.0",
         "numpy>=1.24.0",
         "psutil>=5.9.0",
         "schedule>=1.2.0",
@@ -0,0 +1,1172 @@
+import unittest
+from unittest.mock import patch, MagicMock, AsyncMock
+import io
+import asyncio
+import os
+import struct
+import sys
+import tempfile
+import threading
+
+import httpx
+from PIL import Image
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+
+from comfyui_gradio.client import (
+    BackendPool, CircuitOpenError, ComfyUIClient, ClientMetrics,
+    ExecutionError, get_client
+)
+from comfyui_gradio.client.coalescer import fingerprint
+from comfyui_gradio.client.comfyui_client import _Submission
+from comfyui_gradio.client.dispatcher import Dispatcher, QueueFullError
+from comfyui_gradio.client.status import RequestStatus
+from comfyui_gradio.client.fair_share import FairShare
+from comfyui_gradio.client.priority import (
+    PRIORITY_INTERACTIVE, PRIORITY_BULK
+)
+from comfyui_gradio.client.result_cache import ResultCache, is_deterministic
+from comfyui_gradio.client.eta import LatencyModel
+from comfyui_gradio.client.schema import SchemaCache, WorkflowValidationError
+from comfyui_gradio.client.workflow_template import (
+    WorkflowTemplate, new_request_id, prune_workflow
+)
+from comfyui_gradio.client.ws_listener import ExecutionListener
+
+
+class TestComfyUIClient(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.client = ComfyUIClient("http://localhost:8188/prompt")
+        # 测试中不启动事件监听线程，不使用结果缓存
+        self.client.listener.start = MagicMock()
+        self.client.result_cache = None
+
+    def test_normalize_base_url(self):
+        """测试兼容带/prompt后缀的旧配置"""
+        self.assertEqual(self.client.base_url, "http://localhost:8188")
+        self.assertEqual(
+            ComfyUIClient._normalize_base_url("http://host:8188/"),
+            "http://host:8188")
+
+    def test_get_client_shared_per_backend(self):
+        """测试同一后端只创建一个客户端"""
+        client_a = get_client("http://localhost:8188/prompt")
+        client_b = get_client("http://localhost:8188")
+        client_c = get_client("http://localhost:8189")
+        self.assertIs(client_a, client_b)
+        self.assertIsNot(client_a, client_c)
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_submit_records_metrics(self, mock_request):
+        """测试提交成功返回prompt_id并记录指标"""
+        mock_response = MagicMock()
+        mock_response.json.return_value = {"prompt_id": "abc"}
+        mock_request.return_value = mock_response
+
+        prompt_id = await self.client.submit({"1": {}}, "test_request")
+
+        self.assertEqual(prompt_id, "abc")
+        args, kwargs = mock_request.call_args
+        self.assertEqual(args, ("POST", "/prompt"))
+        self.assertEqual(kwargs["json"]["prompt"], {"1": {}})
+        self.assertEqual(kwargs["json"]["client_id"], self.client.client_id)
+        self.assertIn("prompt_id", kwargs["json"])
+        stats = self.client.metrics.snapshot()
+        self.assertEqual(stats["prompt"]["count"], 1)
+        self.assertEqual(stats["prompt"]["errors"], 0)
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_submit_failure_records_error(self, mock_request):
+        """测试重试仍失败时抛出异常并记录失败次数"""
+        mock_request.side_effect = httpx.ConnectError("refused")
+        self.client.retry_base_delay = 0.01
+
+        with self.assertRaises(httpx.HTTPError):
+            await self.client.submit({}, "test_request")
+
+        stats = self.client.metrics.snapshot()
+        self.assertEqual(
+            stats["prompt"]["errors"], self.client.retry_attempts)
+        self.assertEqual(stats["prompt_retry"]["errors"], 1)
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_submit_coalesces_identical_requests(self, mock_request):
+        """测试执行中的相同请求只提交一次，输入内容不同时单独提交"""
+        async def respond(*args, **kwargs):
+            prompt_id = f"p{mock_request.await_count}"
+            await asyncio.sleep(0.01)
+            response = MagicMock()
+            response.json.return_value = {"prompt_id": prompt_id}
+            return response
+        mock_request.side_effect = respond
+        self.client.dispatcher.max_outstanding = 0
+        for path, digest in [("r1_input.png", "aaa"), ("r2_input.png", "aaa"),
+                             ("r3_input.png", "bbb")]:
+            self.client._remember_digest(path, digest)
+
+        def workflow(request_id):
+            return {
+                "8": {"inputs": {"image": f"{request_id}_input.png"}},
+                "10": {"inputs": {"filename_prefix": request_id}}
+            }
+
+        prompt_ids = await asyncio.gather(*(
+            self.client.submit(workflow(request_id), request_id, "rmbg")
+            for request_id in ("r1", "r2", "r3")))
+
+        self.assertEqual(prompt_ids[0], prompt_ids[1])
+        self.assertNotEqual(prompt_ids[0], prompt_ids[2])
+        self.assertEqual(mock_request.await_count, 2)
+        self.assertEqual(self.client.coalescer.get_stats()["merged"], 1)
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_coalesced_request_follows_status(self, mock_request):
+        """测试合并的请求收到提交方的状态更新，离开后不再收到"""
+        response = MagicMock()
+        response.json.return_value = {"prompt_id": "p1"}
+        mock_request.return_value = response
+        leader, follower = RequestStatus(), RequestStatus()
+
+        await self.client.submit({"1": {}}, "r1", status=leader)
+        await self.client.submit({"1": {}}, "r2", status=follower)
+        self.assertEqual(follower.message, leader.message)
+        leader.update("正在执行节点: K采样器，第3/20步", (3, 20))
+        self.assertEqual(follower.message, "正在执行节点: K采样器，第3/20步")
+        self.assertEqual(follower.progress, (3, 20))
+
+        self.client.coalescer._leave(
+            self.client.coalescer._jobs["p1"], "r2")
+        leader.update("正在执行节点: VAE解码")
+        self.assertEqual(follower.message, "正在执行节点: K采样器，第3/20步")
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_coalesced_request_cancelled_before_wait(self, mock_request):
+        """测试得到prompt_id后未等待结果就被取消的请求离开合并记录"""
+        response = MagicMock()
+        response.json.return_value = {"prompt_id": "p1"}
+        mock_request.return_value = response
+
+        async def abandon(request_id):
+            await self.client.submit({"1": {}}, request_id)
+            await asyncio.Event().wait()
+        tasks = [asyncio.create_task(abandon(request_id))
+                 for request_id in ("r1", "r2")]
+        await asyncio.sleep(0.01)
+        job = self.client.coalescer._jobs["p1"]
+        self.assertEqual(job.waiters, 2)
+
+        tasks[1].cancel()
+        await asyncio.gather(tasks[1], return_exceptions=True)
+        self.assertEqual(job.waiters, 1)
+        tasks[0].cancel()
+        await asyncio.gather(tasks[0], return_exceptions=True)
+        self.assertEqual(job.waiters, 0)
+        self.assertEqual(self.client.coalescer.get_stats()["inflight"], 0)
+        self.assertNotIn("p1", self.client.coalescer._jobs)
+
+    async def test_cached_result_dropped_when_not_taken(self):
+        """测试命中缓存后未取走结果就结束的请求不会留下缓存结果"""
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.client.result_cache = ResultCache(cache_dir, max_bytes=1 << 20)
+            workflow = {"1": {"inputs": {"seed": 1}}}
+            key = fingerprint(None, workflow, "r1", {})
+            buffer = io.BytesIO()
+            Image.new("RGB", (4, 4)).save(buffer, format="PNG")
+            self.client.result_cache.put(key, buffer.getvalue())
+
+            async def abandon():
+                prompt_id = await self.client.submit(workflow, "r1")
+                self.assertIn(prompt_id, self.client._cached_results)
+                raise RuntimeError("上传结果失败")
+            with self.assertRaises(RuntimeError):
+                await asyncio.create_task(abandon())
+            # 任务结束的回调在下一轮事件循环中执行
+            await asyncio.sleep(0)
+
+            self.assertEqual(self.client._cached_results, {})
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_interactive_preempts_bulk(self, mock_request):
+        """测试交互请求排队时撤回尚未开始执行的批量prompt"""
+        pending = [[0, "p1", {}]]
+
+        async def respond(method, path, **kwargs):
+            response = MagicMock()
+            if path == "/prompt":
+                response.json.return_value = {
+                    "prompt_id": f"p{mock_request.await_count}"}
+            elif method == "POST" and path == "/queue":
+                pending.clear()
+            elif method == "GET":
+                response.json.return_value = {
+                    "queue_running": [], "queue_pending": list(pending)}
+            return response
+        mock_request.side_effect = respond
+        self.client.dispatcher.max_outstanding = 1
+
+        bulk_id = await self.client.submit(
+            {"1": {}}, "bulk", status=RequestStatus(priority=PRIORITY_BULK))
+        interactive_id = await self.client.submit(
+            {"2": {}}, "interactive",
+            status=RequestStatus(priority=PRIORITY_INTERACTIVE))
+
+        self.assertEqual(bulk_id, "p1")
+        self.assertNotEqual(interactive_id, bulk_id)
+        mock_request.assert_any_await(
+            "POST", "/queue", json={"delete": ["p1"]})
+        self.assertTrue(self.client._submissions["p1"].preempted)
+        self.assertEqual(self.client.preempted, 1)
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_preempt_skips_prompt_that_started(self, mock_request):
+        """测试批量prompt在读取队列和删除之间开始执行时不重新排队"""
+        queue = {"queue_running": [], "queue_pending": [[0, "p1", {}]]}
+
+        async def respond(method, path, **kwargs):
+            response = MagicMock()
+            if path == "/prompt":
+                response.json.return_value = {"prompt_id": "p1"}
+            elif method == "POST" and path == "/queue":
+                # 删除请求到达前prompt已开始执行，删除不生效
+                queue["queue_running"] = queue["queue_pending"]
+                queue["queue_pending"] = []
+            elif method == "GET":
+                response.json.return_value = dict(queue)
+            return response
+        mock_request.side_effect = respond
+        self.client.dispatcher.max_outstanding = 1
+
+        await self.client.submit(
+            {"1": {}}, "bulk", status=RequestStatus(priority=PRIORITY_BULK))
+        waiting = asyncio.create_task(self.client.submit(
+            {"2": {}}, "interactive",
+            status=RequestStatus(priority=PRIORITY_INTERACTIVE)))
+        await asyncio.sleep(0.05)
+        await asyncio.gather(*self.client._background_tasks)
+
+        mock_request.assert_any_await(
+            "POST", "/queue", json={"delete": ["p1"]})
+        self.assertFalse(self.client._submissions["p1"].preempted)
+        self.assertEqual(self.client.preempted, 0)
+        self.assertEqual(self.client.dispatcher.get_stats()["outstanding"], 1)
+        self.assertFalse(waiting.done())
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_interactive_jumps_other_process_bulk(self, mock_request):
+        """测试交互请求排到其他进程提交的批量prompt之前，不删除这些prompt"""
+        async def respond(method, path, **kwargs):
+            response = MagicMock()
+            if path == "/prompt":
+                response.json.return_value = {
+                    "prompt_id": kwargs["json"]["prompt_id"]}
+            else:
+                response.json.return_value = {
+                    "queue_running": [], "queue_pending": [
+                        [7, "c", {}, {}],
+                        [6, "b", {}, {"priority": PRIORITY_BULK}],
+                        [5, "a", {}, {"priority": PRIORITY_INTERACTIVE}]]}
+            return response
+        mock_request.side_effect = respond
+
+        await self.client.submit(
+            {"1": {}}, "test_request",
+            status=RequestStatus(priority=PRIORITY_INTERACTIVE))
+        self.client.dispatcher.release()
+
+        payload = mock_request.call_args.kwargs["json"]
+        self.assertEqual(payload["number"], 5.5)
+        self.assertEqual(payload["extra_data"]["priority"], PRIORITY_INTERACTIVE)
+        self.assertNotIn(("POST", "/queue"), [
+            call.args for call in mock_request.call_args_list])
+        self.assertEqual(self.client.get_stats()["queue_jumps"], 1)
+
+        # 提交失败时不计为插队
+        async def reject(method, path, **kwargs):
+            if path == "/prompt":
+                raise httpx.HTTPStatusError(
+                    "bad request", request=MagicMock(),
+                    response=MagicMock(status_code=400))
+            return await respond(method, path, **kwargs)
+        mock_request.side_effect = reject
+        with self.assertRaises(httpx.HTTPStatusError):
+            await self.client.submit(
+                {"2": {}}, "rejected_request",
+                status=RequestStatus(priority=PRIORITY_INTERACTIVE))
+        self.assertEqual(self.client.get_stats()["queue_jumps"], 1)
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_cancel_interrupts_running_prompt(self, mock_request):
+        """测试放弃等待时删除排队中的prompt并中断正在执行的prompt"""
+        async def respond(method, path, **kwargs):
+            response = MagicMock()
+            if path == "/prompt":
+                response.json.return_value = {"prompt_id": "p1"}
+            elif method == "GET":
+                response.json.return_value = {
+                    "queue_running": [[0, "p1", {}]], "queue_pending": []}
+            return response
+        mock_request.side_effect = respond
+
+        prompt_id = await self.client.submit({"1": {}}, "test_request")
+        with tempfile.TemporaryDirectory() as output_dir:
+            task = asyncio.create_task(self.client.wait_for_image(
+                prompt_id, "test_request", output_dir))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            await asyncio.gather(*self.client._background_tasks)
+
+        mock_request.assert_any_await(
+            "POST", "/queue", json={"delete": ["p1"]})
+        mock_request.assert_any_await(
+            "POST", "/interrupt", json={"prompt_id": "p1"})
+        self.assertEqual(self.client.cancelled, 1)
+        self.assertEqual(self.client.dispatcher.get_stats()["outstanding"], 0)
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_cancel_during_submit_stops_prompt(self, mock_request):
+        """测试提交请求发出后被取消时，按生成的prompt_id删除该prompt"""
+        submitted = {}
+        posted = asyncio.Event()
+
+        async def respond(method, path, **kwargs):
+            response = MagicMock()
+            if path == "/prompt":
+                submitted["prompt_id"] = kwargs["json"]["prompt_id"]
+                posted.set()
+                await asyncio.sleep(10)
+            elif method == "GET":
+                response.json.return_value = {
+                    "queue_running": [], "queue_pending": []}
+            return response
+        mock_request.side_effect = respond
+
+        task = asyncio.create_task(
+            self.client.submit({"1": {}}, "test_request"))
+        await posted.wait()
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        await asyncio.gather(*self.client._background_tasks)
+
+        mock_request.assert_any_await(
+            "POST", "/queue", json={"delete": [submitted["prompt_id"]]})
+        self.assertEqual(self.client.dispatcher.get_stats()["outstanding"], 0)
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_deadline_cancels_prompt(self, mock_request):
+        """测试超过执行期限时停止prompt后再归还许可"""
+        async def respond(method, path, **kwargs):
+            response = MagicMock()
+            if path == "/prompt":
+                response.json.return_value = {"prompt_id": "p1"}
+            elif path.startswith("/history"):
+                response.json.return_value = {}
+            elif method == "GET":
+                response.json.return_value = {
+                    "queue_running": [[0, "p1", {}]], "queue_pending": []}
+            return response
+        mock_request.side_effect = respond
+
+        prompt_id = await self.client.submit({"1": {}}, "test_request")
+        with tempfile.TemporaryDirectory() as output_dir:
+            with self.assertRaises(TimeoutError):
+                await asyncio.wait_for(self.client.wait_for_image(
+                    prompt_id, "test_request", output_dir, max_wait=0.3), 5)
+
+        mock_request.assert_any_await(
+            "POST", "/queue", json={"delete": ["p1"]})
+        mock_request.assert_any_await(
+            "POST", "/interrupt", json={"prompt_id": "p1"})
+        self.assertEqual(self.client.cancelled, 1)
+        self.assertEqual(self.client.dispatcher.get_stats()["outstanding"], 0)
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_execution_error_fails_fast(self, mock_request):
+        """测试收到execution_error事件时立即失败，不等到执行期限"""
+        mock_response = MagicMock()
+        mock_response.json.return_value = {"prompt_id": "p1"}
+        mock_request.return_value = mock_response
+        self.client.listener.connected = True
+
+        prompt_id = await self.client.submit({"1": {}}, "test_request")
+        asyncio.get_running_loop().call_later(
+            0.05, self.client.listener._handle_message, {
+                "type": "execution_error",
+                "data": {"prompt_id": "p1", "node_type": "KSampler",
+                         "exception_message": "CUDA out of memory"}})
+
+        with self.assertRaises(ExecutionError) as ctx:
+            await asyncio.wait_for(self.client.wait_for_image(
+                prompt_id, "test_request", "unused", max_wait=60), 5)
+        self.assertIn("KSampler", str(ctx.exception))
+        self.assertEqual(self.client.dispatcher.get_stats()["outstanding"], 0)
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_submit_retries_transient_failure(self, mock_request):
+        """测试连接失败后退避重试，重试次数和额外延迟单独统计"""
+        mock_response = MagicMock()
+        mock_response.json.return_value = {"prompt_id": "abc"}
+        mock_request.side_effect = [
+            httpx.ConnectError("refused"), mock_response]
+        self.client.retry_base_delay = 0.01
+
+        prompt_id = await self.client.submit({"1": {}}, "test_request")
+
+        self.assertEqual(prompt_id, "abc")
+        self.assertEqual(self.client.retries, 1)
+        stats = self.client.metrics.snapshot()
+        self.assertEqual(stats["prompt"]["errors"], 1)
+        self.assertEqual(stats["prompt_retry"]["count"], 1)
+        self.assertEqual(stats["prompt_retry"]["errors"], 0)
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_submit_retry_is_idempotent(self, mock_request):
+        """测试响应丢失但提交已被接收时不再重复提交"""
+        async def respond(method, path, **kwargs):
+            if path == "/prompt":
+                self.submitted = kwargs["json"]["prompt_id"]
+                raise httpx.ReadError("connection reset")
+            response = MagicMock()
+            response.json.return_value = {
+                "queue_running": [], "queue_pending": [[0, self.submitted]]}
+            return response
+        mock_request.side_effect = respond
+        self.client.retry_base_delay = 0.01
+
+        prompt_id = await self.client.submit({"1": {}}, "test_request")
+
+        self.assertEqual(prompt_id, self.submitted)
+        self.assertEqual(self.client.metrics.snapshot()["prompt"]["count"], 1)
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_submit_does_not_retry_invalid_workflow(self, mock_request):
+        """测试工作流校验失败(4xx)时不重试"""
+        request = httpx.Request("POST", "http://localhost:8188/prompt")
+        mock_request.side_effect = httpx.HTTPStatusError(
+            "bad request", request=request,
+            response=httpx.Response(400, request=request))
+
+        with self.assertRaises(httpx.HTTPStatusError):
+            await self.client.submit({"1": {}}, "test_request")
+        self.assertEqual(self.client.retries, 0)
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_fetch_result_api_mode(self, mock_request):
+        """测试api模式下通过/history和/view获取输出图片"""
+        self.client.result_mode = "api"
+
+        buffer = io.BytesIO()
+        Image.new('RGB', (8, 8), color='red').save(buffer, format='PNG')
+
+        history_response = MagicMock()
+        history_response.json.return_value = {"p1": {"outputs": {
+            "9": {"images": [{"filename": "preview.png", "subfolder": "",
+                              "type": "temp"}]},
+            "10": {"images": [{"filename": "rmbg_1_00001_.png",
+                               "subfolder": "", "type": "output"}]}
+        }}}
+        view_response = MagicMock()
+        view_response.content = buffer.getvalue()
+        mock_request.side_effect = [history_response, view_response]
+
+        image, location = await self.client._fetch_result(
+            "p1", "rmbg_1", None)
+
+        self.assertEqual(image.size, (8, 8))
+        self.assertEqual(location, "rmbg_1_00001_.png")
+        args, kwargs = mock_request.call_args
+        self.assertEqual(args, ("GET", "/view"))
+        self.assertEqual(kwargs["params"]["filename"], "rmbg_1_00001_.png")
+        self.assertEqual(kwargs["params"]["type"], "output")
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_upload_image_api_mode(self, mock_request):
+        """测试api模式下通过/upload/image上传输入图片"""
+        self.client.upload_mode = "api"
+        mock_response = MagicMock()
+        mock_response.json.return_value = {
+            "name": "r1_combined.png", "subfolder": "clipspace",
+            "type": "input"}
+        mock_request.return_value = mock_response
+
+        image_path = await self.client.upload_image(
+            Image.new('RGB', (8, 8)), "r1_combined.png", "unused_dir",
+            subfolder="clipspace")
+
+        self.assertEqual(image_path, "clipspace/r1_combined.png")
+        args, kwargs = mock_request.call_args
+        self.assertEqual(args, ("POST", "/upload/image"))
+        self.assertEqual(kwargs["data"]["subfolder"], "clipspace")
+        self.assertEqual(kwargs["data"]["overwrite"], "true")
+        filename, content, mime = kwargs["files"]["image"]
+        self.assertEqual(filename, "r1_combined.png")
+        self.assertTrue(content.startswith(b"\x89PNG"))
+        self.assertFalse(os.path.exists("unused_dir"))
+
+    def test_use_websocket_output(self):
+        """测试SaveImage节点被替换为SaveImageWebsocket且原工作流不变"""
+        workflow = {
+            "7": {"class_type": "BRIA_RMBG", "inputs": {}},
+            "10": {"class_type": "SaveImage",
+                   "inputs": {"images": ["7", 0], "filename_prefix": "x"}}
+        }
+
+        rewritten = ComfyUIClient.use_websocket_output(workflow)
+
+        self.assertNotIn("10", rewritten)
+        self.assertEqual(rewritten["ws_output_10"], {
+            "class_type": "SaveImageWebsocket",
+            "inputs": {"images": ["7", 0]}
+        })
+        self.assertEqual(workflow["10"]["class_type"], "SaveImage")
+
+
+class TestExecutionListener(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.listener = ExecutionListener("http://localhost:8188", "cid")
+        self.listener.connected = True
+
+    def test_ws_url(self):
+        """测试事件通道地址"""
+        self.assertEqual(
+            self.listener.ws_url, "ws://localhost:8188/ws?clientId=cid")
+
+    async def test_event_before_wait(self):
+        """测试完成事件早于等待方到达时仍能立即返回"""
+        self.listener._handle_message({
+            "type": "executed",
+            "data": {"prompt_id": "p1", "node": "10",
+                     "output": {"images": [{"filename": "a.png"}]}}
+        })
+        self.listener._handle_message({
+            "type": "executing", "data": {"prompt_id": "p1", "node": None}
+        })
+
+        state = await self.listener.wait("p1", timeout=0.1)
+
+        self.assertTrue(state.finished)
+        self.assertEqual(
+            state.outputs["10"]["images"][0]["filename"], "a.png")
+
+    async def test_binary_frames_attributed_to_output_node(self):
+        """测试只有websocket输出节点执行期间的二进制帧被当作结果，其余为预览图"""
+        header = struct.pack(">I", 1) + struct.pack(">I", 2)
+        self.listener._handle_message({
+            "type": "executing", "data": {"prompt_id": "p3", "node": "3"}
+        })
+        self.listener._handle_binary(header + b"preview")
+        self.listener._handle_message({
+            "type": "executing",
+            "data": {"prompt_id": "p3", "node": "ws_output_10"}
+        })
+        self.listener._handle_binary(header + b"result")
+        self.listener._handle_message({
+            "type": "execution_success", "data": {"prompt_id": "p3"}
+        })
+
+        state = await self.listener.wait("p3", timeout=0.1)
+
+        self.assertEqual(state.images, [b"result"])
+        self.assertEqual(state.take_preview(), b"preview")
+        self.assertIsNone(state.take_preview())
+
+    async def test_progress_reported_to_status(self):
+        """测试执行中的节点和步数推送到请求状态"""
+        status = RequestStatus()
+        workflow = {"3": {"class_type": "KSampler",
+                          "_meta": {"title": "K采样器"}}}
+        submission = _Submission(workflow, "r1", None, 1, status, None)
+        client = ComfyUIClient("http://localhost:8188")
+        self.listener.watch(
+            "p5", lambda state: client._report_progress(submission, state))
+        self.listener._handle_message({
+            "type": "executing", "data": {"prompt_id": "p5", "node": "3"}
+        })
+        self.listener._handle_message({
+            "type": "progress", "data": {"value": 12, "max": 28, "node": "3"}
+        })
+        await asyncio.sleep(0)
+
+        self.assertEqual(status.message, "正在执行节点: K采样器，第12/28步")
+        self.assertEqual(status.progress, (12, 28))
+
+    async def test_wait_timeout(self):
+        """测试未收到完成事件时超时返回"""
+        state = await self.listener.wait("p2", timeout=0.01)
+        self.assertFalse(state.finished)
+
+    async def test_notify_from_listener_thread(self):
+        """测试监听线程中的完成事件能唤醒事件循环中的等待方"""
+        message = {
+            "type": "execution_success", "data": {"prompt_id": "p4"}
+        }
+        timer = threading.Timer(
+            0.05, self.listener._handle_message, args=(message,))
+        timer.start()
+
+        state = await self.listener.wait("p4", timeout=5)
+
+        self.assertTrue(state.finished)
+
+
+class TestBackendPool(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.pool = BackendPool(
+            ["http://localhost:8190", "http://localhost:8191"])
+        self.first, self.second = self.pool.backends
+        for backend in self.pool.backends:
+            backend.breaker.record_success()
+
+    async def test_failover_to_other_backend(self):
+        """测试重试仍失败时转移到其他后端，等待结果时交给该后端"""
+        for backend in self.pool.backends:
+            backend.listener.start = MagicMock()
+            backend.result_cache = None
+        self.second.get_queue_depth = AsyncMock(return_value=0)
+
+        with patch.object(self.first, "_submit", AsyncMock(
+                side_effect=httpx.ConnectError("refused"))), \
+                patch.object(self.second, "_submit", AsyncMock(
+                    return_value=("p2", False))):
+            prompt_id = await self.first.submit({"1": {}}, "r1", "rmbg")
+
+        self.assertEqual(prompt_id, "p2")
+        self.assertEqual(self.first.failovers, 1)
+        with patch.object(self.second, "wait_for_image", AsyncMock(
+                return_value=("image", "location"))) as wait:
+            await self.first.wait_for_image(prompt_id, "r1", "unused")
+        wait.assert_awaited_once()
+        self.second.dispatcher.release()
+
+    async def test_select_shortest_queue(self):
+        """测试选择队列最短的后端，缓存期内按已分配数量累加"""
+        self.first.get_queue_depth = AsyncMock(return_value=1)
+        self.second.get_queue_depth = AsyncMock(return_value=0)
+
+        self.assertIs(await self.pool.select(), self.second)
+        # 第二个后端已分配一个请求，深度相同，轮流分配
+        chosen = {await self.pool.select(), await self.pool.select()}
+        self.assertEqual(chosen, {self.first, self.second})
+        # 缓存期内不重复读取/queue
+        self.assertEqual(self.second.get_queue_depth.await_count, 1)
+
+    async def test_open_circuit_backend_skipped(self):
+        """测试熔断中的后端不参与分配"""
+        self.first.get_queue_depth = AsyncMock(return_value=0)
+        self.second.get_queue_depth = AsyncMock(return_value=5)
+        for _ in range(self.first.breaker.failure_threshold):
+            self.first.breaker.record_failure()
+
+        self.assertEqual(self.first.breaker.state, "open")
+        self.assertIs(await self.pool.select(), self.second)
+        self.first.get_queue_depth.assert_not_awaited()
+
+
+    async def test_affinity_prefers_warm_backend(self):
+        """测试优先分配到已运行过同一工作流的后端，队列过长时溢出"""
+        self.first.get_queue_depth = AsyncMock(return_value=0)
+        self.second.get_queue_depth = AsyncMock(return_value=0)
+        self.pool.queue_cache_ttl = 0
+
+        warm = await self.pool.select("BRIA_RMBG_2.0")
+        self.assertIs(await self.pool.select("BRIA_RMBG_2.0"), warm)
+
+        warm.get_queue_depth = AsyncMock(
+            return_value=self.pool.affinity_spill_threshold + 1)
+        self.assertIsNot(await self.pool.select("BRIA_RMBG_2.0"), warm)
+
+        affinity = self.pool.get_stats()["affinity"]
+        self.assertEqual(affinity["hits"], 1)
+        self.assertEqual(affinity["misses"], 2)
+
+    def test_validation_retried_until_backend_up(self):
+        """测试启动时无法访问的后端在恢复后重新校验，此前显示为未校验"""
+        template = WorkflowTemplate("Demo", {
+            "10": {"class_type": "LoadImage", "inputs": {"image": ""}}
+        }, {"image": ("10", "image")})
+        schema = {"LoadImage": {"input": {"required": {"image": [[]]}}}}
+        failures = {self.first.base_url: 2}
+        cache = MagicMock()
+
+        def get(url, refresh=False):
+            if failures.get(url):
+                failures[url] -= 1
+                self.assertIn("Demo", self.pool.get_stats()[
+                    "backends"][0]["unvalidated_workflows"])
+                raise httpx.ConnectError("refused")
+            return schema
+        cache.get.side_effect = get
+
+        self.pool._unvalidated["Demo"] = {
+            backend.base_url for backend in self.pool.backends}
+        with patch("comfyui_gradio.client.backend_pool.get_schema_cache",
+                   return_value=cache):
+            self.pool._validate(template, None, retry_delay=0.01)
+
+        self.assertEqual(failures[self.first.base_url], 0)
+        for backend in self.pool.get_stats()["backends"]:
+            self.assertEqual(backend["unvalidated_workflows"], [])
+            self.assertEqual(backend["invalid_workflows"], [])
+
+    def test_stats_log_shows_circuit_state(self):
+        """测试定期记录的统计摘要包含熔断状态和亲和命中率"""
+        for _ in range(self.first.breaker.failure_threshold):
+            self.first.breaker.record_failure()
+
+        line = self.pool.format_stats()
+        self.assertIn(f"{self.first.base_url}: 熔断=open", line)
+        self.assertIn(f"{self.second.base_url}: 熔断=closed", line)
+        self.assertIn("模型亲和命中率", line)
+
+    async def test_invalid_workflow_excluded(self):
+        """测试校验失败的工作流不再分配到对应后端，全部失败时立即报错"""
+        template = WorkflowTemplate("Demo", {
+            "10": {"class_type": "LoadImage", "inputs": {"image": ""}}
+        }, {"image": ("10", "image")})
+        schemas = {
+            self.first.base_url: {},
+            self.second.base_url: {"LoadImage": {"input": {
+                "required": {"image": [[]]}, "hidden": {"upload": None}}}}
+        }
+        cache = MagicMock()
+        cache.get.side_effect = lambda url, refresh=False: schemas[url]
+        self.first.get_queue_depth = AsyncMock(return_value=0)
+        self.second.get_queue_depth = AsyncMock(return_value=5)
+
+        with patch("comfyui_gradio.client.backend_pool.get_schema_cache",
+                   return_value=cache):
+            self.pool._validate(template, None)
+        # 校验失败时绕过磁盘缓存重新读取一次
+        cache.get.assert_any_call(self.first.base_url, refresh=True)
+        self.assertIs(await self.pool.select("Demo"), self.second)
+        self.assertEqual(
+            self.pool.get_stats()["backends"][0]["invalid_workflows"], ["Demo"])
+
+        schemas[self.second.base_url] = {}
+        with patch("comfyui_gradio.client.backend_pool.get_schema_cache",
+                   return_value=cache):
+            self.pool._validate(template, None)
+        with self.assertRaises(WorkflowValidationError):
+            await self.pool.select("Demo")
+
+    def test_websocket_mode_requires_save_image_websocket(self):
+        """测试websocket模式下校验后端是否有SaveImageWebsocket节点"""
+        template = WorkflowTemplate("Demo", {
+            "10": {"class_type": "LoadImage", "inputs": {"image": ""}},
+            "20": {"class_type": "SaveImage",
+                   "inputs": {"images": ["10", 0], "filename_prefix": ""}}
+        }, {"image": ("10", "image")})
+        schema = {
+            "LoadImage": {"input": {"required": {"image": [[]]}}},
+            "SaveImage": {"input": {"required": {
+                "images": ["IMAGE"], "filename_prefix": ["STRING"]}}}
+        }
+        cache = MagicMock()
+        cache.get.return_value = schema
+        self.first.result_mode = "websocket"
+
+        with patch("comfyui_gradio.client.backend_pool.get_schema_cache",
+                   return_value=cache):
+            self.pool._validate(template, None)
+        first, second = self.pool.get_stats()["backends"]
+        self.assertEqual(first["invalid_workflows"], ["Demo"])
+        self.assertEqual(second["invalid_workflows"], [])
+
+        schema["SaveImageWebsocket"] = {
+            "input": {"required": {"images": ["IMAGE"]}}}
+        with patch("comfyui_gradio.client.backend_pool.get_schema_cache",
+                   return_value=cache):
+            self.pool._validate(template, None)
+        self.assertEqual(
+            self.pool.get_stats()["backends"][0]["invalid_workflows"], [])
+
+
+class TestCircuitBreaker(unittest.IsolatedAsyncioTestCase):
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_open_fails_fast_and_probe_closes(self, mock_request):
+        """测试连续失败后快速失败，冷却后放行一个探测请求并恢复"""
+        client = ComfyUIClient("http://localhost:8192")
+        client.breaker.reset_seconds = 0.05
+        mock_request.side_effect = httpx.ConnectError("refused")
+        for _ in range(client.breaker.failure_threshold):
+            with self.assertRaises(httpx.ConnectError):
+                await client.get_queue_depth()
+
+        with self.assertRaises(CircuitOpenError):
+            await client.get_queue_depth()
+        self.assertEqual(
+            mock_request.await_count, client.breaker.failure_threshold)
+
+        await asyncio.sleep(0.06)
+        self.assertEqual(client.breaker.state, "half_open")
+        self.assertTrue(client.breaker.allow())
+        # 探测请求进行中时不再放行其他请求
+        self.assertFalse(client.breaker.allow())
+        client.breaker.record_success()
+        self.assertEqual(client.breaker.get_stats()["state"], "closed")
+
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_submit_retries_count_as_one_failure(self, mock_request):
+        """测试一次提交的重试只计一次失败，单个请求不会触发熔断"""
+        client = ComfyUIClient("http://localhost:8193")
+        client.listener.start = MagicMock()
+        client.retry_base_delay = 0.01
+        mock_request.side_effect = httpx.ConnectError("refused")
+
+        with self.assertRaises(httpx.ConnectError):
+            await client.submit({"1": {}}, "r1")
+
+        self.assertEqual(mock_request.await_count, client.retry_attempts)
+        stats = client.breaker.get_stats()
+        self.assertEqual(stats["state"], "closed")
+        self.assertEqual(stats["consecutive_failures"], 1)
+        for request_id in range(2, client.breaker.failure_threshold + 1):
+            with self.assertRaises(httpx.ConnectError):
+                await client.submit({"1": {}}, f"r{request_id}")
+        self.assertEqual(client.breaker.state, "open")
+
+
+class TestFairShare(unittest.IsolatedAsyncioTestCase):
+
+    async def test_rate_limit_per_caller(self):
+        """测试调用方用完突发额度后等待，其他调用方不受影响"""
+        fair_share = FairShare(
+            {"image_upscale": {"burst": 2, "per_minute": 600}}, max_delay=1)
+        heavy = RequestStatus(caller="10.0.0.8", service="image_upscale")
+        light = RequestStatus(caller="10.0.0.9", service="image_upscale")
+
+        await fair_share.throttle(heavy)
+        await fair_share.throttle(heavy)
+        waiting = asyncio.create_task(fair_share.throttle(heavy))
+        await fair_share.throttle(light)
+        await asyncio.sleep(0)
+        self.assertFalse(waiting.done())
+        self.assertIn("提交过于频繁", heavy.message)
+
+        await waiting
+        self.assertEqual(fair_share.get_stats()["throttled"], 1)
+        for _ in range(10):
+            fair_share._buckets[("image_upscale", "10.0.0.8")].reserve()
+        with self.assertRaises(QueueFullError):
+            await fair_share.throttle(heavy)
+
+
+class TestDispatcher(unittest.IsolatedAsyncioTestCase):
+
+    async def _enqueue(self, dispatcher, groups, order):
+        """按顺序排队多个请求，放行时记录所属模型组"""
+        async def run(group):
+            await dispatcher.acquire(group)
+            order.append(group)
+
+        tasks = []
+        for group in groups:
+            tasks.append(asyncio.create_task(run(group)))
+            await asyncio.sleep(0)
+        return tasks
+
+    async def test_groups_same_model(self):
+        """测试有空位时优先放行与上一个提交同组的请求"""
+        dispatcher = Dispatcher(max_outstanding=1, reorder_window=8)
+        await dispatcher.acquire("rmbg")
+        order = []
+        tasks = await self._enqueue(
+            dispatcher, ["flux", "rmbg", "flux", "rmbg"], order)
+
+        for _ in tasks:
+            dispatcher.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+
+        self.assertEqual(order, ["rmbg", "rmbg", "flux", "flux"])
+        self.assertEqual(dispatcher.get_stats()["reordered"], 2)
+
+    async def test_starvation_guard(self):
+        """测试等待超过上限的请求按到达顺序放行"""
+        dispatcher = Dispatcher(max_outstanding=1, max_hold_seconds=0)
+        await dispatcher.acquire("rmbg")
+        order = []
+        tasks = await self._enqueue(dispatcher, ["flux", "rmbg"], order)
+
+        for _ in tasks:
+            dispatcher.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+
+        self.assertEqual(order, ["flux", "rmbg"])
+        self.assertEqual(dispatcher.get_stats()["forced"], 2)
+
+    async def test_priority_first(self):
+        """测试有空位时先放行高优先级请求，低优先级积压不挡住高优先级请求"""
+        dispatcher = Dispatcher(max_outstanding=1, max_queued=1)
+        await dispatcher.acquire("rmbg")
+        order = []
+
+        async def run(group, priority):
+            await dispatcher.acquire(group, priority=priority)
+            order.append(group)
+
+        bulk = asyncio.create_task(run("rmbg", PRIORITY_BULK))
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(run("flux", PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0)
+
+        for _ in range(2):
+            dispatcher.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(bulk, interactive)
+
+        self.assertEqual(order, ["flux", "rmbg"])
+        self.assertEqual(dispatcher.get_stats()["rejected"], 0)
+
+    async def test_round_robin_callers(self):
+        """测试同一优先级内按调用方轮流放行"""
+        dispatcher = Dispatcher(max_outstanding=1)
+        await dispatcher.acquire(caller="heavy")
+        order = []
+
+        async def run(caller):
+            await dispatcher.acquire(caller=caller)
+            order.append(caller)
+
+        tasks = []
+        for caller in ["heavy", "heavy", "heavy", "light", "light"]:
+            tasks.append(asyncio.create_task(run(caller)))
+            await asyncio.sleep(0)
+        for _ in tasks:
+            dispatcher.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+
+        self.assertEqual(
+            order, ["light", "heavy", "light", "heavy", "heavy"])
+
+    async def test_eta_and_shedding(self):
+        """测试排队时显示预计等待时间，预计等待过长的请求立即拒绝"""
+        dispatcher = Dispatcher(max_outstanding=1)
+        await dispatcher.acquire(estimate=30)
+        status = RequestStatus()
+        waiting = asyncio.create_task(
+            dispatcher.acquire(status=status, estimate=30, max_wait=60))
+        await asyncio.sleep(0)
+        self.assertIn("预计等待30秒", status.message)
+
+        with self.assertRaises(QueueFullError):
+            await dispatcher.acquire(estimate=30, max_wait=45)
+        self.assertEqual(dispatcher.get_stats()["shed"], 1)
+
+        dispatcher.release(30)
+        await waiting
+        self.assertEqual(dispatcher.predicted_wait(), 30)
+
+    async def test_vram_hold(self):
+        """测试空闲显存不足时暂缓提交，显存足够的请求先放行"""
+        dispatcher = Dispatcher(max_outstanding=3)
+        dispatcher.update_vram(10000)
+        await dispatcher.acquire("flux", cost=8000)
+        heavy = asyncio.create_task(dispatcher.acquire("flux", cost=8000))
+        await asyncio.sleep(0)
+        await dispatcher.acquire("rmbg", cost=1000)
+
+        self.assertFalse(heavy.done())
+        self.assertTrue(dispatcher.vram_waiting)
+        dispatcher.update_vram(20000)
+        await heavy
+        self.assertEqual(dispatcher.get_stats()["vram_held"], 1)
+
+    async def test_vram_not_held_when_idle(self):
+        """测试后端没有已提交的prompt时不因空闲显存偏低暂缓"""
+        dispatcher = Dispatcher(
+            max_outstanding=2, vram_reserve_mb=1024, vram_max_hold_seconds=120)
+        dispatcher.update_vram(8000)
+        await asyncio.wait_for(dispatcher.acquire("flux", cost=16000), 1)
+
+        # 已有prompt执行时，显存不足的请求暂缓，执行结束后放行
+        heavy = asyncio.create_task(dispatcher.acquire("flux", cost=16000))
+        await asyncio.sleep(0)
+        self.assertFalse(heavy.done())
+        dispatcher.release()
+        await asyncio.wait_for(heavy, 1)
+        self.assertEqual(dispatcher.get_stats()["vram_held"], 1)
+
+    async def test_queue_full_and_position(self):
+        """测试排队请求达到上限时立即拒绝，排队中的请求能看到排队位置"""
+        dispatcher = Dispatcher(max_outstanding=1, max_queued=1)
+        await dispatcher.acquire("rmbg")
+        status = RequestStatus()
+        task = asyncio.create_task(dispatcher.acquire("rmbg", status))
+        await asyncio.sleep(0)
+
+        self.assertEqual(status.message, "排队中，前面还有1个请求")
+        with self.assertRaises(QueueFullError):
+            await dispatcher.acquire("rmbg")
+
+        dispatcher.release()
+        await task
+        self.assertEqual(dispatcher.get_stats()["rejected"], 1)
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache = ResultCache(self.temp_dir.name, max_bytes=350)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_get_put(self):
+        """测试写入后命中并统计节省的字节数"""
+        self.assertIsNone(self.cache.get("aa01"))
+        self.cache.put("aa01", b"x" * 100)
+
+        self.assertEqual(self.cache.get("aa01"), b"x" * 100)
+        stats = self.cache.get_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+        self.assertEqual(stats["bytes_saved"], 100)
+
+    def test_lru_eviction(self):
+        """测试超过字节上限时淘汰最久未使用的结果"""
+        for index, key in enumerate(["aa01", "bb02", "cc03"]):
+            self.cache.put(key, b"x" * 100)
+            path = self.cache._path(key)
+            os.utime(path, (1000 + index, 1000 + index))
+
+        self.cache.get("aa01")
+        self.cache.put("dd04", b"x" * 100)
+
+        self.assertIsNone(self.cache.get("bb02"))
+        self.assertIsNotNone(self.cache.get("aa01"))
+        self.assertIsNotNone(self.cache.get("cc03"))
+
+    def test_random_seed_not_cached(self):
+        """测试随机种子的工作流不使用缓存"""
+        self.assertTrue(is_deterministic(
+            {"50": {"class_type": "KSampler", "inputs": {"seed": 42}}}))
+        self.assertFalse(is_deterministic(
+            {"50": {"class_type": "KSampler", "inputs": {"seed": -1}}}))
+
+class TestLatencyModel(unittest.TestCase):
+
+    def test_estimate_persisted(self):
+        """测试按工作流和输入尺寸学习耗时，重启后继续使用"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "eta.json")
+            model = LatencyModel(path)
+            model.observe("Fill_Repaint", 0.8, 10.0)
+            model.observe("Fill_Repaint", 0.8, 20.0)
+            model.observe("Fill_Repaint", 3.5, 60.0)
+            model.save()
+
+            model = LatencyModel(path)
+            self.assertAlmostEqual(model.estimate("Fill_Repaint", 0.9), 15.0)
+            self.assertAlmostEqual(model.estimate("Fill_Repaint", 3.0), 60.0)
+            # 没有样本的尺寸档使用该工作流的加权平均
+            self.assertAlmostEqual(model.estimate("Fill_Repaint", 6.0), 30.0)
+            self.assertIsNone(model.estimate("Image_Extend", 1.0))
+
+
+class TestSchemaCache(unittest.TestCase):
+
+    def test_disk_cache_keyed_by_version(self):
+        """测试节点定义按后端版本缓存到磁盘，版本变化时重新读取"""
+        def response(data):
+            result = MagicMock()
+            result.json.return_value = data
+            return result
+
+        version = {"system": {"comfyui_version": "0.3.10"}}
+        http = MagicMock()
+        http.get.side_effect = lambda path: response(
+            version if path == "/system_stats" else {"LoadImage": {}})
+
+        with tempfile.TemporaryDirectory() as cache_dir, \
+                patch("comfyui_gradio.client.schema.httpx.Client") as client:
+            client.return_value.__enter__.return_value = http
+            self.assertIn("LoadImage", SchemaCache(cache_dir).get("http://a:1"))
+            # 新进程直接使用磁盘缓存，不再读取/object_info
+            SchemaCache(cache_dir).get("http://a:1")
+            self.assertEqual(http.get.call_count, 3)
+
+            version["system"]["comfyui_version"] = "0.3.11"
+            SchemaCache(cache_dir).get("http://a:1")
+            self.assertEqual(http.get.call_count, 5)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+
+class TestWorkflowTemplate(unittest.TestCase):
+
+    def test_render_does_not_share_inputs(self):
+        """测试每次生成独立的prompt，模板不被修改"""
+        template = WorkflowTemplate("Demo", {
+            "10": {"class_type": "LoadImage", "inputs": {"image": ""}},
+            "34": {"class_type": "SaveImage",
+                   "inputs": {"filename_prefix": "", "images": ["9", 0]}}
+        }, {"image": ("10", "image"),
+            "filename_prefix": ("34", "filename_prefix")})
+
+        first = template.render(image="a.png", filename_prefix="r1")
+        second = template.render(image="b.png")
+
+        self.assertEqual(first["10"]["inputs"]["image"], "a.png")
+        self.assertEqual(second["10"]["inputs"]["image"], "b.png")
+        self.assertEqual(second["34"]["inputs"]["filename_prefix"], "")
+        self.assertEqual(template.nodes["10"]["inputs"]["image"], "")
+        # 模板的各层都是只读的，修改嵌套的输入会报错
+        with self.assertRaises(TypeError):
+            template.nodes["10"]["inputs"]["image"] = "c.png"
+        with self.assertRaises(AttributeError):
+            template.nodes["34"]["inputs"]["images"].append(1)
+        # 修改生成的prompt不影响之后的请求
+        first["34"]["inputs"]["images"][0] = "99"
+        self.assertEqual(template.render()["34"]["inputs"]["images"], ["9", 0])
+        with self.assertRaises(ValueError):
+            template.render(seed=1)
+        with self.assertRaises(ValueError):
+            WorkflowTemplate("Demo", {}, {"image": ("10", "image")})
+        self.assertNotEqual(new_request_id("rmbg"), new_request_id("rmbg"))
+
+    def test_prune_preview_nodes(self):
+        """测试移除预览节点及只为其提供输入的节点，保留绑定的节点"""
+        workflow = {
+            "1": {"class_type": "LoadImage", "inputs": {"image": ""}},
+            "2": {"class_type": "MaskToImage", "inputs": {"mask": ["1", 1]}},
+            "3": {"class_type": "PreviewImage", "inputs": {"images": ["2", 0]}},
+            "4": {"class_type": "SaveImage",
+                  "inputs": {"images": ["1", 0], "filename_prefix": ""}},
+            "5": {"class_type": "PrimitiveNode", "inputs": {"value": [1, 2]}}
+        }
+
+        pruned = prune_workflow(workflow, ["SaveImage"], ["5"])
+        self.assertEqual(sorted(pruned), ["1", "4", "5"])
+        self.assertIn("3", prune_workflow(workflow, ["SaveImage", "PreviewImage"]))
+
+
+class TestClientMetrics(unittest.TestCase):
+
+    def test_snapshot(self):
+        """测试平均耗时与最大耗时统计"""
+        metrics = ClientMetrics()
+        metrics.record("prompt", 1.0)
+        metrics.record("prompt", 3.0, success=False)
+
+        stats = metrics.snapshot()["prompt"]
+        self.assertEqual(stats["count"], 2)
+        self.assertEqual(stats["errors"], 1)
+        self.assertAlmostEqual(stats["avg_time"], 2.0)
+        self.assertAlmostEqual(stats["max_time"], 3.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
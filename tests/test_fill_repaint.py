@@ -1,8 +1,10 @@
 from comfyui_gradio.services.fill_repaint import FillRepaintApp
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
+import httpx
 from PIL import Image
 import numpy as np
+import json
 import os
 import sys
 
@@ -11,7 +13,7 @@ sys.path.insert(0, os.path.abspath(
     os.path.join(os.path.dirname(__file__), '..')))
 
 
-class TestFillRepaintApp(unittest.TestCase):
+class TestFillRepaintApp(unittest.IsolatedAsyncioTestCase):
 
     def setUp(self):
         # 创建测试目录
@@ -25,21 +27,25 @@ class TestFillRepaintApp(unittest.TestCase):
         self.mock_config_get.side_effect = self._mock_config_get
 
         # 模拟工作流文件
-        self.workflow_patcher = patch('pathlib.Path.open')
-        self.mock_open = self.workflow_patcher.start()
-        self.mock_open.return_value.__enter__.return_value.read.return_value = '{}'
-
-        # 创建测试应用
-        self.app = FillRepaintApp()
-
-        # 模拟工作流
-        self.app.workflow = {
+        self.workflow = {
             "54": {"inputs": {"image": ""}},
-            "175": {"inputs": {"text": ""}},
+            "175": {"inputs": {"text": "empty"}},
             "170": {"inputs": {"input": 1}},
             "50": {"inputs": {"denoise": 0.5}},
             "168": {"inputs": {"filename_prefix": ""}}
         }
+        self.workflow_patcher = patch('pathlib.Path.open')
+        self.mock_open = self.workflow_patcher.start()
+        self.mock_open.return_value.__enter__.return_value.read.return_value = (
+            json.dumps(self.workflow))
+
+        # 创建测试应用
+        self.app = FillRepaintApp()
+        # 测试中不使用结果缓存，避免命中之前运行的结果；
+        # 重置熔断器，避免受其他用例中请求失败的影响
+        for backend in self.app.pool.backends:
+            backend.result_cache = None
+            backend.breaker.record_success()
 
     def tearDown(self):
         # 停止所有模拟
@@ -56,6 +62,11 @@ class TestFillRepaintApp(unittest.TestCase):
         os.rmdir('test_output')
         os.rmdir('test_clipspace')
 
+    async def _run(self, *args):
+        """调用处理函数，返回最后一次输出"""
+        outputs = [output async for output in self.app.process_image(*args)]
+        return outputs[-1]
+
     def _mock_config_get(self, key, default=None):
         """模拟配置获取函数"""
         config = {
@@ -67,10 +78,11 @@ class TestFillRepaintApp(unittest.TestCase):
         }
         return config.get(key, default)
 
-    @patch('requests.post')
-    @patch('time.sleep')
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    @patch('asyncio.sleep', new_callable=AsyncMock)
     @patch('pathlib.Path.glob')
-    def test_process_image_success(self, mock_glob, mock_sleep, mock_post):
+    async def test_process_image_success(self, mock_glob, mock_sleep,
+                                         mock_post):
         """测试图片处理成功的情况"""
         # 创建测试输入数据
         background = np.zeros((100, 100, 3), dtype=np.uint8)
@@ -85,6 +97,7 @@ class TestFillRepaintApp(unittest.TestCase):
         # 模拟请求成功
         mock_response = MagicMock()
         mock_response.raise_for_status.return_value = None
+        mock_response.json.return_value = {"prompt_id": "test-prompt-id"}
         mock_post.return_value = mock_response
 
         # 模拟输出文件
@@ -94,7 +107,7 @@ class TestFillRepaintApp(unittest.TestCase):
         mock_glob.return_value = [test_output_file]
 
         # 调用处理函数
-        result_image, status = self.app.process_image(
+        result_image, status = await self._run(
             input_data, "test prompt", 0.5)
 
         # 验证结果
@@ -102,14 +115,18 @@ class TestFillRepaintApp(unittest.TestCase):
         self.assertEqual(status, "处理成功")
         self.assertEqual(result_image.size, (100, 100))
 
-        # 验证工作流更新
-        self.assertEqual(
-            self.app.workflow["175"]["inputs"]["text"], "test prompt")
-        self.assertEqual(self.app.workflow["170"]["inputs"]["input"], 2)
-        self.assertEqual(self.app.workflow["50"]["inputs"]["denoise"], 0.5)
-
-    @patch('requests.post')
-    def test_process_image_request_error(self, mock_post):
+        # 验证提交的工作流填入了参数
+        prompt = next(
+            call.kwargs["json"]["prompt"] for call in mock_post.call_args_list
+            if str(call.args[1]).endswith("/prompt"))
+        self.assertEqual(prompt["175"]["inputs"]["text"], "test prompt")
+        self.assertEqual(prompt["170"]["inputs"]["input"], 2)
+        self.assertEqual(prompt["50"]["inputs"]["denoise"], 0.5)
+        # 模板本身没有被修改
+        self.assertEqual(self.app.template.nodes["175"]["inputs"]["text"], "empty")
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_process_image_request_error(self, mock_post):
         """测试请求失败的情况"""
         # 创建测试输入数据
         background = np.zeros((100, 100, 3), dtype=np.uint8)
@@ -122,24 +139,25 @@ class TestFillRepaintApp(unittest.TestCase):
         }
 
         # 模拟请求失败
-        mock_post.side_effect = Exception("Connection error")
+        mock_post.side_effect = httpx.ConnectError("Connection error")
 
         # 调用处理函数
-        result_image, status = self.app.process_image(
+        result_image, status = await self._run(
             input_data, "test prompt", 0.5)
 
         # 验证结果
         self.assertIn("ComfyUI请求失败", status)
 
-    def test_process_image_no_input(self):
+    async def test_process_image_no_input(self):
         """测试没有输入图片的情况"""
         # 调用处理函数
-        result_image, status = self.app.process_image(None, "test prompt", 0.5)
+        result_image, status = await self._run(
+            None, "test prompt", 0.5)
 
         # 验证结果
         self.assertEqual(status, "未上传图片")
 
-    def test_process_image_no_mask(self):
+    async def test_process_image_no_mask(self):
         """测试没有蒙版的情况"""
         # 创建测试输入数据，但没有蒙版
         background = np.zeros((100, 100, 3), dtype=np.uint8)
@@ -150,7 +168,7 @@ class TestFillRepaintApp(unittest.TestCase):
         }
 
         # 调用处理函数
-        result_image, status = self.app.process_image(
+        result_image, status = await self._run(
             input_data, "test prompt", 0.5)
 
         # 验证结果
@@ -0,0 +1,215 @@
+import asyncio
+import io
+import os
+import struct
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import gradio as gr
+import numpy as np
+from PIL import Image
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..')))
+
+from comfyui_gradio.client.ws_listener import ExecutionListener
+from comfyui_gradio.config import Config
+from comfyui_gradio.services import (
+    fill_repaint, fill_replace, image_extend, image_upscale,
+    manual_remove_object, remove_background, remove_object, swap_face
+)
+
+# 预览图的二进制帧头：事件类型1（预览图） + 图片格式2（PNG）
+PREVIEW_HEADER = struct.pack(">I", 1) + struct.pack(">I", 2)
+
+
+def _png(color: str) -> bytes:
+    """生成PNG编码的测试图片"""
+    buffer = io.BytesIO()
+    Image.new("RGB", (8, 8), color=color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _masked_input() -> dict:
+    """带蒙版的ImageEditor输入"""
+    mask = np.zeros((64, 64, 4), dtype=np.uint8)
+    mask[16:48, 16:48, 3] = 255
+    return {"background": np.zeros((64, 64, 3), dtype=np.uint8),
+            "layers": [mask]}
+
+
+# 各带预览图的服务：(模块, 应用类, 处理参数)
+SERVICES = [
+    (fill_repaint, "FillRepaintApp",
+     lambda: (_masked_input(), "test prompt", 0.5)),
+    (fill_replace, "FillReplaceApp",
+     lambda: (_masked_input(), Image.new("RGB", (32, 32)), "clothes")),
+    (image_extend, "ImageExtendApp",
+     lambda: (Image.new("RGB", (64, 64)), "sky", 32, 0, 0, 0)),
+]
+
+
+class TestServicePreviews(unittest.IsolatedAsyncioTestCase):
+    """测试采样预览图推送到结果图片，以及中止处理时取消ComfyUI中的prompt"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.output_dir = Path(self.temp_dir.name) / "output"
+        self.output_dir.mkdir()
+        get = Config.get
+        overrides = {
+            "paths.input_dir": self.temp_dir.name,
+            "paths.output_dir": str(self.output_dir),
+            "paths.clipspace_dir": self.temp_dir.name,
+            "comfyui_server.validate_workflows": False,
+            "comfyui_server.stats_log_interval": 0,
+        }
+        self.config_patcher = patch.object(
+            Config, "get", side_effect=lambda key, default=None:
+            overrides[key] if key in overrides else get(key, default))
+        self.config_patcher.start()
+        # 已提交的工作流，键为prompt_id
+        self.prompts = {}
+        self.submitted = asyncio.Event()
+
+    def tearDown(self):
+        self.config_patcher.stop()
+        self.temp_dir.cleanup()
+
+    def _create_app(self, module, name):
+        """创建服务应用，后端使用本地文件模式，事件由测试推送"""
+        app = getattr(module, name)()
+        for backend in app.pool.backends:
+            backend.listener = ExecutionListener(
+                backend.base_url, backend.client_id)
+            backend.listener.start = MagicMock()
+            backend.listener.connected = True
+            backend.upload_mode = "filesystem"
+            backend.result_mode = "filesystem"
+            backend.result_cache = None
+            backend.breaker.record_success()
+        return app
+
+    async def _respond(self, method, path, **kwargs):
+        """模拟ComfyUI接口"""
+        response = MagicMock()
+        if path == "/prompt":
+            payload = kwargs["json"]
+            self.prompts[payload["prompt_id"]] = payload["prompt"]
+            self.submitted.set()
+            response.json.return_value = {"prompt_id": payload["prompt_id"]}
+        elif method == "GET" and path == "/queue":
+            response.json.return_value = {
+                "queue_running": [], "queue_pending": []}
+        else:
+            response.json.return_value = {}
+        return response
+
+    async def _watched_listener(self, app, prompt_id):
+        """等待请求订阅执行进度，返回该prompt所在后端的事件监听器"""
+        while True:
+            for backend in app.pool.backends:
+                state = backend.listener._states.get(prompt_id)
+                if state is not None and state._watchers:
+                    return backend.listener
+            await asyncio.sleep(0.01)
+
+    async def _send_preview(self, app):
+        """提交后推送一张采样预览图，返回(prompt_id, 事件监听器)"""
+        await self.submitted.wait()
+        prompt_id = next(iter(self.prompts))
+        listener = await self._watched_listener(app, prompt_id)
+        listener._handle_message({
+            "type": "executing",
+            "data": {"prompt_id": prompt_id, "node": "3"}
+        })
+        listener._handle_binary(PREVIEW_HEADER + _png("red"))
+        return prompt_id, listener
+
+    def _finish(self, prompt_id, listener):
+        """写出结果文件并推送完成事件"""
+        prefix = next(
+            node["inputs"]["filename_prefix"]
+            for node in self.prompts[prompt_id].values()
+            if "filename_prefix" in node.get("inputs", {}))
+        Image.new("RGB", (64, 64), color="green").save(
+            self.output_dir / f"{prefix}_00001_.png")
+        listener._handle_message({
+            "type": "execution_success", "data": {"prompt_id": prompt_id}
+        })
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_preview_yielded_before_result(self, mock_request):
+        """测试采样预览图在结果之前推送到结果图片"""
+        mock_request.side_effect = self._respond
+        for module, name, args in SERVICES:
+            with self.subTest(service=name):
+                self.prompts.clear()
+                self.submitted.clear()
+                app = self._create_app(module, name)
+                sender = asyncio.create_task(self._send_preview(app))
+                outputs = []
+                async for output in app.process_image(*args()):
+                    outputs.append(output)
+                    if isinstance(output[0], Image.Image) and sender.done():
+                        self._finish(*sender.result())
+
+                previews = [image for image, _ in outputs[:-1]
+                            if isinstance(image, Image.Image)]
+                self.assertTrue(previews)
+                self.assertEqual(previews[0].getpixel((0, 0)), (255, 0, 0))
+                result_image, status = outputs[-1]
+                self.assertEqual(status, "处理成功")
+                self.assertEqual(result_image.getpixel((0, 0)), (0, 128, 0))
+
+    @patch('httpx.AsyncClient.request', new_callable=AsyncMock)
+    async def test_abort_cancels_prompt(self, mock_request):
+        """测试中止处理事件后，ComfyUI中对应的prompt被删除"""
+        mock_request.side_effect = self._respond
+        for module, name, args in SERVICES:
+            with self.subTest(service=name):
+                self.prompts.clear()
+                self.submitted.clear()
+                mock_request.reset_mock()
+                app = self._create_app(module, name)
+
+                async def consume():
+                    async for _ in app.process_image(*args()):
+                        pass
+                task = asyncio.create_task(consume())
+                prompt_id, _ = await self._send_preview(app)
+                # Gradio中止事件时取消运行处理函数的任务
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                # 处理请求的任务在之后的事件循环中响应取消
+                await asyncio.sleep(0.1)
+                for backend in app.pool.backends:
+                    await asyncio.gather(*backend._background_tasks)
+
+                mock_request.assert_any_await(
+                    "POST", "/queue", json={"delete": [prompt_id]})
+
+    def test_abort_button_cancels_process_event(self):
+        """测试各服务的中止按钮取消处理事件"""
+        for module in [fill_repaint, fill_replace, image_extend,
+                       image_upscale, manual_remove_object,
+                       remove_background, remove_object, swap_face]:
+            with self.subTest(service=module.__name__):
+                with gr.Blocks() as demo:
+                    components = module.create_interface()
+                process_fn = next(
+                    fn_id for fn_id, fn in demo.fns.items()
+                    if (components["process_btn"]._id, "click") in fn.targets)
+                self.assertTrue(any(
+                    fn.is_cancel_function and process_fn in fn.cancels
+                    for fn in demo.fns.values()
+                    if (components["abort_btn"]._id, "click") in fn.targets))
+
+
+if __name__ == '__main__':
+    unittest.main()